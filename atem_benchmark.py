@@ -0,0 +1,940 @@
+# ATEM benchmarks:
+# Small timing harnesses for the hot paths of the server. These run the
+# server code in-process (no sockets) so the numbers only reflect the cost
+# of the Python code itself.
+#
+# python atem_benchmark.py            (run everything)
+# python atem_benchmark.py connect    (run just the named benchmark(s))
+
+import argparse
+import asyncio
+import contextlib
+import io
+import multiprocessing
+import os
+import select
+import selectors
+import socket
+import struct
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import atem_config
+import atem_commands
+import atem_latency
+import atem_persist
+import atem_server
+import atem_switcher
+import client_manager
+import raw_commands
+from atem_packet import Packet, ATEMFlags
+from client_manager import ClientManager
+
+
+benchmarks = {}
+
+def benchmark(func):
+    # register a benchmark by its function name, minus the "bench_" prefix
+    benchmarks[func.__name__[len("bench_"):]] = func
+    return func
+
+
+def report(name, total_sec, iterations, unit="op"):
+    per_op_us = total_sec / iterations * 1000000
+    print(f"  {name:<40} {per_op_us:10.2f} us/{unit}  ({iterations} x)")
+
+
+def quiet():
+    # the server prints on connects and state changes; keep that out of the report
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+def make_packet(addr, flags, session_id, acked_packet_id=0, packet_id=0, payload=b''):
+    length = 12 + len(payload)
+    raw = struct.pack('!3H 4x H', (flags << 11) | length, session_id, acked_packet_id, packet_id) + payload
+    packet = Packet(addr, raw)
+    packet.parse_packet()
+    return packet
+
+
+def connect_client(client_mgr, addr, session_id=0x1234):
+    """
+    Run a client through the handshake: init packet, then the ack of the
+    init response which triggers the setup dump.
+    """
+    init = make_packet(addr, ATEMFlags.INIT, session_id, payload=b'\x01' + b'\x00' * 7)
+    client = client_mgr.get_client(init.ip_and_port, init.session_id)
+    client.process_inbound_packet(init)
+    ack = make_packet(addr, ATEMFlags.ACK, session_id)
+    client.process_inbound_packet(ack)
+    return client
+
+
+class NullSocket(object):
+    # stands in for the server socket, just counts what would have been sent
+    def __init__(self):
+        self.packets_sent = 0
+        self.bytes_sent = 0
+
+    def sendto(self, data, addr):
+        self.packets_sent += 1
+        self.bytes_sent += len(data)
+
+
+def connect_clients(num_clients):
+    """
+    Create a ClientManager with num_clients fully connected clients (setup dump acked)
+    """
+    client_mgr = ClientManager()
+    with quiet():
+        for i in range(num_clients):
+            addr = ('127.0.0.1', 10000 + i)
+            client = connect_client(client_mgr, addr)
+            client.update(NullSocket())
+            ack_all(client)
+    return client_mgr
+
+
+def ack_all(client):
+    # the client acks everything the server has sent it so far
+    ack = make_packet(client.ip_and_port, ATEMFlags.ACK, client.session_id, client.current_packet_id)
+    client.process_inbound_packet(ack)
+
+
+@benchmark
+def bench_connect(iterations):
+    raw_setup_commands = [raw_commands.commands1, raw_commands.commands2,
+                          raw_commands.commands3, raw_commands.commands4,
+                          raw_commands.commands5, raw_commands.commands6]
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for rsc in raw_setup_commands:
+            raw_commands.getByteStream(rsc)
+    report("decode setup dump from hex", time.perf_counter() - start, iterations)
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        atem_config.state_changed()
+        atem_commands.build_setup_commands_list()
+    report("rebuild state dump after a change", time.perf_counter() - start, iterations)
+
+    atem_commands.build_setup_commands_list()
+    client_mgr = ClientManager()
+    with quiet():
+        start = time.perf_counter()
+        for i in range(iterations):
+            connect_client(client_mgr, ('127.0.0.1', 10000 + i))
+        elapsed = time.perf_counter() - start
+    report("handshake incl. setup dump", elapsed, iterations, "connect")
+
+
+@benchmark
+def bench_fanout(iterations):
+    # A state change seen by every client: the cost per client should stay
+    # flat as the number of clients grows, and not depend on the payload size
+    # (only the packet header is built per client).
+    sock = NullSocket()
+    for num_clients in (10, 100, 500):
+        client_mgr = connect_clients(num_clients)
+        sender = next(iter(client_mgr.clients.values()))
+        for num_tally in (1, 8):
+            elapsed = 0
+            for _ in range(max(1, iterations // 10)):
+                cc = atem_commands.CommandCarrier()
+                cc.commands.append(atem_commands.Cmd_Time())
+                for _ in range(num_tally):
+                    cc.commands.append(atem_commands.Cmd_TlIn(0))
+                    cc.commands.append(atem_commands.Cmd_TlSr(0))
+                cc.commands.append(atem_commands.Cmd_PrgI(0))
+                start = time.perf_counter()
+                client_mgr.send_to_other_clients(sender, cc)
+                client_mgr.run_clients(sock)
+                elapsed += time.perf_counter() - start
+                for client in list(client_mgr.clients.values()):
+                    ack_all(client)
+            payload_size = len(cc.cmd_bytes)
+            report(f"{num_clients} clients, {payload_size} byte payload", elapsed,
+                   max(1, iterations // 10) * (num_clients - 1), "client")
+
+
+@benchmark
+def bench_lookup(iterations):
+    # finding the client for an inbound datagram
+    for num_clients in (10, 100, 1000):
+        client_mgr = connect_clients(num_clients)
+        keys = [(client.ip_and_port, client.session_id) for client in client_mgr.clients.values()]
+        start = time.perf_counter()
+        for _ in range(iterations):
+            for ip_and_port, session_id in keys:
+                client_mgr.get_client(ip_and_port, session_id)
+        report(f"get_client with {num_clients} clients", time.perf_counter() - start,
+               iterations * num_clients, "lookup")
+
+
+@benchmark
+def bench_backlog(iterations):
+    # A slow client with a deep backlog of unacked packets: the cost of a
+    # client tick and of an ack should not grow with the backlog.
+    sock = NullSocket()
+    for backlog in (10, 1000, 10000):
+        client_mgr = connect_clients(1)
+        client = next(iter(client_mgr.clients.values()))
+        first_packet_id = client.current_packet_id + 1
+        for _ in range(backlog):
+            cc = atem_commands.CommandCarrier()
+            cc.commands.append(atem_commands.Cmd_PrgI(0))
+            client.outbound_commands_list.append(cc)
+        # every one of them has to go out, not just the latest, and all at once
+        client_manager.COALESCE_UPDATES = False
+        in_flight_window = client_manager.IN_FLIGHT_WINDOW
+        client_manager.IN_FLIGHT_WINDOW = backlog + 1
+        try:
+            client.update(sock)
+        finally:
+            client_manager.COALESCE_UPDATES = True
+            client_manager.IN_FLIGHT_WINDOW = in_flight_window
+        start = time.perf_counter()
+        for _ in range(iterations):
+            client.update(sock)
+        report(f"client tick, {backlog} packets unacked", time.perf_counter() - start, iterations, "tick")
+        start = time.perf_counter()
+        for i in range(min(iterations, backlog)):
+            ack = make_packet(client.ip_and_port, ATEMFlags.ACK, client.session_id, first_packet_id + i)
+            client.process_inbound_packet(ack)
+        report(f"ack one packet, {backlog} packets unacked", time.perf_counter() - start, min(iterations, backlog), "ack")
+
+
+def make_command_payload(code, content):
+    return struct.pack('!H 2x 4s', len(content) + 8, code.encode()) + content
+
+
+@benchmark
+def bench_coalesce(iterations):
+    # A panel scrubbing the preview buttons: a burst of CPvI in one tick.
+    # With coalescing the other clients only get the last one.
+    for burst in (1, 4, 16):
+        for coalesce in (False, True):
+            client_manager.COALESCE_UPDATES = coalesce
+            try:
+                client_mgr = connect_clients(100)
+                sender = next(iter(client_mgr.clients.values()))
+                sock = NullSocket()
+                packet_id = 0
+                elapsed = 0
+                rounds = max(1, iterations // 10)
+                with quiet():
+                    for _ in range(rounds):
+                        start = time.perf_counter()
+                        for source in range(1, burst + 1):
+                            packet_id += 1
+                            packet = make_packet(sender.ip_and_port, ATEMFlags.COMMAND, sender.session_id, packet_id=packet_id,
+                                                 payload=make_command_payload('CPvI', struct.pack('!B x H', 0, source)))
+                            sender.process_inbound_packet(packet)
+                        client_mgr.run_clients(sock)
+                        elapsed += time.perf_counter() - start
+                        for client in list(client_mgr.clients.values()):
+                            ack_all(client)
+            finally:
+                client_manager.COALESCE_UPDATES = True
+            label = "coalesced" if coalesce else "every update"
+            report(f"burst of {burst} CPvI, 100 clients, {label}", elapsed, rounds, "burst")
+            print(f"    {sock.packets_sent / rounds:.0f} packets, {sock.bytes_sent / rounds / 1000:.1f} KB per burst")
+
+
+@benchmark
+def bench_packetize(iterations):
+    # A panel firing a few commands in one go (eg. a macro). What comes out
+    # of one wakeup goes to each client in as few packets as fit the MTU,
+    # and the sender gets one ack for the lot.
+    burst = (('CPvI', struct.pack('!B x H', 0, 3)), ('CPgI', struct.pack('!B x H', 0, 2)),
+             ('DCut', struct.pack('!B 3x', 0)), ('CPvI', struct.pack('!B x H', 0, 4)))
+    for num_clients in (10, 100):
+        client_mgr = connect_clients(num_clients)
+        sender = next(iter(client_mgr.clients.values()))
+        sock = NullSocket()
+        packet_id = 0
+        elapsed = 0
+        rounds = max(1, iterations // 10)
+        with quiet():
+            for _ in range(rounds):
+                start = time.perf_counter()
+                for code, content in burst:
+                    packet_id += 1
+                    packet = make_packet(sender.ip_and_port, ATEMFlags.COMMAND, sender.session_id, packet_id=packet_id,
+                                         payload=make_command_payload(code, content))
+                    sender.process_inbound_packet(packet)
+                client_mgr.run_clients(sock)
+                elapsed += time.perf_counter() - start
+                for client in list(client_mgr.clients.values()):
+                    ack_all(client)
+        report(f"burst of {len(burst)} commands, {num_clients} clients", elapsed, rounds, "burst")
+        print(f"    {sock.packets_sent / rounds / num_clients:.2f} packets, "
+              f"{sock.bytes_sent / rounds / num_clients:.0f} bytes per client per burst")
+
+
+@benchmark
+def bench_keepalive(iterations):
+    # Idle clients (eg. tally lights). A loop wakeup only costs the clients
+    # that are due, and a quiet client that answers slowly still only gets
+    # the one keepalive (plus its resends).
+    sock = NullSocket()
+    for num_clients in (10, 100, 1000):
+        client_mgr = connect_clients(num_clients)
+        with quiet():
+            client_mgr.run_clients(sock)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            client_mgr.run_clients(sock)
+        report(f"idle wakeup, {num_clients} clients", time.perf_counter() - start, iterations, "wakeup")
+
+    # 100 quiet clients for a few seconds of select loop, each answering
+    # what the server sends it after a 200 ms round trip
+    class DelayedAckSocket(NullSocket):
+        def __init__(self):
+            super().__init__()
+            self.acks_due = []
+
+        def sendto(self, data, addr):
+            super().sendto(data, addr)
+            packet_id = struct.unpack_from('!H', data, 10)[0]
+            self.acks_due.append((time.monotonic() + 0.200, addr, packet_id))
+
+    client_mgr = connect_clients(100)
+    clients = {client.ip_and_port: client for client in client_mgr.clients.values()}
+    sock = DelayedAckSocket()
+    duration = 3.0
+    with quiet():
+        end_time = time.monotonic() + duration
+        while time.monotonic() < end_time:
+            time.sleep(client_mgr.get_wait_time())
+            now = time.monotonic()
+            while sock.acks_due and sock.acks_due[0][0] <= now:
+                _, addr, packet_id = sock.acks_due.pop(0)
+                client = clients[addr]
+                if packet_id:
+                    client.process_inbound_packet(make_packet(addr, ATEMFlags.ACK, client.session_id, packet_id))
+            client_mgr.run_clients(sock)
+    print(f"  100 quiet clients, 200 ms round trip: {sock.packets_sent / duration / 100:.2f} packets, "
+          f"{sock.bytes_sent / duration / 100:.1f} bytes per client per second")
+
+
+@benchmark
+def bench_transition(iterations):
+    # Client ticks while transitions are running on an ME, both DSKs and
+    # fade to black (nothing due yet). The running transitions shouldn't
+    # cost anything per client per tick.
+    sock = NullSocket()
+    for num_clients in (10, 100, 500):
+        client_mgr = connect_clients(num_clients)
+        sender = next(iter(client_mgr.clients.values()))
+        with quiet():
+            for packet_id, (code, index) in enumerate((('DAut', 0), ('DDsA', 0), ('DDsA', 1), ('FtbA', 0)), 1):
+                packet = make_packet(sender.ip_and_port, ATEMFlags.COMMAND, sender.session_id, packet_id=packet_id,
+                                     payload=make_command_payload(code, struct.pack('!B 3x', index)))
+                sender.process_inbound_packet(packet)
+            client_mgr.run_clients(sock)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            client_mgr.run_clients(sock)
+        report(f"tick, {num_clients} clients, 4 transitions running", time.perf_counter() - start, iterations, "tick")
+    atem_commands.transition_engine.transitions.clear()
+    atem_config.state.mes[0].transition_position = 0
+
+    # An auto transition cancelled by a cut straight after, responses encoded
+    with quiet():
+        commands = []
+        for code in ('DAut', 'DCut'):
+            cmd = atem_commands.get_command_object(make_command_payload(code, struct.pack('!B 3x', 0)), code)
+            cmd.parse_cmd()
+            commands.append(cmd)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            for cmd in commands:
+                for cc in atem_commands.get_response([cmd]):
+                    cc.to_bytes()
+        total_sec = time.perf_counter() - start
+    report("DAut then DCut to encoded responses", total_sec, iterations)
+
+    # Updates for the 4 transitions when they are all due, sent every frame
+    engine = atem_commands.transition_engine
+    update_frames = atem_commands.TRANSITION_UPDATE_FRAMES
+    atem_commands.TRANSITION_UPDATE_FRAMES = 1
+    try:
+        with quiet():
+            now = time.monotonic()
+            engine.start(atem_commands.MixEffectTransition(('me', 0)), now)
+            engine.start(atem_commands.DownstreamKeyTransition(('dsk', 0)), now)
+            engine.start(atem_commands.DownstreamKeyTransition(('dsk', 1)), now)
+            engine.start(atem_commands.FadeToBlackTransition(('ftb', 0)), now)
+            elapsed = 0
+            for _ in range(iterations):
+                start = time.perf_counter()
+                for cc in engine.tick(engine.get_next_time()):
+                    cc.to_bytes()
+                elapsed += time.perf_counter() - start
+                for transition in engine.transitions.values():
+                    # keep them running
+                    transition.start_time += 1 / transition.frame_rate
+    finally:
+        atem_commands.TRANSITION_UPDATE_FRAMES = update_frames
+        engine.transitions.clear()
+        atem_config.state.mes[0].transition_position = 0
+    report("update 4 transitions, encoded", elapsed, iterations, "frame")
+
+
+def parse_allocations(addr, buf, length, iterations):
+    # keep every parsed packet alive and compare tracemalloc snapshots
+    packets = []
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for _ in range(iterations):
+        packet = Packet(addr, memoryview(buf)[:length])
+        packet.parse_packet()
+        packets.append(packet)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    blocks = sum(stat.count_diff for stat in stats)
+    size = sum(stat.size_diff for stat in stats)
+    return blocks / iterations, size / iterations
+
+
+@benchmark
+def bench_parse(iterations):
+    # Parse inbound packets straight out of a reused receive buffer, like the
+    # select loop does.
+    small_payload = (make_command_payload('CPgI', struct.pack('!B x H', 0, 3)) +
+                     make_command_payload('CPvI', struct.pack('!B x H', 0, 4)) +
+                     make_command_payload('DCut', struct.pack('!B 3x', 0)))
+    large_payload = raw_commands.getByteStream(raw_commands.commands1)
+    addr = ('127.0.0.1', 10000)
+    for name, payload in (("3 commands", small_payload), (f"{len(large_payload)} bytes", large_payload)):
+        datagram = struct.pack('!3H 4x H', (ATEMFlags.COMMAND << 11) | (12 + len(payload)), 0x8001, 0, 1) + payload
+        buf = bytearray(2048)
+        buf[:len(datagram)] = datagram
+        start = time.perf_counter()
+        for _ in range(iterations):
+            packet = Packet(addr, memoryview(buf)[:len(datagram)])
+            packet.parse_packet()
+        report(f"parse packet, {name}", time.perf_counter() - start, iterations, "packet")
+        blocks, size = parse_allocations(addr, buf, len(datagram), iterations)
+        print(f"  {'  allocations per packet':<40} {blocks:10.1f} blocks, {size:.0f} bytes")
+
+
+@benchmark
+def bench_encode(iterations):
+    # Encode already built commands, ie. just the cost of turning them into bytes.
+    me = 0
+    cut_response = [atem_commands.Cmd_Time(), atem_commands.Cmd_TlIn(me), atem_commands.Cmd_TlSr(me),
+                    atem_commands.Cmd_PrgI(me), atem_commands.Cmd_PrvI(me)]
+    start = time.perf_counter()
+    for _ in range(iterations):
+        cc = atem_commands.CommandCarrier()
+        cc.commands = cut_response
+        cc.to_bytes()
+    report("encode cut response carrier", time.perf_counter() - start, iterations)
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        packet = Packet(('127.0.0.1', 10000))
+        packet.session_id = 0x8001
+        packet.packet_id = 1
+        packet.commands = cut_response
+        packet.to_bytes()
+    report("encode cut response packet", time.perf_counter() - start, iterations)
+
+    state_commands = atem_commands.build_current_state_command_list()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for cmd in state_commands:
+            cmd.to_bytes()
+    report(f"encode state dump, {len(state_commands)} commands", time.perf_counter() - start, iterations)
+
+
+@benchmark
+def bench_cut(iterations):
+    # Inbound command to encoded response: decode the command, update the
+    # switcher state, build the response commands and encode them.
+    for code, content in (('DCut', struct.pack('!B 3x', 0)), ('CPgI', struct.pack('!B x H', 0, 3))):
+        cmd_bytes = make_command_payload(code, content)
+        with quiet():
+            start = time.perf_counter()
+            for _ in range(iterations):
+                cmd = atem_commands.get_command_object(cmd_bytes, code)
+                cmd.parse_cmd()
+                for cc in atem_commands.get_response([cmd]):
+                    cc.to_bytes()
+            total_sec = time.perf_counter() - start
+        report(f"{code} to encoded response", total_sec, iterations)
+
+
+@benchmark
+def bench_dispatch(iterations):
+    # Per registered command code: decoding the command (handler lookup
+    # included), then handling it (state change and building the response).
+    for code, handler in atem_commands.command_handlers.items():
+        cmd_bytes = make_command_payload(code, bytes(handler.cmd_class.command_length - 8))
+        start = time.perf_counter()
+        for _ in range(iterations):
+            cmd = atem_commands.get_command_object(cmd_bytes, code)
+            cmd.parse_cmd()
+        report(f"decode {code}", time.perf_counter() - start, iterations)
+        with quiet():
+            start = time.perf_counter()
+            for _ in range(iterations):
+                atem_commands.get_response([cmd])
+            total_sec = time.perf_counter() - start
+        report(f"handle {code}", total_sec, iterations)
+
+    # commands the server doesn't know get dropped while parsing the packet
+    payload = make_command_payload('XXXX', bytes(4))
+    datagram = struct.pack('!3H 4x H', (ATEMFlags.COMMAND << 11) | (12 + len(payload)), 0x8001, 0, 1) + payload
+    addr = ('127.0.0.1', 10000)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        packet = Packet(addr, datagram)
+        packet.parse_packet()
+    report("parse packet, 1 unknown command", time.perf_counter() - start, iterations, "packet")
+    buf = bytearray(datagram)
+    blocks, size = parse_allocations(addr, buf, len(buf), iterations)
+    print(f"  {'  allocations per packet':<40} {blocks:10.1f} blocks, {size:.0f} bytes")
+
+
+@benchmark
+def bench_tally(iterations):
+    # Tally commands built and encoded after every cut, for the configured
+    # switcher and for a made up bigger one.
+    state = atem_config.state
+    me = state.mes[0]
+    product, inputs = state.product, state.inputs
+    big_product = "Benchmark 80 input switcher"
+    atem_config.DEVICE_VIDEO_SOURCES[big_product] = list(range(81)) + [s for s in atem_config.DEVICE_VIDEO_SOURCES[product] if s > 80]
+    profiles = ((product, inputs), (big_product, {i: atem_config.InputState(i) for i in range(81)}))
+    try:
+        for state.product, state.inputs in profiles:
+            atem_commands.tally_tables.clear()
+            start = time.perf_counter()
+            for _ in range(iterations):
+                me.program_input, me.preview_input = me.preview_input, me.program_input
+                atem_commands.Cmd_TlIn(0).to_bytes()
+                atem_commands.Cmd_TlSr(0).to_bytes()
+            num_sources = len(atem_config.DEVICE_VIDEO_SOURCES[state.product])
+            report(f"TlIn + TlSr, {len(state.inputs)} inputs, {num_sources} sources", time.perf_counter() - start, iterations, "cut")
+    finally:
+        state.product, state.inputs = product, inputs
+        del atem_config.DEVICE_VIDEO_SOURCES[big_product]
+        atem_commands.tally_tables.clear()
+
+
+@benchmark
+def bench_latency(iterations):
+    # A panel command through to the packets for every client with the
+    # latency stats off and on. Off should cost nothing.
+    client_mgr = connect_clients(10)
+    sender = next(iter(client_mgr.clients.values()))
+    sock = NullSocket()
+    payload = make_command_payload('CPvI', struct.pack('!B x H', 0, 2))
+    for enabled in (False, True):
+        atem_latency.reset()
+        if enabled:
+            atem_latency.enable()
+        elapsed = 0
+        try:
+            with quiet():
+                for i in range(iterations):
+                    start = time.perf_counter()
+                    packet = make_packet(sender.ip_and_port, ATEMFlags.COMMAND, sender.session_id, packet_id=i + 1, payload=payload)
+                    sender.process_inbound_packet(packet)
+                    client_mgr.run_clients(sock)
+                    elapsed += time.perf_counter() - start
+                    for client in client_mgr.clients.values():
+                        ack_all(client)
+        finally:
+            atem_latency.disable()
+        report(f"CPvI to 10 clients, stats {'on' if enabled else 'off'}", elapsed, iterations, "cmd")
+    atem_latency.reset()
+
+
+def serve(port, config_file, use_select):
+    # runs in a separate process for the socket level benchmarks
+    sys.stdout = open(os.devnull, "w")
+    atem_config.config_init(config_file)
+    client_mgr = ClientManager()
+    if use_select:
+        atem_server.run_select_server("127.0.0.1", port, client_mgr)
+    else:
+        atem_server.asyncio.run(atem_server.run_asyncio_server("127.0.0.1", port, client_mgr))
+
+
+def udp_handshake(sock, server_addr):
+    # just enough of the client side of the handshake to get connected
+    sock.settimeout(1.0)
+    sock.sendto(struct.pack('!3H 4x H', (ATEMFlags.INIT << 11) | 20, 0x1234, 0, 0) + b'\x01' + b'\x00' * 7, server_addr)
+    sock.recvfrom(2048)
+    sock.sendto(struct.pack('!3H 4x H', (ATEMFlags.ACK << 11) | 12, 0x1234, 0, 0), server_addr)
+    while True:
+        data = sock.recvfrom(2048)[0]
+        flags_and_size, session_id, acked_packet_id, packet_id = struct.unpack_from('!3H 4x H', data)
+        if data.endswith(b'InCm\x01\x00\x00\x00'):
+            break
+    sock.sendto(struct.pack('!3H 4x H', (ATEMFlags.ACK << 11) | 12, session_id, packet_id, 0), server_addr)
+    sock.setblocking(False)
+    return session_id
+
+
+def udp_load(port, num_clients, packets_per_client, window):
+    """
+    Every client sends packets_per_client command packets (an unknown
+    command, so the server just acks it), keeping up to window packets in
+    flight. Returns (acked packets, seconds, resent packets).
+    """
+    server_addr = ("127.0.0.1", port)
+    sel = selectors.DefaultSelector()
+    clients = []
+    for _ in range(num_clients):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        session_id = udp_handshake(sock, server_addr)
+        # state: [session id, next packet id, acked count, {packet id: send time}]
+        state = [session_id, 1, 0, {}]
+        clients.append((sock, state))
+        sel.register(sock, selectors.EVENT_READ, state)
+    payload = make_command_payload('BNCH', b'\x00' * 4)
+
+    def send(sock, state, packet_id):
+        sock.sendto(struct.pack('!3H 4x H', (ATEMFlags.COMMAND << 11) | (12 + len(payload)), state[0], 0, packet_id) + payload, server_addr)
+        state[3][packet_id] = time.perf_counter()
+
+    resent = 0
+    start = time.perf_counter()
+    for sock, state in clients:
+        for _ in range(min(window, packets_per_client)):
+            send(sock, state, state[1])
+            state[1] += 1
+    remaining = num_clients
+    while remaining:
+        for key, _ in sel.select(0.1):
+            sock, state = key.fileobj, key.data
+            while True:
+                try:
+                    data = sock.recv(2048)
+                except BlockingIOError:
+                    break
+                flags_and_size, session_id, acked_packet_id = struct.unpack_from('!3H', data)
+                if (flags_and_size >> 11) & ATEMFlags.ACK and acked_packet_id in state[3]:
+                    del state[3][acked_packet_id]
+                    state[2] += 1
+                    if state[1] <= packets_per_client:
+                        send(sock, state, state[1])
+                        state[1] += 1
+                    elif state[2] == packets_per_client:
+                        remaining -= 1
+        # resend anything that went missing
+        now = time.perf_counter()
+        for sock, state in clients:
+            for packet_id, sent in list(state[3].items()):
+                if now - sent > 0.5:
+                    send(sock, state, packet_id)
+                    resent += 1
+    elapsed = time.perf_counter() - start
+    for sock, state in clients:
+        sock.close()
+    return num_clients * packets_per_client, elapsed, resent
+
+
+@benchmark
+def bench_load(iterations):
+    # Socket level throughput: lots of clients each keeping a few packets in
+    # flight against a server running in its own process.
+    for use_select, loop_name in ((True, "select"), (False, "asyncio")):
+        for num_clients in (10, 100):
+            port = 19910
+            server = multiprocessing.Process(target=serve, args=(port, "default_config.xml", use_select), daemon=True)
+            server.start()
+            time.sleep(0.5)
+            try:
+                packets, elapsed, resent = udp_load(port, num_clients, iterations, 4)
+            finally:
+                server.terminate()
+                server.join()
+            print(f"  {loop_name}, {num_clients} clients: {packets / elapsed:10.0f} packets/s  ({packets} packets, {resent} resent)")
+
+
+def serve_sharded(port, config_file, num_workers):
+    sys.stdout = open(os.devnull, "w")
+    atem_server.run_sharded_server("127.0.0.1", port, config_file, num_workers)
+
+
+@benchmark
+def bench_shards(iterations):
+    # Socket level throughput with the server split across worker processes
+    # (atem_server.py --workers). The load comes from as many processes as
+    # there are workers so the load generator isn't the limit. The numbers
+    # only go up while there are spare cores, check os.cpu_count().
+    num_clients = 120
+    print(f"  ({os.cpu_count()} cpus)")
+    for num_workers in (1, 2, 4):
+        port = 19911
+        if num_workers == 1:
+            # the plain single process server
+            server = multiprocessing.Process(target=serve, args=(port, "default_config.xml", False))
+        else:
+            server = multiprocessing.Process(target=serve_sharded, args=(port, "default_config.xml", num_workers))
+        server.start()
+        time.sleep(1.0)
+        try:
+            with multiprocessing.Pool(num_workers) as pool:
+                results = pool.starmap(udp_load, [(port, num_clients // num_workers, iterations, 4)] * num_workers)
+        finally:
+            server.terminate()
+            server.join()
+        packets = sum(result[0] for result in results)
+        elapsed = max(result[1] for result in results)
+        resent = sum(result[2] for result in results)
+        print(f"  {num_workers} workers, {num_clients} clients: {packets / elapsed:10.0f} packets/s  ({packets} packets, {resent} resent)")
+
+
+def serve_switchers(port, config_file, num_switchers, conn):
+    # runs num_switchers switchers in a separate process and tells the
+    # parent its CPU time whenever asked
+    sys.stdout = open(os.devnull, "w")
+    switchers = [atem_switcher.VirtualSwitcher(config_file, port + i) for i in range(num_switchers)]
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        loop.add_reader(conn.fileno(), lambda: conn.recv() or conn.send(time.process_time()))
+        conn.send("ready")
+        await atem_server.run_asyncio_switchers("127.0.0.1", switchers)
+    asyncio.run(run())
+
+
+def interpreter_memory(config_file):
+    # peak RSS (KB) of a fresh interpreter with one switcher loaded, ie. the
+    # cost of running each switcher as its own server
+    code = ("import resource, atem_config, atem_commands, atem_server; "
+            f"atem_config.config_init({config_file!r}); atem_commands.build_setup_commands_list(); "
+            "print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)")
+    return int(subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout)
+
+
+@benchmark
+def bench_switchers(iterations):
+    # The cost of each extra switcher in one process (atem_server.py
+    # --switchers): memory for its state, caches and setup dump, and CPU
+    # when idle and with a client connected that only answers the pings.
+    num_switchers = 20
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    with quiet():
+        switchers = [atem_switcher.VirtualSwitcher("default_config.xml", 19920 + i) for i in range(num_switchers)]
+    per_switcher = (tracemalloc.get_traced_memory()[0] - before) / num_switchers
+    tracemalloc.stop()
+    atem_switcher.deactivate()
+    del switchers
+    print(f"  {'memory per switcher':<40} {per_switcher / 1024:10.1f} KB")
+    print(f"  {'memory per interpreter (one switcher)':<40} {interpreter_memory('default_config.xml'):10.1f} KB")
+
+    port = 19920
+    conn, child_conn = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve_switchers, args=(port, "default_config.xml", num_switchers, child_conn), daemon=True)
+    server.start()
+    conn.recv()
+
+    def cpu_per_switcher(seconds, socks):
+        # CPU the server used over the next few seconds, answering its pings meanwhile
+        conn.send(None)
+        start = conn.recv()
+        end_time = time.monotonic() + seconds
+        while time.monotonic() < end_time:
+            if not socks:
+                time.sleep(0.1)
+                continue
+            for sock in select.select(socks, [], [], 0.1)[0]:
+                data, addr = sock.recvfrom(2048)
+                flags_and_size, session_id, acked_packet_id, packet_id = struct.unpack_from('!3H 4x H', data)
+                if (flags_and_size >> 11) & ATEMFlags.COMMAND:
+                    sock.sendto(struct.pack('!3H 4x H', (ATEMFlags.ACK << 11) | 12, session_id, packet_id, 0), addr)
+        conn.send(None)
+        return (conn.recv() - start) / seconds / num_switchers
+
+    try:
+        seconds = max(1, iterations // 100)
+        print(f"  {'idle CPU per switcher':<40} {cpu_per_switcher(seconds, []) * 100:10.3f} %")
+        socks = []
+        for i in range(num_switchers):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            udp_handshake(sock, ("127.0.0.1", port + i))
+            socks.append(sock)
+        print(f"  {'CPU per switcher, 1 idle client':<40} {cpu_per_switcher(seconds * 2, socks) * 100:10.3f} %")
+        for sock in socks:
+            sock.close()
+    finally:
+        server.terminate()
+        server.join()
+
+
+def make_large_profile(config_file, num_cameras, num_macros):
+    """
+    The config file padded out like the profile of a big switcher: camera
+    control for num_cameras cameras and num_macros macros of 20 steps
+    """
+    with open(config_file) as f:
+        xml = f.read()
+    cameras = "".join(
+        f'        <Parameter device="{device}" category="Video" parameter="Param{i}" value="{i}"/>\n'
+        for device in range(9, 9 + num_cameras) for i in range(100))
+    macros = "".join(
+        f'        <Macro index="{index}" name="Macro {index}" description="">\n'
+        + "".join(f'            <Op id="ProgramInput" mixEffectBlockIndex="0" input="{op % 8 + 1}"/>\n' for op in range(20))
+        + "        </Macro>\n"
+        for index in range(1, 1 + num_macros))
+    xml = xml.replace("    </CameraControl>", cameras + "    </CameraControl>")
+    return xml.replace("    </MacroPool>", macros + "    </MacroPool>")
+
+
+@benchmark
+def bench_config(iterations):
+    # Reading the config file at startup: parsing the XML against loading
+    # the snapshot of it saved the first time (see atem_config.CONFIG_CACHE_DIR)
+    import tempfile
+    config_file = "default_config.xml"
+    saved_cache_dir = atem_config.CONFIG_CACHE_DIR
+    with tempfile.TemporaryDirectory() as temp_dir:
+        large_file = os.path.join(temp_dir, "large_config.xml")
+        with open(large_file, "w") as f:
+            f.write(make_large_profile(config_file, 40, 500))
+        try:
+            for name, path in (("default config", config_file), ("large profile", large_file)):
+                with open(path, "rb") as f:
+                    size = len(f.read())
+                atem_config.CONFIG_CACHE_DIR = None
+                rounds = max(1, iterations // 10)
+                start = time.perf_counter()
+                for _ in range(rounds):
+                    atem_config.read_config_file(path)
+                report(f"{name} ({size // 1000} KB), parse XML", time.perf_counter() - start, rounds, "load")
+                atem_config.CONFIG_CACHE_DIR = os.path.join(temp_dir, "cache")
+                atem_config.read_config_file(path)
+                start = time.perf_counter()
+                for _ in range(rounds):
+                    atem_config.read_config_file(path)
+                report(f"{name} ({size // 1000} KB), snapshot", time.perf_counter() - start, rounds, "load")
+        finally:
+            atem_config.CONFIG_CACHE_DIR = saved_cache_dir
+
+        # a whole server start up to ready for clients (new interpreter)
+        for label, cache_dir in (("parse XML", None), ("snapshot", os.path.join(temp_dir, "cache"))):
+            code = ("import atem_config, atem_commands, atem_server; "
+                    f"atem_config.CONFIG_CACHE_DIR = {cache_dir!r}; "
+                    f"atem_config.config_init({large_file!r}); atem_commands.build_setup_commands_list()")
+            rounds = max(1, iterations // 40)
+            start = time.perf_counter()
+            for _ in range(rounds):
+                subprocess.run([sys.executable, "-c", code], check=True)
+            report(f"server start, large profile, {label}", time.perf_counter() - start, rounds, "start")
+
+
+@benchmark
+def bench_persist(iterations):
+    # Sustained state changes (CPgI, CPvI, DCut handled back to back) with
+    # the state saved (see atem_persist) and without. The server loop only
+    # pays for queueing the records, the writer thread catches up after.
+    import tempfile
+    commands = []
+    for code, content in (('CPgI', struct.pack('!B x H', 0, 3)), ('CPvI', struct.pack('!B x H', 0, 4)),
+                          ('DCut', struct.pack('!B 3x', 0))):
+        cmd = atem_commands.get_command_object(make_command_payload(code, content), code)
+        cmd.parse_cmd()
+        commands.append(cmd)
+    rounds = iterations * 50
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for label, state_file in (("not saved", None), ("saved", os.path.join(temp_dir, "switcher.state"))):
+            journal = atem_persist.open_state(state_file) if state_file else None
+            try:
+                with quiet():
+                    start = time.perf_counter()
+                    for i in range(rounds):
+                        atem_commands.get_response([commands[i % 3]])
+                    total_sec = time.perf_counter() - start
+                    if journal is not None:
+                        while journal.records_written < journal.records_queued:
+                            time.sleep(0.001)
+                        drain_sec = time.perf_counter() - start
+            finally:
+                atem_persist.close_state()
+            report(f"state change, {label}", total_sec, rounds, "change")
+            if journal is not None:
+                print(f"  {'  writer caught up after':<40} {drain_sec * 1000:10.1f} ms  ({total_sec * 1000:.1f} ms of changes)")
+                print(f"  {'  journal':<40} {journal.records_written:10} records, "
+                      f"{journal.bytes_written / journal.records_written:.1f} bytes/record, "
+                      f"{journal.compactions} compactions, {journal.fsyncs} fsyncs")
+
+
+@benchmark
+def bench_reload(iterations):
+    # Picking up an edited config file: reloading it into the running
+    # switcher and sending what changed, against loading it from scratch
+    # and sending every client the setup dump again (a restart)
+    import tempfile
+    config_file = "default_config.xml"
+    saved_cache_dir = atem_config.CONFIG_CACHE_DIR
+    with open(config_file) as f:
+        config_text = f.read()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        atem_config.CONFIG_CACHE_DIR = os.path.join(temp_dir, "cache")
+        # the edit: a program source and an input name
+        files = []
+        for name, text in (("a.xml", config_text),
+                           ("b.xml", config_text.replace('<Program input="4"/>', '<Program input="6"/>')
+                                                .replace('longName="PP MAIN"', 'longName="CAM ONE"'))):
+            files.append(os.path.join(temp_dir, name))
+            with open(files[-1], "w") as f:
+                f.write(text)
+        try:
+            atem_config.config_init(files[0])
+            with quiet():
+                # both files snapshotted first, like the second reload of an edit
+                for path in files:
+                    atem_commands.reload_config(path)
+                start = time.perf_counter()
+                for i in range(iterations):
+                    carriers = atem_commands.reload_config(files[(i + 1) % 2])
+                    for cc in carriers:
+                        cc.to_bytes()
+                total_sec = time.perf_counter() - start
+            report("reload, 2 fields changed", total_sec, iterations, "reload")
+            reload_bytes = sum(len(cc.to_bytes()) for cc in carriers)
+            with quiet():
+                start = time.perf_counter()
+                for _ in range(iterations):
+                    atem_commands.reload_config(files[1])
+                total_sec = time.perf_counter() - start
+            report("reload, file unchanged", total_sec, iterations, "reload")
+            start = time.perf_counter()
+            for i in range(iterations):
+                atem_config.config_init(files[i % 2])
+                setup_commands = atem_commands.build_setup_commands_list()
+            report("load from scratch + setup dump", time.perf_counter() - start, iterations, "reload")
+            dump_bytes = sum(len(cmd.bytes) for cmd in setup_commands)
+            print(f"  {'  sent per client':<40} {reload_bytes:10} bytes reloading, {dump_bytes} bytes of setup dump")
+        finally:
+            atem_config.CONFIG_CACHE_DIR = saved_cache_dir
+            atem_config.config_init(config_file)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("names", nargs="*", help=f"benchmarks to run (default=all): {', '.join(benchmarks)}")
+    ap.add_argument("--iterations", "-n", type=int, default=200, help="iterations per benchmark, default=200")
+    ap.add_argument("--config", required=False, default="default_config.xml", help="config XML file from ATEM software (default=default_config.xml)")
+    args = ap.parse_args()
+
+    atem_config.config_init(args.config)
+    for name in (args.names or benchmarks):
+        print(f"{name}:")
+        benchmarks[name](args.iterations)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,27 +2,76 @@
 
 from os import truncate
 import struct
+from operator import attrgetter
 import raw_commands
 from typing import List
 import atem_config
 from atem_config import DEVICE_VIDEO_SOURCES
 import datetime
 import time
+import atem_latency
+
+
+# Every command starts with the command length (including this header)
+# and the 4 character command code.
+CMD_HEADER = struct.Struct('!H 2x 4s')
+CMD_HEADER_SIZE = CMD_HEADER.size
 
 
 class ATEMCommand(object):
+    # Commands with a fixed layout declare it once. content_format is the
+    # struct format of the content (everything after the header) and
+    # content_fields are the attributes that get packed into / unpacked from
+    # it, in order. When the class is created the format is compiled, along
+    # with the header, into command_struct so a command is encoded or decoded
+    # with a single pack/unpack.
+    content_format = None
+    content_fields = ()
+    command_struct = None
+    command_length = None
+    # Commands to the client that report a piece of the switcher state name
+    # the fields that say which piece (eg. the ME). A later command with the
+    # same code and key supersedes it, so an update that hasn't been sent
+    # yet can be dropped (see ATEMClient.coalesce_outbound_commands). None
+    # for anything else, those are never dropped.
+    state_key_fields = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.__dict__.get('content_format') is not None:
+            cls.command_struct = struct.Struct(CMD_HEADER.format + cls.content_format.lstrip('!'))
+            cls.command_length = cls.command_struct.size
+            cls.content_getter = attrgetter(*cls.content_fields)
+
     def __init__(self, bytes=b''):
         self.bytes = bytes
         self.length = None
         self.code = type(self).__name__[-4:]
         self.full = ""
         self.time_to_send = 0
-    
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Decode a command (header included). The subclass __init__ isn't run
+        since for commands to the client it builds the command from the
+        switcher state instead.
+        """
+        cmd = cls.__new__(cls)
+        ATEMCommand.__init__(cmd, data)
+        cmd.code = CMD_HEADER.unpack_from(data, 0)[1].decode('latin-1')
+        cmd.parse_cmd()
+        return cmd
+
     def parse_cmd(self):
         """
         Parse the command into useful variables
         """
-        pass
+        self.length = len(self.bytes)
+        if self.command_struct is not None:
+            values = self.command_struct.unpack_from(self.bytes, 0)
+            for name, value in zip(self.content_fields, values[2:]):
+                setattr(self, name, value)
 
     def update_state(self):
         """
@@ -30,58 +79,97 @@ class ATEMCommand(object):
         """
         pass
 
+    def content_values(self):
+        """
+        Values to pack into the content, in content_fields order
+        """
+        values = self.content_getter(self)
+        return values if len(self.content_fields) > 1 else (values,)
+
+    def get_length(self):
+        """
+        Length of the encoded command, header included
+        """
+        if self.command_struct is not None:
+            return self.command_length
+        return len(self.bytes)
+
+    def pack_into(self, buf, offset):
+        """
+        Encode the command directly into buf at offset.
+        Returns the number of bytes written.
+        """
+        if self.command_struct is None:
+            cmd_length = len(self.bytes)
+            buf[offset:offset + cmd_length] = self.bytes
+            return cmd_length
+        self.command_struct.pack_into(buf, offset, self.command_length, self.code.encode(), *self.content_values())
+        return self.command_length
+
     def to_bytes(self):
         """
         Build the command into a byte stream
         """
-        pass
+        self.length = self.get_length()
+        if self.command_struct is not None:
+            self.bytes = self.command_struct.pack(self.command_length, self.code.encode(), *self.content_values())
+        else:
+            self.bytes = bytearray(self.length)
+            self.pack_into(self.bytes, 0)
 
-    def _build(self, content):
+    def get_state_key(self):
         """
-        Boilerplate bytes stream build stuff for commands
+        (code, key field values) of the state the command reports, or None
         """
-        if self.length != None:
-            cmd_length = self.length
-        else:
-            cmd_length = len(content) + 8
-            self.length = cmd_length
-        cmd = struct.pack('!H 2x 4s', cmd_length, self.code.encode())
-        return cmd + content
+        if self.state_key_fields is None:
+            return None
+        return (self.code,) + tuple(getattr(self, name) for name in self.state_key_fields)
+
+    def materialize(self):
+        """
+        Inbound commands reference the receive buffer, copy the bytes out
+        if the command has to be kept after the buffer gets reused
+        """
+        self.bytes = bytes(self.bytes)
 
 
 
 class Cmd__ver(ATEMCommand):
+    content_format = '!HH'
+    content_fields = ('major', 'minor')
+
     def __init__(self, bytes=b''):
         super().__init__(bytes=bytes)
         self.full = "ProtocolVersion"
         self.major = 2
         self.minor = 30
-    
-    def to_bytes(self):
-        content = struct.pack('!HH', self.major, self.minor)
-        self.bytes = self._build(content)
 
 
 class Cmd__pin(ATEMCommand):
+    content_format = '!44s'
+    content_fields = ('product_name',)
+
     def __init__(self, bytes=b''):
         super().__init__(bytes=bytes)
         self.full = "ProductId"
-        self.product_name = "ATEM Television Studio HD"
-    
-    def to_bytes(self):
-        content = struct.pack('!44s', self.product_name.encode())
-        self.bytes = self._build(content)
+        self.product_name = atem_config.state.product
+
+    def parse_cmd(self):
+        super().parse_cmd()
+        self.product_name = self.product_name.rstrip(b'\0').decode('latin-1')
+
+    def content_values(self):
+        return [self.product_name.encode()]
 
 
 class Cmd_InCm(ATEMCommand):
+    content_format = '!4s'
+    content_fields = ('raw_hex',)
+
     def __init__(self, bytes=b''):
         super().__init__(bytes=bytes)
-        self.length = 12
         self.raw_hex = b'\x01\x00\x00\x00'
 
-    def to_bytes(self):
-        self.bytes = self._build(self.raw_hex)
-
 
 ######################################################
 # COMMANDS FROM CLIENT
@@ -89,87 +177,86 @@ class Cmd_InCm(ATEMCommand):
 
 # Auto Transition from client
 class Cmd_DAut(ATEMCommand):
+    content_format = '!B 3x'
+    content_fields = ('me',)
+
     def __init__(self, bytes=b''):
         super().__init__(bytes=bytes)
         self.me = None
-        self.prog = None
-        self.prev = None
-        self.transition_pos = None
-        self.transition_total_frames = None
-
-    def parse_cmd(self):
-        self.length = len(self.bytes)
-        self.me = struct.unpack('!B', self.bytes[8:9])
-        self.me = self.me[0]
 
-    def update_state(self):
-        self.prog = atem_config.conf_db['MixEffectBlocks'][self.me]['Program']['input']
-        self.prev = atem_config.conf_db['MixEffectBlocks'][self.me]['Preview']['input']
-        self.transition_pos = int(atem_config.conf_db['MixEffectBlocks'][self.me]['TransitionStyle']['transitionPosition'])
-        transition_style = atem_config.conf_db['MixEffectBlocks'][self.me]['TransitionStyle']['style']
-        if transition_style == "Dip":
-            self.transition_total_frames = int(atem_config.conf_db['MixEffectBlocks'][self.me]['TransitionStyle']['DipParameters']['rate'])
-        elif transition_style == "Wipe":
-            self.transition_total_frames = int(atem_config.conf_db['MixEffectBlocks'][self.me]['TransitionStyle']['WipeParameters']['rate'])
-        else: # default to mix parameters
-            self.transition_total_frames = int(atem_config.conf_db['MixEffectBlocks'][self.me]['TransitionStyle']['MixParameters']['rate'])
-    
-    def update_prog_prev(self):
-        atem_config.conf_db['MixEffectBlocks'][self.me]['Program']['input'] = self.prev
-        atem_config.conf_db['MixEffectBlocks'][self.me]['Preview']['input'] = self.prog
+    # The transition itself is run by the transition engine (see respond_auto_transition)
 
 
 # Cut from client
 class Cmd_DCut(ATEMCommand):
+    content_format = '!B 3x'
+    content_fields = ('me',)
+
     def __init__(self, bytes=b''):
         super().__init__(bytes=bytes)
         self.me = None
-
-    def parse_cmd(self):
-        self.length = len(self.bytes)
-        self.me = struct.unpack('!B', self.bytes[8:9])
-        self.me = self.me[0]
+        self.cancelled_transition = False
 
     def update_state(self):
-        prog_source = atem_config.conf_db['MixEffectBlocks'][self.me]['Program']['input']
-        prev_source = atem_config.conf_db['MixEffectBlocks'][self.me]['Preview']['input']
-        atem_config.conf_db['MixEffectBlocks'][self.me]['Program']['input'] = prev_source
-        atem_config.conf_db['MixEffectBlocks'][self.me]['Preview']['input'] = prog_source
-        #print(f"me{self.me}={atem_config.conf_db['MixEffectBlocks'][self.me]}")
+        me = atem_config.state.mes[self.me]
+        # a cut in the middle of an auto transition finishes it straight away
+        self.cancelled_transition = transition_engine.cancel(('me', self.me))
+        if self.cancelled_transition:
+            me.transition_position = 0
+        me.program_input, me.preview_input = me.preview_input, me.program_input
+        atem_config.state_changed(me)
 
 
 # Program Input from client (See also PrgI)
 class Cmd_CPgI(ATEMCommand):
+    content_format = '!B x H'
+    content_fields = ('me', 'video_source')
+
     def __init__(self, bytes=b''):
         super().__init__(bytes=bytes)
-        self.length = 12
         self.me = None
         self.video_source = None
 
-    def parse_cmd(self):
-        self.length = len(self.bytes)
-        self.me, self.video_source = struct.unpack('!B x H', self.bytes[8:12])
-
     def update_state(self):
-        atem_config.conf_db['MixEffectBlocks'][self.me]['Program']['input'] = str(self.video_source)
-        #print(f"me{self.me}={atem_config.conf_db['MixEffectBlocks'][self.me]}")
+        me = atem_config.state.mes[self.me]
+        me.program_input = self.video_source
+        atem_config.state_changed(me)
 
 
 # Preview Input from client, almost identical to Cmd_CPgI (See also PrvI)
 class Cmd_CPvI(ATEMCommand):
+    content_format = '!B x H'
+    content_fields = ('me', 'video_source')
+
     def __init__(self, bytes=b''):
         super().__init__(bytes=bytes)
-        self.length = 12
         self.me = None
         self.video_source = None
 
-    def parse_cmd(self):
-        self.length = len(self.bytes)
-        self.me, self.video_source = struct.unpack('!B x H', self.bytes[8:12])
-
     def update_state(self):
-        atem_config.conf_db['MixEffectBlocks'][self.me]['Preview']['input'] = str(self.video_source)
-        #print(f"me{self.me}={atem_config.conf_db['MixEffectBlocks'][self.me]}")
+        me = atem_config.state.mes[self.me]
+        me.preview_input = self.video_source
+        atem_config.state_changed(me)
+
+
+# Downstream Keyer Auto (transition the DSK on or off air) from client
+class Cmd_DDsA(ATEMCommand):
+    content_format = '!B 3x'
+    content_fields = ('dsk',)
+
+    def __init__(self, bytes=b''):
+        super().__init__(bytes=bytes)
+        self.dsk = None
+
+
+# Fade To Black Auto from client
+class Cmd_FtbA(ATEMCommand):
+    content_format = '!B 3x'
+    content_fields = ('me',)
+
+    def __init__(self, bytes=b''):
+        super().__init__(bytes=bytes)
+        self.me = None
 
 
 
@@ -180,137 +267,411 @@ class Cmd_CPvI(ATEMCommand):
 
 # Time sent to client
 class Cmd_Time(ATEMCommand):
+    content_format = '!4B 4x'
+    content_fields = ('hour', 'minute', 'second', 'frame')
+    state_key_fields = ()
+
     def __init__(self, offset_sec=0):
         super().__init__(b'')
-        self.length = 16
         self.offset_sec = offset_sec
-
-    def to_bytes(self):
-        video_mode = atem_config.conf_db['VideoMode']['videoMode']
-        if "5994" in video_mode:
-            frame_rate = 59.94
-        elif "2997" in video_mode:
-            frame_rate = 29.97
-        elif "2398" in video_mode:
-            frame_rate = 23.98
-        elif "50" in video_mode:
-            frame_rate = 50
-        elif "25" in video_mode:
-            frame_rate = 25
-        elif "24" in video_mode:
-            frame_rate = 24
+        # the same frame clock the transitions run on
+        frame_rate = atem_config.state.get_frame_rate()
         t = datetime.datetime.now() + datetime.timedelta(seconds=int(self.offset_sec), microseconds=int((self.offset_sec % 1) * 1000000))
-        frame = int(t.microsecond / 1000000 * frame_rate)
-        content = struct.pack('!4B 4x', t.hour, t.minute, t.second, frame)
-        self.bytes = self._build(content)
+        self.hour = t.hour
+        self.minute = t.minute
+        self.second = t.second
+        self.frame = int(t.microsecond / 1000000 * frame_rate)
+
+
+# Tally commands: a count, then one entry per input/source, then 2 unknown bytes
+TALLY_COUNT = struct.Struct('!H')
+TALLY_SOURCE = struct.Struct('!HB')
+
+def get_tally_flags(source, program_source, preview_source, transition_pos):
+    """
+    Tally bits for one source: 0x01 program, 0x02 preview
+    """
+    flags = 0x00
+    if program_source == source:
+        flags |= 0x01
+    if preview_source == source:
+        flags |= 0x02
+        # If in mid transition then the preview source is also the program source.
+        # Transition range is 0-10000
+        if transition_pos > 0 and transition_pos < 10000:
+            flags |= 0x01
+    return flags
+
+
+class TallyTable(object):
+    """
+    Tally of one ME, kept as the encoded content of the Tally By Index (TlIn)
+    and Tally By Source (TlSr) commands. When the program, preview or
+    transition state changes only the flag bytes of the sources involved
+    get rewritten.
+    """
+    def __init__(self, me_state, num_inputs, video_sources):
+        self.me_state = me_state
+        # TlIn: count, one flags byte per input (input numbers start at 1), 2 unknown bytes
+        self.by_index = bytearray(TALLY_COUNT.size + num_inputs + 2)
+        TALLY_COUNT.pack_into(self.by_index, 0, num_inputs)
+        self.index_offsets = {i + 1: TALLY_COUNT.size + i for i in range(num_inputs)}
+        # TlSr: count, (source, flags) per source, 2 unknown bytes
+        self.by_source = bytearray(TALLY_COUNT.size + len(video_sources) * TALLY_SOURCE.size + 2)
+        TALLY_COUNT.pack_into(self.by_source, 0, len(video_sources))
+        self.source_offsets = {}
+        for i, source in enumerate(video_sources):
+            entry_offset = TALLY_COUNT.size + i * TALLY_SOURCE.size
+            TALLY_SOURCE.pack_into(self.by_source, entry_offset, source, 0)
+            self.source_offsets[source] = entry_offset + 2
+        # what the flags currently reflect
+        self.program_source = None
+        self.preview_source = None
+        self.mid_transition = False
+        self.update()
+
+    def update(self):
+        """
+        Bring the flags up to date with the ME state
+        """
+        me = self.me_state
+        mid_transition = me.transition_position > 0 and me.transition_position < 10000
+        if (me.program_input == self.program_source and me.preview_input == self.preview_source
+                and mid_transition == self.mid_transition):
+            return
+        # only the old and new program and preview sources can have changed
+        changed_sources = {self.program_source, self.preview_source, me.program_input, me.preview_input}
+        changed_sources.discard(None)
+        self.program_source = me.program_input
+        self.preview_source = me.preview_input
+        self.mid_transition = mid_transition
+        for source in changed_sources:
+            flags = get_tally_flags(source, me.program_input, me.preview_input, me.transition_position)
+            offset = self.index_offsets.get(source)
+            if offset is not None:
+                self.by_index[offset] = flags
+            offset = self.source_offsets.get(source)
+            if offset is not None:
+                self.by_source[offset] = flags
+
+
+# Tally tables by ME
+tally_tables = {}
+
+def get_tally_table(me):
+    """
+    Up to date tally table for the given ME
+    """
+    switcher = atem_config.state
+    me_state = switcher.mes[me]
+    table = tally_tables.get(me)
+    if table is None or table.me_state is not me_state:
+        # first use, or the switcher state got reloaded
+        table = TallyTable(me_state, len(switcher.inputs), DEVICE_VIDEO_SOURCES[switcher.product])
+        tally_tables[me] = table
+    else:
+        table.update()
+    return table
+
+
+class TallyCommand(ATEMCommand):
+    """
+    Tally commands send a copy of the content held in the tally table
+    """
+    state_key_fields = ('me',)
+
+    def parse_cmd(self):
+        self.length = len(self.bytes)
+        self.content = bytes(self.bytes[CMD_HEADER_SIZE:])
+
+    def get_length(self):
+        return CMD_HEADER_SIZE + len(self.content)
+
+    def pack_into(self, buf, offset):
+        cmd_length = self.get_length()
+        CMD_HEADER.pack_into(buf, offset, cmd_length, self.code.encode())
+        buf[offset + CMD_HEADER_SIZE:offset + cmd_length] = self.content
+        return cmd_length
 
 
 # Tally By Index sent to client
-class Cmd_TlIn(ATEMCommand):
+class Cmd_TlIn(TallyCommand):
     def __init__(self, me=0):
         super().__init__(b'')
         self.me = me
-        self.program_source = int(atem_config.conf_db['MixEffectBlocks'][self.me]['Program']['input'])
-        self.preview_source = int(atem_config.conf_db['MixEffectBlocks'][self.me]['Preview']['input'])
-        self.transition_pos = int(atem_config.conf_db['MixEffectBlocks'][self.me]['TransitionStyle']['transitionPosition'])
-        self.num_inputs = len(atem_config.conf_db['Settings']['Inputs'])
-
-    def to_bytes(self):
-        # Build content
-        content = struct.pack('!H', self.num_inputs)
-        for i in range(self.num_inputs):
-            input_byte = 0x00
-            if self.program_source <= self.num_inputs and self.program_source == i + 1:
-                input_byte |= 0x01
-            if self.preview_source <= self.num_inputs and self.preview_source == i + 1:
-                input_byte |= 0x02
-                # If in mid transition then the preview source is also the program source.
-                # Transition range is 0-10000
-                if self.transition_pos > 0 and self.transition_pos < 10000:
-                    input_byte |= 0x1
-            content += struct.pack('!B', input_byte)
-        # add the 2 unknown bytes
-        content += struct.pack('!2x')
-        self.bytes = self._build(content)
+        self.content = bytes(get_tally_table(me).by_index)
 
 
 # Tally By Source sent to client
-class Cmd_TlSr(ATEMCommand):
+class Cmd_TlSr(TallyCommand):
     def __init__(self, me=0):
-        super().__init__(bytes=bytes)
-        self.length = 84
+        super().__init__(b'')
         self.me = me
-        self.program_source = int(atem_config.conf_db['MixEffectBlocks'][self.me]['Program']['input'])
-        self.preview_source = int(atem_config.conf_db['MixEffectBlocks'][self.me]['Preview']['input'])
-        self.transition_pos = int(atem_config.conf_db['MixEffectBlocks'][self.me]['TransitionStyle']['transitionPosition'])
-        # the product determines how many sources there are
-        product = atem_config.conf_db['product']
-        self.video_sources = DEVICE_VIDEO_SOURCES[product]
-        self.num_sources = len(self.video_sources)
-
-    def to_bytes(self):
-        # Build content
-        content = struct.pack('!H', self.num_sources)
-        for i in range(self.num_sources):
-            source_byte = 0x00
-            if self.program_source == self.video_sources[i]:
-                source_byte |= 0x01
-            if self.preview_source == self.video_sources[i]:
-                source_byte |= 0x02
-                # If in mid transition then the preview source is also the program source.
-                # Transition range is 0-10000
-                if self.transition_pos > 0 and self.transition_pos < 10000:
-                    source_byte |= 0x1
-            content += struct.pack('!HB', self.video_sources[i], source_byte)
-        # add the 2 unknown bytes
-        content += struct.pack('!2x')
-        self.bytes = self._build(content)
+        self.content = bytes(get_tally_table(me).by_source)
 
 
 # Program Input to client (see also CPgI)
 class Cmd_PrgI(ATEMCommand):
+    content_format = '!B x H'
+    content_fields = ('me', 'program_source')
+    state_key_fields = ('me',)
+
     def __init__(self, me=0):
-        super().__init__(bytes=bytes)
+        super().__init__(b'')
         self.me = me
-        self.program_source = int(atem_config.conf_db['MixEffectBlocks'][self.me]['Program']['input'])
-
-    def to_bytes(self):
-        content = struct.pack('!B x H', self.me, self.program_source)
-        self.bytes = self._build(content)
+        self.program_source = atem_config.state.mes[self.me].program_input
 
 
 # Preview Input to client, almost identical to Cmd_PrgI (see also CPvI)
 class Cmd_PrvI(ATEMCommand):
+    content_format = '!B x H 4x'
+    content_fields = ('me', 'preview_source')
+    state_key_fields = ('me',)
+
     def __init__(self, me=0):
-        super().__init__(bytes=bytes)
+        super().__init__(b'')
         self.me = me
-        self.preview_source = int(atem_config.conf_db['MixEffectBlocks'][self.me]['Preview']['input'])
-
-    def to_bytes(self):
-        content = struct.pack('!B x H 4x', self.me, self.preview_source)
-        self.bytes = self._build(content)
+        self.preview_source = atem_config.state.mes[self.me].preview_input
 
 
 # Transition Position to client
 class Cmd_TrPs(ATEMCommand):
+    content_format = '!BBB x H 2x'
+    content_fields = ('me', 'in_transition', 'frames_remaining', 'transition_pos')
+    state_key_fields = ('me',)
+
     def __init__(self, me=0, frames_remaining=None, total_frames=None):
-        super().__init__(bytes=bytes)
+        super().__init__(b'')
         self.me = me
-        self.total_frames = total_frames
-        self.frames_remaining = frames_remaining
-        if frames_remaining > 255: # maximum size of the byte that it's going into
-            self.frames_remaining = 255
-        self.transition_pos = int((self.frames_remaining/self.total_frames) * 10000)
-        self.transition_pos = 10000 - self.transition_pos
-        atem_config.conf_db['MixEffectBlocks'][self.me]['TransitionStyle']['transitionPosition'] = str(self.transition_pos)
+        me_state = atem_config.state.mes[self.me]
+        if frames_remaining is None:
+            # Report the current transition position without changing it (eg. for the state dump)
+            self.total_frames = me_state.get_transition_rate()
+            self.transition_pos = me_state.transition_position
+            self.frames_remaining = min(255, round(self.total_frames * (10000 - self.transition_pos) / 10000))
+        else:
+            self.total_frames = total_frames
+            self.frames_remaining = frames_remaining
+            if frames_remaining > 255: # maximum size of the byte that it's going into
+                self.frames_remaining = 255
+            self.transition_pos = int((self.frames_remaining/self.total_frames) * 10000)
+            self.transition_pos = 10000 - self.transition_pos
+            me_state.transition_position = self.transition_pos
+            atem_config.state_changed(me_state)
         if self.frames_remaining == self.total_frames:
             self.in_transition = 0
         else:
             self.in_transition = 1
 
-    def to_bytes(self):
-        content = struct.pack('!BBB x H 2x', self.me, self.in_transition, self.frames_remaining, self.transition_pos)
-        self.bytes = self._build(content)
+
+# Input Properties to client
+# Only the names come from the config. The rest of the fields (port types,
+# availability, etc.) are device specific so they are copied from a template
+# captured from the real switcher.
+INPR_INPUT_ID = struct.Struct('!H')
+INPR_LONG_NAME = struct.Struct('!20s')
+INPR_SHORT_NAME = struct.Struct('!4s')
+
+class Cmd_InPr(ATEMCommand):
+    def __init__(self, template=b''):
+        super().__init__(bytes=template)
+        self.template = template
+        self.input_id = INPR_INPUT_ID.unpack_from(template, CMD_HEADER_SIZE)[0]
+        self.long_name = None
+        self.short_name = None
+        input_state = atem_config.state.inputs.get(self.input_id)
+        if input_state is not None:
+            self.long_name = input_state.long_name
+            self.short_name = input_state.short_name
+
+    @classmethod
+    def for_input(cls, input_id):
+        # the command for one input, None if the capture doesn't have it
+        for code, cmd_bytes in get_raw_setup_commands():
+            if code == 'InPr' and INPR_INPUT_ID.unpack_from(cmd_bytes, CMD_HEADER_SIZE)[0] == input_id:
+                return cls(cmd_bytes)
+        return None
+
+    def parse_cmd(self):
+        self.length = len(self.bytes)
+        self.template = bytes(self.bytes)
+        self.input_id = INPR_INPUT_ID.unpack_from(self.bytes, CMD_HEADER_SIZE)[0]
+        self.long_name = INPR_LONG_NAME.unpack_from(self.bytes, CMD_HEADER_SIZE + 2)[0].split(b'\0')[0].decode('latin-1')
+        self.short_name = INPR_SHORT_NAME.unpack_from(self.bytes, CMD_HEADER_SIZE + 22)[0].split(b'\0')[0].decode('latin-1')
+
+    def get_length(self):
+        return len(self.template)
+
+    def pack_into(self, buf, offset):
+        cmd_length = len(self.template)
+        buf[offset:offset + cmd_length] = self.template
+        CMD_HEADER.pack_into(buf, offset, cmd_length, self.code.encode())
+        if self.long_name is not None:
+            INPR_LONG_NAME.pack_into(buf, offset + CMD_HEADER_SIZE + 2, self.long_name.encode()[:19])
+        if self.short_name is not None:
+            INPR_SHORT_NAME.pack_into(buf, offset + CMD_HEADER_SIZE + 22, self.short_name.encode()[:4])
+        return cmd_length
+
+
+# Mix Transition Parameters to client
+class Cmd_TMxP(ATEMCommand):
+    content_format = '!BB 2x'
+    content_fields = ('me', 'rate')
+    state_key_fields = ('me',)
+
+    def __init__(self, me=0):
+        super().__init__(b'')
+        self.me = me
+        self.rate = atem_config.state.mes[self.me].mix_rate
+
+
+# Dip Transition Parameters to client
+class Cmd_TDpP(ATEMCommand):
+    content_format = '!BB H'
+    content_fields = ('me', 'rate', 'input')
+    state_key_fields = ('me',)
+
+    def __init__(self, me=0):
+        super().__init__(b'')
+        self.me = me
+        me = atem_config.state.mes[self.me]
+        self.rate = me.dip_rate
+        self.input = me.dip_input
+
+
+# Upstream Keyer On Air to client
+class Cmd_KeOn(ATEMCommand):
+    content_format = '!BB? x'
+    content_fields = ('me', 'keyer', 'on_air')
+    state_key_fields = ('me', 'keyer')
+
+    def __init__(self, me=0, keyer=0):
+        super().__init__(b'')
+        self.me = me
+        self.keyer = keyer
+        self.on_air = atem_config.state.mes[self.me].keys[self.keyer].on_air
+
+
+# Downstream Keyer Sources to client
+class Cmd_DskB(ATEMCommand):
+    content_format = '!B x 2H 2x'
+    content_fields = ('dsk', 'fill_source', 'key_source')
+    state_key_fields = ('dsk',)
+
+    def __init__(self, dsk=0):
+        super().__init__(b'')
+        self.dsk = dsk
+        dsk_state = atem_config.state.dsks[self.dsk]
+        self.fill_source = dsk_state.fill_source
+        self.key_source = dsk_state.key_source
+
+
+# Downstream Keyer Properties to client
+# clip and gain are in tenths of a percent, the mask edges in thousandths
+class Cmd_DskP(ATEMCommand):
+    content_format = '!B?B? 2H ?? 4h 2x'
+    content_fields = ('dsk', 'tie', 'rate', 'pre_multiplied', 'clip', 'gain', 'invert',
+                      'mask_enabled', 'mask_top', 'mask_bottom', 'mask_left', 'mask_right')
+    state_key_fields = ('dsk',)
+
+    def __init__(self, dsk=0):
+        super().__init__(b'')
+        self.dsk = dsk
+        dsk_state = atem_config.state.dsks[self.dsk]
+        self.tie = dsk_state.tie
+        self.rate = dsk_state.rate
+        self.pre_multiplied = dsk_state.pre_multiplied
+        self.clip = int(dsk_state.clip * 10)
+        self.gain = int(dsk_state.gain * 10)
+        self.invert = dsk_state.invert
+        self.mask_enabled = dsk_state.mask_enabled
+        self.mask_top = int(dsk_state.mask_top * 1000)
+        self.mask_bottom = int(dsk_state.mask_bottom * 1000)
+        self.mask_left = int(dsk_state.mask_left * 1000)
+        self.mask_right = int(dsk_state.mask_right * 1000)
+
+
+# Downstream Keyer State to client
+class Cmd_DskS(ATEMCommand):
+    content_format = '!B???B 3x'
+    content_fields = ('dsk', 'on_air', 'in_transition', 'is_auto_transitioning', 'frames_remaining')
+    state_key_fields = ('dsk',)
+
+    def __init__(self, dsk=0):
+        super().__init__(b'')
+        self.dsk = dsk
+        dsk_state = atem_config.state.dsks[self.dsk]
+        self.on_air = dsk_state.on_air
+        transition = transition_engine.transitions.get(('dsk', self.dsk))
+        if transition is None:
+            self.in_transition = False
+            self.is_auto_transitioning = False
+            self.frames_remaining = dsk_state.rate
+        else:
+            self.in_transition = True
+            self.is_auto_transitioning = True
+            self.frames_remaining = min(255, transition.frames_remaining(time.monotonic()))
+
+
+# Fade To Black Parameters (rate) to client
+class Cmd_FtbP(ATEMCommand):
+    content_format = '!BB 2x'
+    content_fields = ('me', 'rate')
+    state_key_fields = ('me',)
+
+    def __init__(self, me=0):
+        super().__init__(b'')
+        self.me = me
+        self.rate = atem_config.state.mes[self.me].ftb_rate
+
+
+# Fade To Black State to client
+class Cmd_FtbS(ATEMCommand):
+    content_format = '!B??B'
+    content_fields = ('me', 'fully_black', 'in_transition', 'frames_remaining')
+    state_key_fields = ('me',)
+
+    def __init__(self, me=0):
+        super().__init__(b'')
+        self.me = me
+        me = atem_config.state.mes[self.me]
+        self.fully_black = me.ftb_fully_black
+        transition = transition_engine.transitions.get(('ftb', self.me))
+        if transition is None:
+            self.in_transition = False
+            self.frames_remaining = me.ftb_rate
+        else:
+            self.in_transition = True
+            self.frames_remaining = min(255, transition.frames_remaining(time.monotonic()))
+
+
+# Color Generator to client
+# hue is in tenths of a degree, saturation and luma in tenths of a percent
+class Cmd_ColV(ATEMCommand):
+    content_format = '!B x 3H'
+    content_fields = ('color_gen', 'hue', 'saturation', 'luma')
+    state_key_fields = ('color_gen',)
+
+    def __init__(self, color_gen=0):
+        super().__init__(b'')
+        self.color_gen = color_gen
+        color_state = atem_config.state.color_generators[self.color_gen]
+        self.hue = int(color_state.hue * 10)
+        self.saturation = int(color_state.saturation * 10)
+        self.luma = int(color_state.luma * 10)
+
+
+# Aux Source to client
+class Cmd_AuxS(ATEMCommand):
+    content_format = '!B x H'
+    content_fields = ('aux', 'source')
+    state_key_fields = ('aux',)
+
+    def __init__(self, aux_id=8001):
+        super().__init__(b'')
+        # aux ids in the config start at 8001 but the command uses a 0 based index
+        self.aux = aux_id - 8001
+        self.source = atem_config.state.auxes[aux_id].input
 
 
 
@@ -335,6 +696,9 @@ class Cmd_Raw(ATEMCommand):
     def __init__(self, bytes):
         super().__init__(bytes=bytes)
 
+    def parse_cmd(self):
+        self.length = len(self.bytes)
+
     def to_bytes(self):
         self.length = len(self.bytes)
 
@@ -357,74 +721,469 @@ class CommandCarrier(object):
         # Packet id to ack when this response command(s) is sent back.
         # This is more for the client to manage in the outbound_packet_list.
         self.ack_packet_id = 0
+        # The encoded commands. Built once by to_bytes() and shared by
+        # every client the carrier gets sent to (the clients only add
+        # their own packet header).
+        self.cmd_bytes = None
+        # Only used when the latency stats are on (see atem_latency):
+        # (code of the command this is a response to, when that packet was
+        # received, when this was ready to send). Shared by the copies
+        # that go to the other clients.
+        self.trace = None
+        # (state key, start, end) of each command in cmd_bytes, built along
+        # with them and shared by the copies, for coalescing
+        self.command_spans = None
+
+    def to_bytes(self):
+        if self.cmd_bytes is None:
+            # size the buffer up front and have every command pack itself into it
+            cmd_bytes = bytearray(sum(cmd.get_length() for cmd in self.commands))
+            command_spans = []
+            offset = 0
+            for cmd in self.commands:
+                start = offset
+                offset += cmd.pack_into(cmd_bytes, offset)
+                command_spans.append((cmd.get_state_key(), start, offset))
+            self.cmd_bytes = bytes(cmd_bytes)
+            self.command_spans = command_spans
+        return self.cmd_bytes
+
+
+# Commands the real switcher sends on connection, split into a list of
+# (code, bytes) tuples. Decoded once from the capture in raw_commands.
+raw_setup_commands_cache = None
+
+def get_raw_setup_commands():
+    global raw_setup_commands_cache
+    if raw_setup_commands_cache is None:
+        raw_setup_commands = [
+            raw_commands.commands1,
+            raw_commands.commands2,
+            raw_commands.commands3,
+            raw_commands.commands4,
+            raw_commands.commands5,
+            raw_commands.commands6,
+            #raw_commands.commands7,
+            #raw_commands.commands8,
+            ]
+        raw_cmds = []
+        for rsc in raw_setup_commands:
+            cmd_bytes = raw_commands.getByteStream(rsc)
+            offset = 0
+            while offset < len(cmd_bytes):
+                cmd_length, cmd_raw_name = CMD_HEADER.unpack_from(cmd_bytes, offset)
+                raw_cmds.append((cmd_raw_name.decode('utf-8'), cmd_bytes[offset:offset + cmd_length]))
+                offset += cmd_length
+        raw_setup_commands_cache = raw_cmds
+    return raw_setup_commands_cache
+
+
+# Maximum number of command bytes in each packet of the setup dump.
+# The real switcher keeps the setup packets to about this size. The server
+# uses less when the MTU is smaller (see client_manager.get_setup_packet_cmd_bytes).
+SETUP_PACKET_MAX_CMD_BYTES = 1400
+
+# The encoded setup dump is shared by every client that connects. It only
+# gets rebuilt when the switcher state (or the packet size) has changed
+# since it was last built.
+setup_commands_cache = None
+# (state_version, max_cmd_bytes) the cache was built for
+setup_commands_cache_version = None
+
+def build_setup_commands_list(max_cmd_bytes=SETUP_PACKET_MAX_CMD_BYTES):
+    """
+    Get the setup dump sent to a client when it connects.
+    Returns a list of Cmd_Raw objects, each one holding the commands
+    for one packet, at most max_cmd_bytes of them (a single command bigger
+    than that gets a packet to itself).
+    """
+    global setup_commands_cache, setup_commands_cache_version
+    version = (atem_config.state_version, max_cmd_bytes)
+    if setup_commands_cache is None or setup_commands_cache_version != version:
+        packets_list = []
+        packet_bytes = bytearray()
+        for cmd in build_current_state_command_list():
+            cmd.to_bytes()
+            if packet_bytes and len(packet_bytes) + len(cmd.bytes) > max_cmd_bytes:
+                packets_list.append(Cmd_Raw(bytes(packet_bytes)))
+                packet_bytes = bytearray()
+            packet_bytes += cmd.bytes
+        if packet_bytes:
+            packets_list.append(Cmd_Raw(bytes(packet_bytes)))
+        for cmd in packets_list:
+            cmd.to_bytes()
+        setup_commands_cache = tuple(packets_list)
+        setup_commands_cache_version = version
+    return setup_commands_cache
 
 
-def build_setup_commands_list():
-    raw_setup_commands = [
-        raw_commands.commands1,
-        raw_commands.commands2,
-        raw_commands.commands3,
-        raw_commands.commands4,
-        raw_commands.commands5,
-        raw_commands.commands6,
-        #raw_commands.commands7,
-        #raw_commands.commands8,
-        ]
-    commands_list = []
-    for rsc in raw_setup_commands:
-        cmd_bytes = raw_commands.getByteStream(rsc)
-        cmd = Cmd_Raw(cmd_bytes)
-        commands_list.append(cmd)
-    return commands_list
-
-
-
-
-# get commands list by piecing together the name of the class from the command you want
-# and use:
-# classname = "Cmd" + command_name.decode()
-# if hasattr(atem_commands, classname):
-#   TheClass = getattr(atem_commands, classname)
-#OR instance = getattr(atem_commands, classname)(class_params)
-#
-# This would be the manual way...
-commands_list = {'_ver' : Cmd__ver,
-                '_pin' : Cmd__pin,
-                'DAut' : Cmd_DAut,
-                'DCut' : Cmd_DCut,
-                'CPgI' : Cmd_CPgI,
-                'CPvI' : Cmd_CPvI,
-                'InCm' : Cmd_InCm,
-                }
 
 def build_current_state_command_list():
+    """
+    Build the list of commands describing the current state of the
+    switcher (as held in atem_config.state). The captured setup dump from the real
+    switcher is used as the skeleton: commands that can be built from
+    the state replace the captured ones (in the same spot in the dump), the
+    rest are sent as captured.
+    """
+    state = atem_config.state
+    raw_cmds = get_raw_setup_commands()
+    mes = sorted(state.mes)
+    dsks = sorted(state.dsks)
+    keys = [(me, key) for me in mes for key in sorted(state.mes[me].keys)]
+    state_commands = {
+        '_ver' : [Cmd__ver()],
+        '_pin' : [Cmd__pin()],
+        'InPr' : [Cmd_InPr(cmd_bytes) for code, cmd_bytes in raw_cmds if code == 'InPr'],
+        'PrgI' : [Cmd_PrgI(me) for me in mes],
+        'PrvI' : [Cmd_PrvI(me) for me in mes],
+        'TrPs' : [Cmd_TrPs(me) for me in mes],
+        'TMxP' : [Cmd_TMxP(me) for me in mes],
+        'TDpP' : [Cmd_TDpP(me) for me in mes],
+        'KeOn' : [Cmd_KeOn(me, key) for me, key in keys],
+        'DskB' : [Cmd_DskB(dsk) for dsk in dsks],
+        'DskP' : [Cmd_DskP(dsk) for dsk in dsks],
+        'DskS' : [Cmd_DskS(dsk) for dsk in dsks],
+        'FtbP' : [Cmd_FtbP(me) for me in mes],
+        'FtbS' : [Cmd_FtbS(me) for me in mes],
+        'ColV' : [Cmd_ColV(color_gen) for color_gen in sorted(state.color_generators)],
+        'AuxS' : [Cmd_AuxS(aux_id) for aux_id in sorted(state.auxes)],
+        'TlIn' : [Cmd_TlIn(0)],
+        'TlSr' : [Cmd_TlSr(0)],
+        }
+
+    # Each generated command takes the place of the next captured command with
+    # the same code. If there are more generated commands than captured ones
+    # (eg. more MEs than the captured switcher) the extras follow the last one.
+    slots_left = {}
+    for code, cmd_bytes in raw_cmds:
+        slots_left[code] = slots_left.get(code, 0) + 1
     return_list = []
-
-    cmd = Cmd__ver()
-    return_list.append(cmd)
-
-    cmd = Cmd__pin()
-    return_list.append(cmd)
-
-    #...etc.
+    for code, cmd_bytes in raw_cmds:
+        slots_left[code] -= 1
+        if code not in state_commands:
+            return_list.append(Cmd_Raw(cmd_bytes))
+        elif slots_left[code] > 0:
+            if state_commands[code]:
+                return_list.append(state_commands[code].pop(0))
+        else:
+            return_list.extend(state_commands[code])
     return return_list
 
 def build_command_list_from_names(command_names: list):
     return_list = []
-    for cmd_name in commands_list:
-        new_cmd = get_command_object(cmd_name)
+    for cmd_name in command_names:
+        new_cmd = get_command_object(b'', cmd_name)
         if new_cmd != None:
             return_list.append(new_cmd)
     return return_list
 
 
+######################################################
+# COMMAND HANDLERS
+######################################################
+
+# Inbound commands the server understands, by command code. Anything not
+# in here is ignored (the packet still gets acked).
+command_handlers = {}
+
+class CommandHandler(object):
+    """
+    How the server handles one inbound command: the class that decodes it,
+    the state change it makes and the commands sent back to the clients.
+    """
+    def __init__(self, cmd_class, invalidates=(), respond=None, describe=None):
+        self.code = cmd_class.__name__[-4:]
+        self.cmd_class = cmd_class
+        # the change the command makes to the switcher state
+        self.update_state = cmd_class.update_state
+        # commands to the client whose content changes as a result of the
+        # command. They get built for the ME of the command and sent back.
+        self.invalidates = tuple(invalidates)
+        # builds the response (a list of CommandCarrier objects), by default
+        # one carrier with the time followed by the invalidated commands
+        self.respond = respond if respond is not None else respond_with_invalidated
+        # describe(cmd) gives the line printed when the command is handled
+        self.describe = describe
+
+    def handle(self, cmd):
+        self.update_state(cmd)
+        if self.describe is not None:
+            print(self.describe(cmd))
+        return self.respond(self, cmd)
+
+
+def register_handler(cmd_class, invalidates=(), respond=None, describe=None):
+    handler = CommandHandler(cmd_class, invalidates, respond, describe)
+    command_handlers[handler.code] = handler
+    return handler
+
+
+def respond_with_invalidated(handler, cmd):
+    cc = CommandCarrier()
+    cc.commands.append(Cmd_Time())
+    for cmd_class in handler.invalidates:
+        cc.commands.append(cmd_class(cmd.me))
+    return [cc]
+
+
+def respond_cut(handler, cmd):
+    response_list = respond_with_invalidated(handler, cmd)
+    if cmd.cancelled_transition:
+        # the transition position is back to 0
+        response_list[0].commands.append(Cmd_TrPs(cmd.me))
+    return response_list
+
+
+def respond_auto_transition(handler, cmd):
+    return transition_engine.start(MixEffectTransition(('me', cmd.me)), time.monotonic())
+
+
+def respond_dsk_auto(handler, cmd):
+    return transition_engine.start(DownstreamKeyTransition(('dsk', cmd.dsk)), time.monotonic())
+
+
+def respond_fade_to_black(handler, cmd):
+    return transition_engine.start(FadeToBlackTransition(('ftb', cmd.me)), time.monotonic())
+
+
+######################################################
+# TRANSITIONS
+######################################################
+
+# How often (in frames) the clients get an update while a transition runs.
+# 1 updates every frame. 6 is close to the every 200ms the simulator used
+# to send.
+TRANSITION_UPDATE_FRAMES = 6
+
+class Transition(object):
+    """
+    An auto transition that is running. Nothing is worked out ahead of
+    time: how far it has got comes from the frame clock (the video mode's
+    frame rate) whenever it's asked, and the commands for an update are
+    built when the update is sent. So it can be cancelled or replaced at
+    any point just by dropping it.
+    Subclasses say what the transition changes and what the clients get
+    sent, with:
+      get_rate(): length of the transition in frames, from the switcher state
+      start_commands(now, replacing): the commands sent when it starts
+      update_commands(now): the commands for each update
+      finish_commands(): makes the final state change, and the commands
+        sent when it finishes
+    """
+    def __init__(self, key):
+        # what is transitioning: ('me', index), ('dsk', index) or ('ftb', me index)
+        self.key = key
+        self.total_frames = 1
+        self.frame_rate = 30
+        self.start_frame = 0
+        self.start_time = 0
+        self.next_update_time = 0
+
+    def start(self, now, replacing=None):
+        self.total_frames = max(1, self.get_rate())
+        self.frame_rate = atem_config.state.get_frame_rate()
+        self.start_time = now
+        if replacing is not None:
+            # carry on from where the transition being replaced had got to
+            self.start_frame = min(self.total_frames - 1, replacing.frames_done(now) * self.total_frames // replacing.total_frames)
+        self.schedule_next_update(now)
+
+    def frames_done(self, now):
+        # (the small extra stops a float rounding down just short of an update's frame)
+        return min(self.total_frames, self.start_frame + int((now - self.start_time) * self.frame_rate + 1e-6))
+
+    def frames_remaining(self, now):
+        return self.total_frames - self.frames_done(now)
+
+    def schedule_next_update(self, now):
+        # TRANSITION_UPDATE_FRAMES on from now, or the end if that's sooner
+        next_frame = min(self.total_frames, self.frames_done(now) + TRANSITION_UPDATE_FRAMES)
+        self.next_update_time = self.start_time + (next_frame - self.start_frame) / self.frame_rate
+
+
+class MixEffectTransition(Transition):
+    # DAut: the preview source transitions onto program (in the configured transition style)
+    def get_rate(self):
+        return atem_config.state.mes[self.key[1]].get_transition_rate()
+
+    def trps(self, now):
+        # A running transition never reports all of its frames remaining,
+        # that's what a TrPs with no transition in progress looks like.
+        return Cmd_TrPs(self.key[1], min(self.total_frames - 1, self.frames_remaining(now)), self.total_frames)
+
+    def start_commands(self, now, replacing=None):
+        me = self.key[1]
+        # The transition position has to be set first, the tally commands
+        # set two program sources based on whether it is > 0.
+        trps = self.trps(now)
+        return [Cmd_Time(), Cmd_TlIn(me), Cmd_TlSr(me), Cmd_PrvI(me), trps]
+
+    def update_commands(self, now):
+        return [Cmd_Time(), self.trps(now)]
+
+    def finish_commands(self):
+        me = self.key[1]
+        me_state = atem_config.state.mes[me]
+        me_state.program_input, me_state.preview_input = me_state.preview_input, me_state.program_input
+        atem_config.state_changed(me_state)
+        trps = Cmd_TrPs(me, 0, self.total_frames)
+        # back to no transition (position 0) before the tallies are worked out
+        final_trps = Cmd_TrPs(me, self.total_frames, self.total_frames)
+        return [trps, Cmd_TlIn(me), Cmd_TlSr(me), Cmd_PrgI(me), Cmd_PrvI(me), final_trps]
+
+
+class DownstreamKeyTransition(Transition):
+    # DDsA: the DSK fades on air, or off air if it is already on
+    going_on = True
+
+    def get_rate(self):
+        return atem_config.state.dsks[self.key[1]].rate
+
+    def start_commands(self, now, replacing=None):
+        dsk_state = atem_config.state.dsks[self.key[1]]
+        if replacing is not None:
+            self.going_on = replacing.going_on
+        else:
+            self.going_on = not dsk_state.on_air
+        if self.going_on and not dsk_state.on_air:
+            # on air as soon as it starts to fade in
+            dsk_state.on_air = True
+            atem_config.state_changed(dsk_state)
+        return [Cmd_Time(), Cmd_DskS(self.key[1])]
+
+    def update_commands(self, now):
+        return [Cmd_Time(), Cmd_DskS(self.key[1])]
+
+    def finish_commands(self):
+        dsk_state = atem_config.state.dsks[self.key[1]]
+        if not self.going_on:
+            dsk_state.on_air = False
+        atem_config.state_changed(dsk_state)
+        return [Cmd_Time(), Cmd_DskS(self.key[1])]
+
+
+class FadeToBlackTransition(Transition):
+    # FtbA: fade the ME to black, or back from black if it's fully black
+    to_black = True
+
+    def get_rate(self):
+        return atem_config.state.mes[self.key[1]].ftb_rate
+
+    def start_commands(self, now, replacing=None):
+        me_state = atem_config.state.mes[self.key[1]]
+        if replacing is not None:
+            self.to_black = replacing.to_black
+        else:
+            self.to_black = not me_state.ftb_fully_black
+        if not self.to_black and me_state.ftb_fully_black:
+            # no longer fully black once it starts to fade back up
+            me_state.ftb_fully_black = False
+            atem_config.state_changed(me_state)
+        return [Cmd_Time(), Cmd_FtbS(self.key[1])]
+
+    def update_commands(self, now):
+        return [Cmd_Time(), Cmd_FtbS(self.key[1])]
+
+    def finish_commands(self):
+        me_state = atem_config.state.mes[self.key[1]]
+        me_state.ftb_fully_black = self.to_black
+        atem_config.state_changed(me_state)
+        return [Cmd_Time(), Cmd_FtbS(self.key[1])]
+
+
+class TransitionEngine(object):
+    """
+    The running transitions, at most one per ME, DSK and fade to black, so
+    they can all run at once. The client manager calls tick() when
+    get_next_time() comes around and sends the carriers it returns to
+    every client.
+    """
+    def __init__(self):
+        # key -> Transition
+        self.transitions = {}
+
+    def start(self, transition: Transition, now):
+        """
+        Start a transition, replacing any that is running for the same thing.
+        Returns the carriers for the response to the command.
+        """
+        replacing = self.transitions.get(transition.key)
+        transition.start(now, replacing)
+        self.transitions[transition.key] = transition
+        cc = CommandCarrier()
+        cc.commands.extend(transition.start_commands(now, replacing))
+        return [cc]
+
+    def cancel(self, key):
+        """
+        Drop the running transition for key, if there is one. Nothing has
+        been built for its future updates, so that is all it takes.
+        Returns True if there was one.
+        """
+        return self.transitions.pop(key, None) is not None
+
+    def get_next_time(self):
+        # when tick() next has something to send, None if nothing is running
+        if not self.transitions:
+            return None
+        return min(transition.next_update_time for transition in self.transitions.values())
+
+    def tick(self, now):
+        """
+        Carriers for the updates (and the ends) of the transitions that are due
+        """
+        response_list = []
+        for key, transition in list(self.transitions.items()):
+            if transition.next_update_time > now:
+                continue
+            cc = CommandCarrier()
+            if transition.frames_done(now) >= transition.total_frames:
+                del self.transitions[key]
+                cc.commands.extend(transition.finish_commands())
+            else:
+                cc.commands.extend(transition.update_commands(now))
+                transition.schedule_next_update(now)
+            response_list.append(cc)
+        return response_list
+
+
+# The running transitions of the (active) switcher
+transition_engine = TransitionEngine()
+
+
+register_handler(Cmd_DAut, invalidates=(Cmd_TlIn, Cmd_TlSr, Cmd_PrgI, Cmd_PrvI, Cmd_TrPs),
+                 respond=respond_auto_transition, describe=lambda cmd: f"ME: {cmd.me}, AUTO TRANSITION")
+register_handler(Cmd_DCut, invalidates=(Cmd_TlIn, Cmd_TlSr, Cmd_PrgI, Cmd_PrvI),
+                 respond=respond_cut, describe=lambda cmd: f"ME: {cmd.me}, CUT")
+register_handler(Cmd_CPgI, invalidates=(Cmd_TlIn, Cmd_TlSr, Cmd_PrgI),
+                 describe=lambda cmd: f"ME: {cmd.me}, Program Source: {cmd.video_source}")
+register_handler(Cmd_CPvI, invalidates=(Cmd_TlIn, Cmd_TlSr, Cmd_PrvI),
+                 describe=lambda cmd: f"ME: {cmd.me}, Preview Source: {cmd.video_source}")
+register_handler(Cmd_DDsA, invalidates=(Cmd_DskS,), respond=respond_dsk_auto,
+                 describe=lambda cmd: f"DSK: {cmd.dsk}, AUTO TRANSITION")
+register_handler(Cmd_FtbA, invalidates=(Cmd_FtbS,), respond=respond_fade_to_black,
+                 describe=lambda cmd: f"ME: {cmd.me}, FADE TO BLACK")
+
+# command code -> class of the commands the server decodes
+commands_list = {code: handler.cmd_class for code, handler in command_handlers.items()}
+
+
+def get_command_class(cmd_name):
+    """
+    Class to decode an inbound command with, None if the command is unknown
+    """
+    handler = command_handlers.get(cmd_name)
+    if handler is None:
+        return None
+    return handler.cmd_class
+
+
 def get_command_object(bytes=b'', cmd_name=""):
-    cmd_class = commands_list.get(cmd_name)
-    if cmd_class is not None:
-        cmd_obj = cmd_class(bytes)
-    else:
-        cmd_obj = Cmd_Unknown(bytes, cmd_name)
-    return cmd_obj
+    cmd_class = get_command_class(cmd_name)
+    if cmd_class is None:
+        return None
+    return cmd_class(bytes)
 
 
 def get_response(cmd_list:List[ATEMCommand]):
@@ -446,93 +1205,257 @@ def get_response(cmd_list:List[ATEMCommand]):
     """
     response_list = []
     for cmd in cmd_list:
-        if isinstance(cmd, Cmd_DAut):
-            cmd.update_state()
-            now = time.monotonic()
-            time_offset_sec = 0
-            frames_total = cmd.transition_total_frames
-            frames_remaining = frames_total - 1
-            print(f"ME: {cmd.me}, AUTO TRANSITION")
-            # The transition position command object has to be created first so
-            # the transition position gets updated in the conf_db. The tally
-            # commands set two program sources based on whether the transition
-            # position is > 0.
-            trPs = Cmd_TrPs(cmd.me, frames_remaining, frames_total)
-            # create response packet
-            cc = CommandCarrier()
-            cc.commands.append(Cmd_Time(time_offset_sec))
-            cc.commands.append(Cmd_TlIn(cmd.me))
-            cc.commands.append(Cmd_TlSr(cmd.me))
-            cc.commands.append(Cmd_PrvI(cmd.me))
-            cc.commands.append(trPs)
-            response_list.append(cc)
-            # create future packets
-            
-            while frames_remaining > 0:
-                # Send an update every 200ms which is every 6 "frames".
-                # The transition framerate seems to remain at 30fps.
-                # This is way fewer than a real switcher but gets a similar result.
-                frames_remaining -= 6
-                if frames_remaining <= 0:
-                    frames_remaining = 0
-                    break
-                cc = CommandCarrier()
-                time_offset_sec += 0.200 # create another update packet every 1/5th of a second
-                cc.send_time = now + time_offset_sec
-                cc.commands.append(Cmd_Time(time_offset_sec))
-                cc.commands.append(Cmd_TrPs(cmd.me, frames_remaining, frames_total))
-                response_list.append(cc)
-
-            # create last future packet
-            transition_pos = int((frames_remaining/frames_total) * 10000)
-            cmd.update_prog_prev()
-            cc = CommandCarrier()
-            cc.send_time = now + (frames_total / 30)
-            cc.commands.append(Cmd_TrPs(cmd.me, frames_remaining, frames_total))
-            # create final trPs so the tallys show correctly based on the transition position
-            final_trPs = Cmd_TrPs(cmd.me, frames_total, frames_total)
-            cc.commands.append(Cmd_TlIn(cmd.me)) # Tally by Index
-            cc.commands.append(Cmd_TlSr(cmd.me)) # Tally by Source
-            cc.commands.append(Cmd_PrgI(cmd.me)) # Program Input (PrgI)
-            cc.commands.append(Cmd_PrvI(cmd.me)) # Preivew Input (PrvI)
-            cc.commands.append(final_trPs)
-            response_list.append(cc)
-        elif isinstance(cmd, Cmd_DCut):
-            cmd.update_state()
-            print(f"ME: {cmd.me}, CUT")
-            cc = CommandCarrier()
-            # Time
-            cc.commands.append(Cmd_Time()) # Time
-            cc.commands.append(Cmd_TlIn(cmd.me)) # Tally by Index
-            cc.commands.append(Cmd_TlSr(cmd.me)) # Tally by Source
-            cc.commands.append(Cmd_PrgI(cmd.me)) # Program Input (PrgI)
-            cc.commands.append(Cmd_PrvI(cmd.me)) # Preivew Input (PrvI)
-            response_list.append(cc)
-        elif isinstance(cmd, Cmd_CPgI):
-            cmd.update_state()
-            print(f"ME: {cmd.me}, Program Source: {cmd.video_source}")
-            cc = CommandCarrier()
-            cc.commands.append(Cmd_Time()) # Time
-            cc.commands.append(Cmd_TlIn(cmd.me)) # Tally by Index
-            cc.commands.append(Cmd_TlSr(cmd.me)) # Tally by Source
-            cc.commands.append(Cmd_PrgI(cmd.me)) # Program Input (PrgI)
-            response_list.append(cc)
-        elif isinstance(cmd, Cmd_CPvI):
-            cmd.update_state()
-            print(f"ME: {cmd.me}, Preview Source: {cmd.video_source}")
-            cc = CommandCarrier()
-            cc.commands.append(Cmd_Time()) # Time
-            cc.commands.append(Cmd_TlIn(cmd.me)) # Tally by Index
-            cc.commands.append(Cmd_TlSr(cmd.me)) # Tally by Source
-            cc.commands.append(Cmd_PrvI(cmd.me)) # Preview Input (PrvI)
-            response_list.append(cc)
-        else:
-            pass
+        handler = command_handlers.get(cmd.code)
+        if handler is not None:
+            if atem_latency.enabled:
+                start = time.monotonic()
+                response_list.extend(handler.handle(cmd))
+                atem_latency.record("dispatch", time.monotonic() - start, cmd.code)
+            else:
+                response_list.extend(handler.handle(cmd))
     return response_list
 
-if __name__ == "__main__":
-    # Quick test
-    for cmd_name in commands_list:
-        cmd_class = commands_list[cmd_name]
-        cmd_obj = cmd_class(bytes)
 
+######################################################
+# CONFIG RELOAD
+######################################################
+
+# The commands that carry each field of the switcher state to the clients,
+# by state class. The commands are built with the object's indexes from
+# its path (eg. (me, key) for a KeyState). Fields the server has no
+# command for (eg. the video mode) only change the setup dump.
+STATE_FIELD_COMMANDS = {
+    atem_config.MixEffectState : {
+        'program_input' : (Cmd_TlIn, Cmd_TlSr, Cmd_PrgI),
+        'preview_input' : (Cmd_TlIn, Cmd_TlSr, Cmd_PrvI),
+        # the transition rate is the frames remaining of TrPs
+        'transition_style' : (Cmd_TrPs,),
+        'mix_rate' : (Cmd_TMxP, Cmd_TrPs),
+        'dip_rate' : (Cmd_TDpP, Cmd_TrPs),
+        'dip_input' : (Cmd_TDpP,),
+        'wipe_rate' : (Cmd_TrPs,),
+        'dve_rate' : (Cmd_TrPs,),
+        'ftb_rate' : (Cmd_FtbP, Cmd_FtbS),
+        'ftb_fully_black' : (Cmd_FtbS,),
+        },
+    atem_config.KeyState : {
+        'on_air' : (Cmd_KeOn,),
+        },
+    atem_config.DownstreamKeyState : dict(
+        {name: (Cmd_DskP,) for name in atem_config.DownstreamKeyState.persisted_fields},
+        on_air=(Cmd_DskS,), rate=(Cmd_DskP, Cmd_DskS), fill_source=(Cmd_DskB,), key_source=(Cmd_DskB,)),
+    atem_config.InputState : {
+        'long_name' : (Cmd_InPr.for_input,),
+        'short_name' : (Cmd_InPr.for_input,),
+        },
+    atem_config.AuxState : {
+        'input' : (Cmd_AuxS,),
+        },
+    atem_config.ColorGeneratorState : {
+        'hue' : (Cmd_ColV,),
+        'saturation' : (Cmd_ColV,),
+        'luma' : (Cmd_ColV,),
+        },
+    }
+
+
+def reload_config(config_file):
+    """
+    Reload the config file (see atem_config.reload_config) and get the
+    commands for what it changed, to send to every client. Returns a list
+    of CommandCarrier objects, empty if nothing changed.
+    """
+    return get_change_commands(config_file, atem_config.reload_config(config_file))
+
+
+def apply_config(config_file, changed_values):
+    """
+    Use a config reloaded somewhere else (see atem_config.apply_config) and
+    get the commands for what it changed, as reload_config
+    """
+    return get_change_commands(config_file, atem_config.apply_config(changed_values))
+
+
+def get_change_commands(config_file, changes):
+    # the command carriers for a reload's changes, None if it failed
+    if not changes:
+        if changes is not None:
+            print(f"Reloaded {config_file}: no changes")
+        return []
+    # (command builder, indexes) -> None, in the order they come up
+    builds = {}
+    for path, obj, changed_fields in changes:
+        field_commands = STATE_FIELD_COMMANDS.get(type(obj), {})
+        for name in changed_fields:
+            for make_command in field_commands.get(name, ()):
+                builds[(make_command, path[1::2])] = None
+    cc = CommandCarrier()
+    cc.commands.append(Cmd_Time())
+    for make_command, indexes in builds:
+        cmd = make_command(*indexes)
+        if cmd is not None:
+            cc.commands.append(cmd)
+    print(f"Reloaded {config_file}: changed " +
+          ", ".join(f"{'.'.join(map(str, path)) or 'switcher'} {'/'.join(changed_fields)}"
+                    for path, obj, changed_fields in changes))
+    if len(cc.commands) == 1:
+        # nothing the clients are told about
+        return []
+    return [cc]
+
+
+if __name__ == "__main__":
+    # Quick test: every command survives an encode -> decode -> encode round trip
+    atem_config.config_init("default_config.xml")
+    state = atem_config.state
+    samples = [Cmd__ver(), Cmd__pin(), Cmd_InCm(), Cmd_Time(1.5), Cmd_TlIn(0), Cmd_TlSr(0),
+               Cmd_PrgI(0), Cmd_PrvI(0), Cmd_TrPs(0), Cmd_TMxP(0), Cmd_TDpP(0), Cmd_FtbP(0), Cmd_FtbS(0)]
+    # (only the inputs named in the config, the captured names of the others have junk after the terminator)
+    samples += [cmd for cmd in (Cmd_InPr(cmd_bytes) for code, cmd_bytes in get_raw_setup_commands() if code == 'InPr')
+                if cmd.long_name is not None]
+    samples += [Cmd_KeOn(0, key) for key in state.mes[0].keys]
+    samples += [cmd_class(dsk) for dsk in state.dsks for cmd_class in (Cmd_DskB, Cmd_DskP, Cmd_DskS)]
+    samples += [Cmd_ColV(color_gen) for color_gen in state.color_generators]
+    samples += [Cmd_AuxS(aux_id) for aux_id in state.auxes]
+    for cmd_class, content in ((Cmd_DAut, b'\x00\x00\x00\x00'), (Cmd_DCut, b'\x01\x00\x00\x00'),
+                               (Cmd_CPgI, b'\x00\x00\x00\x03'), (Cmd_CPvI, b'\x00\x00\x0b\xb9'),
+                               (Cmd_DDsA, b'\x01\x00\x00\x00'), (Cmd_FtbA, b'\x00\x00\x00\x00')):
+        samples.append(cmd_class.from_bytes(CMD_HEADER.pack(8 + len(content), cmd_class.__name__[-4:].encode()) + content))
+    samples.append(Cmd_Unknown(CMD_HEADER.pack(12, b'XXXX') + b'\x01\x02\x03\x04', 'XXXX'))
+    samples.append(Cmd_Raw(bytes(get_raw_setup_commands()[0][1])))
+
+    for cmd in samples:
+        cmd.to_bytes()
+        assert cmd.length == len(cmd.bytes) == CMD_HEADER.unpack_from(cmd.bytes, 0)[0], cmd.code
+        decoded = type(cmd).from_bytes(bytes(cmd.bytes))
+        for name in cmd.content_fields:
+            assert getattr(decoded, name) == getattr(cmd, name), (cmd.code, name)
+        decoded.to_bytes()
+        assert bytes(decoded.bytes) == bytes(cmd.bytes), cmd.code
+
+    # every video mode has a frame clock, and the time counts frames on it
+    saved_video_mode = state.video_mode
+    for video_mode, frame_rate in (("1080i50", 25), ("720p60", 60), ("1080p30", 30), ("525i5994 NTSC", 29.97)):
+        state.video_mode = video_mode
+        assert state.get_frame_rate() == frame_rate
+        assert 0 <= Cmd_Time().frame < frame_rate
+    state.video_mode = saved_video_mode
+
+    # a carrier packs the same bytes as the commands encoded one at a time
+    cc = CommandCarrier()
+    cc.commands = samples
+    assert cc.to_bytes() == b''.join(bytes(cmd.bytes) for cmd in samples)
+
+    # the incrementally updated tally matches the tally worked out from scratch
+    # (mid transition the preview source is on air as well)
+    me_state = state.mes[0]
+    video_sources = DEVICE_VIDEO_SOURCES[state.product]
+    for program, preview, position in ((1, 2, 0), (2, 1, 5000), (2, 3, 10000), (3, 3, 0), (1000, 4, 2500), (4, 1000, 0), (4, 1000, 0)):
+        me_state.program_input, me_state.preview_input, me_state.transition_position = program, preview, position
+        expected = bytes(get_tally_flags(i + 1, program, preview, position) for i in range(len(state.inputs)))
+        assert Cmd_TlIn(0).content[TALLY_COUNT.size:-2] == expected
+        expected = bytes(get_tally_flags(source, program, preview, position) for source in video_sources)
+        assert Cmd_TlSr(0).content[TALLY_COUNT.size + 2:-2:TALLY_SOURCE.size] == expected
+
+    # transitions on an ME, a DSK and fade to black all running at once, on a made up clock
+    me_state.program_input, me_state.preview_input, me_state.transition_position = 1, 2, 0
+    dsk_state = state.dsks[0]
+    dsk_state.on_air = False
+    me_state.ftb_fully_black = False
+    frame = 1 / state.get_frame_rate()
+    transition_engine.start(MixEffectTransition(('me', 0)), 0)
+    transition_engine.start(DownstreamKeyTransition(('dsk', 0)), 0)
+    transition_engine.start(FadeToBlackTransition(('ftb', 0)), 0)
+    assert dsk_state.on_air and not me_state.ftb_fully_black
+    positions = [me_state.transition_position]
+    updates = 0
+    now = 0
+    while transition_engine.transitions:
+        now = transition_engine.get_next_time()
+        for cc in transition_engine.tick(now):
+            updates += 1
+            if ('me', 0) in transition_engine.transitions:
+                positions.append(me_state.transition_position)
+    assert positions == sorted(positions) and 0 < positions[0] and positions[-1] < 10000, positions
+    # done when the longest one (fade to black) has run all its frames
+    assert abs(now - me_state.ftb_rate * frame) < frame
+    assert (me_state.program_input, me_state.preview_input, me_state.transition_position) == (2, 1, 0)
+    assert dsk_state.on_air and me_state.ftb_fully_black
+    # every update is TRANSITION_UPDATE_FRAMES on, plus the end of each transition
+    expected_updates = sum(-(-rate // TRANSITION_UPDATE_FRAMES) for rate in (me_state.get_transition_rate(), dsk_state.rate, me_state.ftb_rate))
+    assert updates == expected_updates, (updates, expected_updates)
+    # a cut half way through cancels the rest of the transition
+    transition_engine.start(MixEffectTransition(('me', 0)), 0)
+    transition_engine.tick(transition_engine.get_next_time())
+    assert 0 < me_state.transition_position < 10000
+    dcut = Cmd_DCut.from_bytes(CMD_HEADER.pack(12, b'DCut') + bytes(4))
+    assert [cmd.code for cmd in get_response([dcut])[0].commands][-1] == 'TrPs'
+    assert not transition_engine.transitions and me_state.transition_position == 0
+    assert (me_state.program_input, me_state.preview_input) == (1, 2)
+    # a second auto transition carries on from where the first had got to
+    first = MixEffectTransition(('me', 0))
+    transition_engine.start(first, 0)
+    second = MixEffectTransition(('me', 0))
+    transition_engine.start(second, 10 * frame)
+    assert second.frames_done(10 * frame) == first.frames_done(10 * frame) == 10
+    transition_engine.cancel(('me', 0))
+    me_state.transition_position = 0
+
+    # every registered command gets decoded and answered, unknown ones are ignored
+    for code, handler in command_handlers.items():
+        content = bytes(handler.cmd_class.command_length - CMD_HEADER_SIZE)
+        cmd = get_command_object(CMD_HEADER.pack(handler.cmd_class.command_length, code.encode()) + content, code)
+        cmd.parse_cmd()
+        assert get_response([cmd]), code
+    assert get_command_object(CMD_HEADER.pack(12, b'XXXX') + bytes(4), 'XXXX') is None
+
+    # a config reload changes (and sends) only what the file changed, over
+    # what the clients have done to the state, and the changes get saved
+    import os
+    import tempfile
+    import atem_persist
+    atem_config.config_init("default_config.xml")
+    temp_dir = tempfile.mkdtemp()
+    journal = atem_persist.open_state(os.path.join(temp_dir, "switcher.state"))
+    tally_table = get_tally_table(0)
+    state = atem_config.state
+    state.mes[0].program_input, state.mes[0].preview_input = 3, 2
+    with open("default_config.xml") as f:
+        config_text = f.read()
+    edited_text = (config_text.replace('<Program input="4"/>', '<Program input="6"/>')
+                   .replace('longName="PP MAIN"', 'longName="CAM ONE"')
+                   .replace('<DownstreamKey index="0" fillSource="1" keySource="1" rate="20"',
+                            '<DownstreamKey index="0" fillSource="1" keySource="1" rate="30"')
+                   .replace('<Key index="0" type="Luma" inputCut="0" inputFill="0" onAir="False"',
+                            '<Key index="0" type="Luma" inputCut="0" inputFill="0" onAir="True"'))
+    fd, edited_file = tempfile.mkstemp(suffix=".xml")
+    with os.fdopen(fd, 'w') as f:
+        f.write(edited_text)
+    saved_cache_dir = atem_config.CONFIG_CACHE_DIR
+    atem_config.CONFIG_CACHE_DIR = None
+    response_list = reload_config(edited_file)
+    assert [cmd.code for cmd in response_list[0].commands] == ['Time', 'TlIn', 'TlSr', 'PrgI', 'KeOn', 'DskP', 'DskS', 'InPr']
+    assert (state.mes[0].program_input, state.mes[0].preview_input) == (6, 2) and state.mes[0].keys[0].on_air
+    assert state.inputs[1].long_name == "CAM ONE" and state.dsks[0].rate == 30
+    assert atem_config.state is state and get_tally_table(0) is tally_table
+    assert reload_config(edited_file) == []
+    # an ME more or less takes a restart
+    with open(edited_file, 'w') as f:
+        f.write(edited_text.replace('<MixEffectBlock index="0"', '<MixEffectBlock index="1"', 1))
+    assert reload_config(edited_file) == [] and state.mes[0].program_input == 6
+    atem_persist.close_state()
+    assert journal.records_written == journal.records_queued
+    saved_state = atem_config.get_state_values()
+    atem_config.config_init("default_config.xml")
+    atem_persist.restore_state(journal.state_file)
+    assert atem_config.get_state_values() == saved_state and atem_config.state.mes[0].keys[0].on_air
+    atem_config.CONFIG_CACHE_DIR = saved_cache_dir
+    os.remove(edited_file)
+    import shutil
+    shutil.rmtree(temp_dir)
+
+    tested = {type(cmd) for cmd in samples}
+    command_classes = [cls for cls in globals().values() if isinstance(cls, type) and cls.__name__.startswith('Cmd_')]
+    untested = [cls.__name__ for cls in command_classes if cls not in tested]
+    assert not untested, untested
+    print(f"{len(samples)} commands round tripped")
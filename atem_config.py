@@ -2,12 +2,51 @@
 # This should eventually be saved/restored to a file
 # Currently it gets populated with sane defaults
 
+import copy
+import hashlib
+import os
+import pickle
+import re
+import time
 import xml.etree.ElementTree as ET
 from collections import defaultdict
+from enum import IntEnum
 from pprint import pprint
 
+# The config file as a nested dict of strings. The parts of the switcher
+# state the commands work with are loaded into the typed model (state)
+# below and kept there, so conf_db is only brought up to date when it is
+# read through get_config().
 conf_db = {}
 
+# Typed switcher state (a SwitcherState)
+state = None
+
+# Bumped every time the switcher state changes so anything derived from
+# it (eg. the state dump sent to new clients) knows to rebuild itself.
+state_version = 0
+
+# state_version the conf_db strings were last brought up to date at
+conf_db_version = 0
+
+# The values of the state's objects as the config file has them (see
+# get_state_values), so a reload can tell which of them the file changed
+config_values = {}
+
+# atem_persist.StateJournal that state_changed() reports the changes to,
+# when the state is being saved
+state_journal = None
+
+# Config snapshots: the parsed config file (conf_db as config_init() makes
+# it) is pickled into CONFIG_CACHE_DIR, named by the hash of the file's
+# content, so the next start with the same file skips parsing the XML. An
+# edited file hashes to a new name, and a snapshot that can't be loaded is
+# parsed again and rewritten. None to always parse the file.
+CONFIG_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "pyAtemSim")
+# Part of the snapshot name. Bump it when the conf_db layout changes (eg.
+# manipulate_sections) so the snapshots made before aren't used.
+CONFIG_SNAPSHOT_VERSION = 1
+
 video_sources = {
     0 : "Black",
     1 : "Input 1",
@@ -96,14 +135,562 @@ audio_sources = {
 
 
 
+######################################################
+# TYPED SWITCHER STATE
+######################################################
+
+class TransitionStyle(IntEnum):
+    MIX = 0
+    DIP = 1
+    WIPE = 2
+    DVE = 3
+    STING = 4
+
+# names used for the transition styles in the config file
+TRANSITION_STYLE_NAMES = {
+    TransitionStyle.MIX : "Mix",
+    TransitionStyle.DIP : "Dip",
+    TransitionStyle.WIPE : "Wipe",
+    TransitionStyle.DVE : "DVE",
+    TransitionStyle.STING : "Sting",
+    }
+TRANSITION_STYLES_BY_NAME = {name: style for style, name in TRANSITION_STYLE_NAMES.items()}
+
+
+def get_frame_rate(video_mode):
+    """
+    Frames per second of a video mode like "1080p5994", "1080i50" or
+    "525i5994 NTSC". Transition rates are in frames at this rate. Interlaced
+    modes are named by their field rate, which is twice the frame rate.
+    """
+    match = re.match(r'\d+([pi])(\d+)', video_mode or "")
+    if match is None:
+        return 30
+    scan, rate_digits = match.groups()
+    # "5994" is 59.94, "50" is 50
+    rate = int(rate_digits) / 100 if len(rate_digits) == 4 else int(rate_digits)
+    if scan == 'i':
+        rate /= 2
+    return rate
+
+
+def to_bool(config_value):
+    # Config file booleans are the strings "True" and "False"
+    return config_value == "True"
+
+def to_number(config_value):
+    return float(config_value)
+
+def from_number(value):
+    # keep whole numbers looking like they did in the config file ("50", not "50.0")
+    if value == int(value):
+        return str(int(value))
+    return str(value)
+
+
+# Each state class lists the fields that get saved (see atem_persist) in
+# persisted_fields: everything but the index and the nested objects.
+
+class KeyState(object):
+    __slots__ = ('index', 'on_air')
+    persisted_fields = ('on_air',)
+
+    def __init__(self, index=0, on_air=False):
+        self.index = index
+        self.on_air = on_air
+
+    @classmethod
+    def from_conf(cls, conf):
+        return cls(int(conf['index']), to_bool(conf['onAir']))
+
+    def to_conf(self, conf):
+        conf['onAir'] = str(self.on_air)
+
+
+class MixEffectState(object):
+    __slots__ = ('index', 'program_input', 'preview_input', 'transition_style', 'transition_position',
+                 'mix_rate', 'dip_rate', 'dip_input', 'wipe_rate', 'dve_rate',
+                 'ftb_rate', 'ftb_fully_black', 'keys')
+    # not transition_position, a restarted switcher has no transition running
+    persisted_fields = ('program_input', 'preview_input', 'transition_style',
+                        'mix_rate', 'dip_rate', 'dip_input', 'wipe_rate', 'dve_rate',
+                        'ftb_rate', 'ftb_fully_black')
+
+    def __init__(self, index=0):
+        self.index = index
+        self.program_input = 0
+        self.preview_input = 0
+        self.transition_style = TransitionStyle.MIX
+        # 0-10000, 0 when no transition is in progress
+        self.transition_position = 0
+        self.mix_rate = 25
+        self.dip_rate = 25
+        self.dip_input = 0
+        self.wipe_rate = 25
+        self.dve_rate = 25
+        self.ftb_rate = 25
+        self.ftb_fully_black = False
+        self.keys = {}
+
+    @classmethod
+    def from_conf(cls, conf):
+        me = cls(int(conf['index']))
+        me.program_input = int(conf['Program']['input'])
+        me.preview_input = int(conf['Preview']['input'])
+        transition_conf = conf['TransitionStyle']
+        me.transition_style = TRANSITION_STYLES_BY_NAME.get(transition_conf['style'], TransitionStyle.MIX)
+        me.transition_position = int(transition_conf['transitionPosition'])
+        me.mix_rate = int(transition_conf['MixParameters']['rate'])
+        me.dip_rate = int(transition_conf['DipParameters']['rate'])
+        me.dip_input = int(transition_conf['DipParameters']['input'])
+        me.wipe_rate = int(transition_conf['WipeParameters']['rate'])
+        me.dve_rate = int(transition_conf['DVEParameters']['rate'])
+        me.ftb_rate = int(conf['FadeToBlack']['rate'])
+        me.ftb_fully_black = to_bool(conf['FadeToBlack']['isFullyBlack'])
+        me.keys = {index: KeyState.from_conf(key_conf) for index, key_conf in (conf.get('Keys') or {}).items()}
+        return me
+
+    def to_conf(self, conf):
+        conf['Program']['input'] = str(self.program_input)
+        conf['Preview']['input'] = str(self.preview_input)
+        transition_conf = conf['TransitionStyle']
+        transition_conf['style'] = TRANSITION_STYLE_NAMES[self.transition_style]
+        transition_conf['transitionPosition'] = str(self.transition_position)
+        transition_conf['MixParameters']['rate'] = str(self.mix_rate)
+        transition_conf['DipParameters']['rate'] = str(self.dip_rate)
+        transition_conf['DipParameters']['input'] = str(self.dip_input)
+        transition_conf['WipeParameters']['rate'] = str(self.wipe_rate)
+        transition_conf['DVEParameters']['rate'] = str(self.dve_rate)
+        conf['FadeToBlack']['rate'] = str(self.ftb_rate)
+        conf['FadeToBlack']['isFullyBlack'] = str(self.ftb_fully_black)
+        for index, key in self.keys.items():
+            key.to_conf(conf['Keys'][index])
+
+    def get_transition_rate(self):
+        """
+        Number of frames the current transition style takes
+        """
+        if self.transition_style == TransitionStyle.DIP:
+            return self.dip_rate
+        elif self.transition_style == TransitionStyle.WIPE:
+            return self.wipe_rate
+        else: # default to mix parameters
+            return self.mix_rate
+
+
+class DownstreamKeyState(object):
+    __slots__ = ('index', 'on_air', 'tie', 'rate', 'fill_source', 'key_source', 'pre_multiplied',
+                 'clip', 'gain', 'invert', 'mask_enabled', 'mask_top', 'mask_bottom', 'mask_left', 'mask_right')
+    persisted_fields = __slots__[1:]
+
+    @classmethod
+    def from_conf(cls, conf):
+        dsk = cls()
+        dsk.index = int(conf['index'])
+        dsk.on_air = to_bool(conf['onAir'])
+        dsk.tie = to_bool(conf['tie'])
+        dsk.rate = int(conf['rate'])
+        dsk.fill_source = int(conf['fillSource'])
+        dsk.key_source = int(conf['keySource'])
+        dsk.pre_multiplied = to_bool(conf['preMultipliedKey'])
+        dsk.clip = to_number(conf['clip'])
+        dsk.gain = to_number(conf['gain'])
+        dsk.invert = to_bool(conf['invert'])
+        dsk.mask_enabled = to_bool(conf['maskEnabled'])
+        dsk.mask_top = to_number(conf['maskTop'])
+        dsk.mask_bottom = to_number(conf['maskBottom'])
+        dsk.mask_left = to_number(conf['maskLeft'])
+        dsk.mask_right = to_number(conf['maskRight'])
+        return dsk
+
+    def to_conf(self, conf):
+        conf['onAir'] = str(self.on_air)
+        conf['tie'] = str(self.tie)
+        conf['rate'] = str(self.rate)
+        conf['fillSource'] = str(self.fill_source)
+        conf['keySource'] = str(self.key_source)
+        conf['preMultipliedKey'] = str(self.pre_multiplied)
+        conf['clip'] = from_number(self.clip)
+        conf['gain'] = from_number(self.gain)
+        conf['invert'] = str(self.invert)
+        conf['maskEnabled'] = str(self.mask_enabled)
+        conf['maskTop'] = from_number(self.mask_top)
+        conf['maskBottom'] = from_number(self.mask_bottom)
+        conf['maskLeft'] = from_number(self.mask_left)
+        conf['maskRight'] = from_number(self.mask_right)
+
+
+class InputState(object):
+    __slots__ = ('id', 'long_name', 'short_name')
+    persisted_fields = ('long_name', 'short_name')
+
+    def __init__(self, id=0, long_name="", short_name=""):
+        self.id = id
+        self.long_name = long_name
+        self.short_name = short_name
+
+    @classmethod
+    def from_conf(cls, conf):
+        return cls(int(conf['id']), conf.get('longName'), conf.get('shortName'))
+
+    def to_conf(self, conf):
+        if self.long_name is not None:
+            conf['longName'] = self.long_name
+        if self.short_name is not None:
+            conf['shortName'] = self.short_name
+
+
+class AuxState(object):
+    __slots__ = ('id', 'input')
+    persisted_fields = ('input',)
+
+    def __init__(self, id=8001, input=0):
+        self.id = id
+        self.input = input
+
+    @classmethod
+    def from_conf(cls, conf):
+        return cls(int(conf['id']), int(conf['input']))
+
+    def to_conf(self, conf):
+        conf['input'] = str(self.input)
+
+
+class ColorGeneratorState(object):
+    __slots__ = ('index', 'hue', 'saturation', 'luma')
+    persisted_fields = ('hue', 'saturation', 'luma')
+
+    def __init__(self, index=0, hue=0.0, saturation=0.0, luma=0.0):
+        self.index = index
+        self.hue = hue
+        self.saturation = saturation
+        self.luma = luma
+
+    @classmethod
+    def from_conf(cls, conf):
+        return cls(int(conf['index']), to_number(conf['hue']), to_number(conf['saturation']), to_number(conf['luma']))
+
+    def to_conf(self, conf):
+        conf['hue'] = from_number(self.hue)
+        conf['saturation'] = from_number(self.saturation)
+        conf['luma'] = from_number(self.luma)
+
+
+class SwitcherState(object):
+    __slots__ = ('product', 'video_mode', 'mes', 'dsks', 'inputs', 'auxes', 'color_generators')
+    persisted_fields = ('product', 'video_mode')
+
+    def get_frame_rate(self):
+        return get_frame_rate(self.video_mode)
+
+    @classmethod
+    def from_conf(cls, conf):
+        switcher = cls()
+        switcher.product = conf.get('product', "ATEM Television Studio HD")
+        switcher.video_mode = conf['VideoMode']['videoMode']
+        switcher.mes = {index: MixEffectState.from_conf(me_conf) for index, me_conf in conf['MixEffectBlocks'].items()}
+        switcher.dsks = {index: DownstreamKeyState.from_conf(dsk_conf) for index, dsk_conf in conf['DownstreamKeys'].items()}
+        switcher.inputs = {id: InputState.from_conf(input_conf) for id, input_conf in conf['Settings']['Inputs'].items()}
+        switcher.auxes = {id: AuxState.from_conf(aux_conf) for id, aux_conf in conf['Auxiliaries'].items()}
+        switcher.color_generators = {index: ColorGeneratorState.from_conf(color_conf)
+                                     for index, color_conf in conf['ColorGenerators'].items()}
+        return switcher
+
+    def to_conf(self, conf):
+        conf['product'] = self.product
+        conf['VideoMode']['videoMode'] = self.video_mode
+        for index, me in self.mes.items():
+            me.to_conf(conf['MixEffectBlocks'][index])
+        for index, dsk in self.dsks.items():
+            dsk.to_conf(conf['DownstreamKeys'][index])
+        for id, input in self.inputs.items():
+            input.to_conf(conf['Settings']['Inputs'][id])
+        for id, aux in self.auxes.items():
+            aux.to_conf(conf['Auxiliaries'][id])
+        for index, color_gen in self.color_generators.items():
+            color_gen.to_conf(conf['ColorGenerators'][index])
+
+
+
+# Where the objects of each class are in SwitcherState: (attribute, the
+# field they are indexed by)
+STATE_SECTIONS = {
+    MixEffectState : ('mes', 'index'),
+    DownstreamKeyState : ('dsks', 'index'),
+    InputState : ('inputs', 'id'),
+    AuxState : ('auxes', 'id'),
+    ColorGeneratorState : ('color_generators', 'index'),
+    }
+
+def get_state_path(obj):
+    """
+    Where obj is in the switcher state, eg. ('mes', 0) for ME 0. The
+    switcher itself is (). See iter_state_objects().
+    """
+    if obj is state:
+        return ()
+    if type(obj) is KeyState:
+        # a key doesn't know its ME, find the ME that has it
+        for me in state.mes.values():
+            if me.keys.get(obj.index) is obj:
+                return ('mes', me.index, 'keys', obj.index)
+        raise KeyError(obj)
+    section, index_field = STATE_SECTIONS[type(obj)]
+    return (section, getattr(obj, index_field))
+
+
+def iter_state_objects(switcher=None):
+    """
+    Every object in the switcher state (or another SwitcherState) with its
+    path: () for the switcher, ('mes', 0) for ME 0, ('mes', 0, 'keys', 1)
+    for one of its keys, etc.
+    """
+    if switcher is None:
+        switcher = state
+    yield (), switcher
+    for section, index_field in STATE_SECTIONS.values():
+        for index, obj in getattr(switcher, section).items():
+            yield (section, index), obj
+            if section == 'mes':
+                for key_index, key in obj.keys.items():
+                    yield (section, index, 'keys', key_index), key
+
+
+def get_state_values(switcher=None):
+    # path -> the persisted_fields values of every object in the state
+    return {path: tuple(getattr(obj, name) for name in obj.persisted_fields)
+            for path, obj in iter_state_objects(switcher)}
+
+
+def get_state_object(path):
+    # the object at path (see iter_state_objects), None if there isn't one
+    obj = state
+    for i in range(0, len(path), 2):
+        obj = getattr(obj, path[i]).get(path[i + 1])
+        if obj is None:
+            return None
+    return obj
+
+
 def config_init(config_file):
-    global conf_db
-    root = ET.parse(config_file).getroot()
-    conf_db = etree_to_dict(root)
-    conf_db = manipulate_sections(conf_db)
+    global conf_db, config_values
+    conf_db = read_config_file(config_file)
+    load_state()
+    config_values = get_state_values()
     return conf_db
 
 
+def reload_config(config_file):
+    """
+    Read the config file again and change the live state where the file
+    has changed since it was loaded. Fields the file hasn't changed keep
+    what the clients have done to them, and only the objects with a
+    changed field are touched, so the tally tables and anything else
+    holding on to the state objects stay valid.
+    Returns a list of (path, object, names of the changed fields), None if
+    the file can't be used (it doesn't parse, or it adds or removes MEs,
+    keys, inputs etc., which takes a restart).
+    """
+    loaded = read_config_values(config_file)
+    if loaded is None:
+        return None
+    new_db, new_values = loaded
+    changed_values = diff_config_values(config_file, new_values)
+    if changed_values is None:
+        return None
+    return apply_config(changed_values, new_db)
+
+
+def read_config_values(config_file):
+    """
+    Read the config file for a reload: (conf_db, its state values as
+    get_state_values() has them), None if it can't be read
+    """
+    try:
+        new_db = read_config_file(config_file)
+        return new_db, get_state_values(SwitcherState.from_conf(new_db))
+    except Exception as e:
+        print(f"Can't reload {config_file} ({e!r}), keeping the config already loaded")
+        return None
+
+
+def diff_config_values(config_file, new_values):
+    """
+    The values in new_values that differ from config_values, by path. None
+    if the file adds or removes objects.
+    """
+    if new_values.keys() != config_values.keys():
+        added = [path for path in new_values if path not in config_values]
+        removed = [path for path in config_values if path not in new_values]
+        print(f"Can't reload {config_file}, it adds {added} and removes {removed}: restart the server to use it")
+        return None
+    return {path: values for path, values in new_values.items() if values != config_values[path]}
+
+
+def apply_config(changed_values, new_db=None):
+    """
+    Use a reloaded config: put the values that have changed (see
+    diff_config_values) into the live state, the fields the file changed
+    only, and take new_db (if given) as conf_db. Returns a list of (path,
+    object, names of the changed fields).
+    """
+    global conf_db, conf_db_version
+    changes = []
+    for path, values in changed_values.items():
+        old_values = config_values[path]
+        config_values[path] = values
+        obj = get_state_object(path)
+        changed_fields = []
+        for name, old_value, value in zip(obj.persisted_fields, old_values, values):
+            if value != old_value and getattr(obj, name) != value:
+                setattr(obj, name, value)
+                changed_fields.append(name)
+        if changed_fields:
+            changes.append((path, obj, changed_fields))
+            state_changed(obj)
+    # the parts of the file outside the typed state come from the new file,
+    # brought up to date with the state on the next get_config()
+    if new_db is not None:
+        conf_db = new_db
+    conf_db_version = -1
+    return changes
+
+
+# seconds between looks at the config file for changes (--watch-config)
+CONFIG_WATCH_INTERVAL = 1.0
+
+
+class ConfigReloader(object):
+    """
+    Calls reload(config_file), eg. ClientManager.reload_config, on SIGHUP
+    and (when watching) when the file has changed. The server loop calls poll() to do it, so the reload never
+    happens in the middle of handling a packet.
+    """
+    def __init__(self, config_file, reload, watch=False):
+        self.config_file = config_file
+        self.reload = reload
+        self.watch = watch
+        self.requested = False
+        self.file_stamp = self.get_file_stamp()
+        self.next_check_time = time.monotonic() + CONFIG_WATCH_INTERVAL
+
+    def get_file_stamp(self):
+        # changes whenever the file is saved, None while it isn't there
+        try:
+            stat = os.stat(self.config_file)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def request(self):
+        self.requested = True
+
+    def poll(self, now):
+        """
+        Reload if it has been asked for or the file has changed. Returns
+        True if it reloaded (for a ClientManager's reload_config, the
+        clients with updates to send are in its updated_clients).
+        """
+        if self.watch and now >= self.next_check_time:
+            self.next_check_time = now + CONFIG_WATCH_INTERVAL
+            file_stamp = self.get_file_stamp()
+            if file_stamp is not None and file_stamp != self.file_stamp:
+                self.file_stamp = file_stamp
+                self.requested = True
+        if not self.requested:
+            return False
+        self.requested = False
+        try:
+            self.reload(self.config_file)
+        except Exception as e:
+            # a bad reload mustn't take the server down
+            print(f"Reloading {self.config_file} failed: {e!r}")
+        return True
+
+
+def parse_config(config_bytes):
+    # the XML config file as conf_db
+    root = ET.fromstring(config_bytes)
+    return manipulate_sections(etree_to_dict(root))
+
+
+def get_snapshot_file(config_bytes):
+    if CONFIG_CACHE_DIR is None:
+        return None
+    digest = hashlib.sha256(config_bytes).hexdigest()
+    return os.path.join(CONFIG_CACHE_DIR, f"config-v{CONFIG_SNAPSHOT_VERSION}-{digest}.pickle")
+
+
+def read_config_file(config_file):
+    """
+    Read the config file into a new conf_db, from its snapshot if there is
+    one, otherwise parse it and save a snapshot for next time
+    """
+    with open(config_file, 'rb') as f:
+        config_bytes = f.read()
+    snapshot_file = get_snapshot_file(config_bytes)
+    if snapshot_file is not None:
+        try:
+            with open(snapshot_file, 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Can't load config snapshot {snapshot_file} ({e}), parsing {config_file}")
+    db = parse_config(config_bytes)
+    if snapshot_file is not None:
+        save_snapshot(snapshot_file, db)
+    return db
+
+
+def save_snapshot(snapshot_file, db):
+    # Written to a temporary file and renamed into place, so a server
+    # starting at the same time never sees half a snapshot
+    temp_file = f"{snapshot_file}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(snapshot_file), exist_ok=True)
+        with open(temp_file, 'wb') as f:
+            pickle.dump(db, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file, snapshot_file)
+    except OSError as e:
+        print(f"Can't save config snapshot {snapshot_file} ({e})")
+        try:
+            os.remove(temp_file)
+        except OSError:
+            pass
+
+
+def load_state():
+    """
+    (Re)load the typed switcher state from conf_db
+    """
+    global state, conf_db_version
+    state = SwitcherState.from_conf(conf_db)
+    state_changed()
+    conf_db_version = state_version
+
+
+def state_changed(changed=None):
+    """
+    Call after every change to the switcher state. changed is the object
+    that was changed (eg. a MixEffectState), None if it could be anything.
+    """
+    global state_version
+    state_version += 1
+    if state_journal is not None:
+        state_journal.record(changed)
+
+
+def sync_conf_db():
+    """
+    Bring the conf_db strings up to date with the typed switcher state
+    """
+    global conf_db_version
+    if conf_db_version != state_version:
+        state.to_conf(conf_db)
+        conf_db_version = state_version
+
+
 
 # Borrowed this nifty algorithm from here:
 # https://stackoverflow.com/questions/7684333/converting-xml-to-dictionary-using-elementtree
@@ -169,21 +756,34 @@ def manipulate_sections(conf_db):
     #     new_dsk_list[int(dsk['index'])] = dsk
     # new_db['DownstreamKeys'] = new_dsk_list
 
-    # push downstream keys up one level and list dictionaries by index
+    # push upstream keys up one level (within each mix effect block) and list dictionaries by index
+    for me in new_db['MixEffectBlocks'].values():
+        if me.get('Keys'):
+            push_up_and_index(me, "Keys", "Key", "index")
+
+    # push color generators up one level and list dictionaries by index
     new_db = push_up_and_index(new_db, "ColorGenerators", "ColorGenerator", "index")
 
+    # push auxiliaries up one level and list dictionaries by id
+    new_db = push_up_and_index(new_db, "Auxiliaries", "Auxiliary", "id")
+
     # push inputs keys up one level and list dictionaries by id
     new_db['Settings'] = push_up_and_index(new_db['Settings'], "Inputs", "Input", "id")
 
     return new_db
 
 
+# get_config/set_config work on the config file layout (nested dicts of
+# strings). They are kept for compatibility, the commands use state directly.
 def get_config(name:str):
+    sync_conf_db()
     return(conf_db.get(name))
 
 def set_config(name:str, val):
     if name in conf_db:
+        sync_conf_db()
         conf_db[name] = val
+        load_state()
     else:
         raise ValueError()
 
@@ -193,4 +793,32 @@ def set_config(name:str, val):
 if __name__ == "__main__":
     db = config_init("default_config.xml")
     pprint(db)
+    # Quick test: the typed state writes back exactly what was loaded
+    loaded_db = copy.deepcopy(db)
+    state.to_conf(db)
+    assert db == loaded_db
+    # and changes made through either side show up on the other
+    state.mes[0].program_input = 3
+    state_changed()
+    assert get_config('MixEffectBlocks')[0]['Program']['input'] == "3"
+    aux_conf = copy.deepcopy(get_config('Auxiliaries'))
+    aux_conf[8001]['input'] = "2"
+    set_config('Auxiliaries', aux_conf)
+    assert state.auxes[8001].input == 2
+
+    # a snapshot loads the same conf_db as parsing the file, and a bad one is parsed again
+    import tempfile
+    CONFIG_CACHE_DIR = tempfile.mkdtemp()
+    parsed_db = config_init("default_config.xml")
+    with open("default_config.xml", 'rb') as f:
+        snapshot_file = get_snapshot_file(f.read())
+    assert os.path.exists(snapshot_file)
+    assert config_init("default_config.xml") == parsed_db
+    with open(snapshot_file, 'wb') as f:
+        f.write(b'not a snapshot')
+    assert config_init("default_config.xml") == parsed_db
+    assert config_init("default_config.xml") == parsed_db
+    import shutil
+    shutil.rmtree(CONFIG_CACHE_DIR)
+    print("config snapshot ok")
 
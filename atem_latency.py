@@ -0,0 +1,182 @@
+# Latency instrumentation:
+# Follows each inbound packet through the server and keeps a histogram of
+# the time spent in every stage, overall and per command code:
+#
+#   parse      packet received -> packet parsed
+#   dispatch   get_response() for one command (state update, building the response)
+#   queue      response ready -> picked up by the client update (waiting in
+#              outbound_commands_list for the next update/tick)
+#   encode     response commands + packet header encoded
+#   sendto     sock.sendto() (or handing it to the batch in the select loop)
+#   flush      select loop only: batched -> actually sent
+#   response   packet received -> the response (ack) to the sender sent
+#   broadcast  packet received -> the update to another client sent
+#
+# It is off unless enable() is called (atem_server.py --latency). When it's
+# off the hot paths only check the enabled flag or a trace attribute that is
+# None, so there is nothing to pay for it.
+#
+# The histograms are printed by dump(), which the server does at shutdown
+# and on SIGUSR1 (kill -USR1 <pid>).
+
+import signal
+import sys
+import time
+
+
+enabled = False
+
+# Histogram resolution. Values below 2 * SUB_BUCKETS microseconds get a
+# bucket each, above that every power of 2 is split into SUB_BUCKETS linear
+# buckets, so any value is within 1/SUB_BUCKETS (~3%) of its bucket.
+SUB_BUCKET_BITS = 5
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+# enough buckets for about an hour in microseconds
+MAX_VALUE_BITS = 32
+NUM_BUCKETS = (MAX_VALUE_BITS - SUB_BUCKET_BITS + 1) * SUB_BUCKETS
+
+
+def bucket_index(value):
+    # value is in microseconds
+    if value < 2 * SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    return min(NUM_BUCKETS - 1, (shift + 1) * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS)
+
+
+def bucket_value(index):
+    # lowest value (microseconds) that goes in the bucket
+    if index < 2 * SUB_BUCKETS:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    return (index % SUB_BUCKETS + SUB_BUCKETS) << shift
+
+
+class LatencyHistogram(object):
+    """
+    HDR style histogram of durations: a fixed array of log-linear buckets,
+    so recording is an index calculation and an increment no matter how
+    many values have been recorded.
+    """
+    def __init__(self):
+        self.counts = [0] * NUM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        value = int(seconds * 1000000)
+        if value < 0:
+            # the clock is monotonic, but don't let a bad timestamp index from the end
+            value = 0
+        self.counts[bucket_index(value)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """
+        Value (seconds) that fraction of the recorded values are at or below,
+        to the resolution of the buckets.
+        """
+        if self.count == 0:
+            return 0.0
+        target = max(1, int(fraction * self.count + 0.5))
+        running = 0
+        for index, bucket_count in enumerate(self.counts):
+            running += bucket_count
+            if running >= target:
+                return min(self.max, bucket_value(index + 1) / 1000000)
+        return self.max
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+
+# stage -> histogram of every command, and (stage, code) -> histogram
+stage_histograms = {}
+code_histograms = {}
+
+def record(stage, seconds, code=None):
+    histogram = stage_histograms.get(stage)
+    if histogram is None:
+        histogram = stage_histograms[stage] = LatencyHistogram()
+    histogram.record(seconds)
+    if code is not None:
+        histogram = code_histograms.get((stage, code))
+        if histogram is None:
+            histogram = code_histograms[(stage, code)] = LatencyHistogram()
+        histogram.record(seconds)
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    stage_histograms.clear()
+    code_histograms.clear()
+
+
+# the order the stages happen in, for the report
+STAGES = ("parse", "dispatch", "queue", "encode", "sendto", "flush", "response", "broadcast")
+
+def format_line(stage, code, histogram):
+    values_us = [histogram.percentile(f) * 1000000 for f in (0.5, 0.9, 0.99, 0.999)]
+    return (f"  {stage:<10} {code:<6} {histogram.count:9} {histogram.mean() * 1000000:10.1f}"
+            + "".join(f"{value:10.1f}" for value in values_us)
+            + f"{histogram.max * 1000000:10.1f}")
+
+
+def dump(file=None):
+    file = file or sys.stdout
+    print("Latency (us):", file=file)
+    print(f"  {'stage':<10} {'code':<6} {'count':>9} {'mean':>10} {'p50':>10} {'p90':>10} {'p99':>10} {'p99.9':>10} {'max':>10}", file=file)
+    stages = [stage for stage in STAGES if stage in stage_histograms]
+    stages += sorted(stage for stage in stage_histograms if stage not in STAGES)
+    for stage in stages:
+        print(format_line(stage, "all", stage_histograms[stage]), file=file)
+        for code in sorted(code for histogram_stage, code in code_histograms if histogram_stage == stage):
+            print(format_line(stage, code, code_histograms[(stage, code)]), file=file)
+    file.flush()
+
+
+def install_signal_handler():
+    # SIGUSR1 dumps the histograms (not on Windows, it doesn't have SIGUSR1)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: dump())
+
+
+if __name__ == "__main__":
+    # Quick test: bucket boundaries line up and percentiles are within the resolution
+    for value in range(0, 1 << 20):
+        index = bucket_index(value)
+        assert bucket_value(index) <= value < bucket_value(index + 1), value
+    assert bucket_index(1 << 40) == NUM_BUCKETS - 1
+
+    histogram = LatencyHistogram()
+    for us in range(1, 10001):
+        histogram.record(us / 1000000)
+    for fraction in (0.5, 0.9, 0.99, 0.999):
+        expected = fraction * 10000 / 1000000
+        assert abs(histogram.percentile(fraction) - expected) <= expected / SUB_BUCKETS, fraction
+    assert histogram.percentile(1.0) == histogram.max == 0.01
+
+    record("parse", 0.000012, "CPgI")
+    record("parse", 0.000020)
+    assert stage_histograms["parse"].count == 2 and code_histograms[("parse", "CPgI")].count == 1
+    dump()
+
+    start = time.perf_counter()
+    for _ in range(100000):
+        record("dispatch", 0.000015, "DCut")
+    print(f"record(): {(time.perf_counter() - start) / 100000 * 1000000:.2f} us")
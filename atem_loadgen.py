@@ -0,0 +1,411 @@
+# ATEM load generator:
+# Simulates a swarm of ATEM clients on loopback against a running server.
+# Control panels send a mix of switching commands, tally boxes just listen
+# (and ack) like the real thing. Reports throughput, command latency
+# (command sent -> acked by the server), retransmits and drops.
+#
+# python atem_server.py
+# python atem_loadgen.py --panels 20 --tally 200 --duration 10
+# python atem_loadgen.py --panels 500 --mix CPgI=4,CPvI=4,DCut=1,DAut=1 --rate 2 --workers 4
+
+import argparse
+import heapq
+import multiprocessing
+import random
+import selectors
+import socket
+import time
+
+import atem_commands
+from atem_commands import CMD_HEADER, CMD_HEADER_SIZE
+from atem_packet import PACKET_HEADER, PACKET_HEADER_SIZE, ATEMFlags
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+INIT_PAYLOAD = b'\x01\x00\x00\x00\x00\x00\x00\x00'
+PACKET_ID_MASK = 0x7FFF
+COMMAND_RESEND_INTERVAL = 0.5   # seconds, same as the server
+RECEIVE_BUFFER_SIZE = 2048
+
+# client states
+CONNECTING = 0      # init sent, waiting for the init response
+SETUP = 1           # init acked, receiving the setup dump
+ESTABLISHED = 2     # got InCm, the setup dump is complete
+FAILED = 3          # handshake timed out or the server dropped the client
+
+
+def make_packet(flags, session_id, acked_packet_id=0, packet_id=0, payload=b''):
+    length = PACKET_HEADER_SIZE + len(payload)
+    return PACKET_HEADER.pack((flags << 11) | length, session_id, acked_packet_id, packet_id) + payload
+
+
+def make_command(code, me, video_source):
+    """
+    Encode one client command with the server's own command codecs
+    """
+    cmd = atem_commands.commands_list[code]()
+    # the ME (or the DSK for DDsA)
+    setattr(cmd, cmd.content_fields[0], me)
+    if 'video_source' in cmd.content_fields:
+        cmd.video_source = video_source
+    cmd.to_bytes()
+    return bytes(cmd.bytes)
+
+
+def parse_mix(mix):
+    """
+    "CPgI=4,CPvI=4,DCut=1" -> (["CPgI", "CPvI", "DCut"], [4, 4, 1])
+    """
+    codes = []
+    weights = []
+    for item in mix.split(','):
+        code, _, weight = item.partition('=')
+        code = code.strip()
+        if code not in atem_commands.commands_list:
+            raise ValueError(f"unknown command in mix: {code} (known: {', '.join(atem_commands.commands_list)})")
+        codes.append(code)
+        weights.append(float(weight) if weight else 1.0)
+    return codes, weights
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class SwarmStats(object):
+    # Results of one swarm (one worker process). Plain lists and counters
+    # so it can be sent back from a worker and merged.
+    def __init__(self):
+        self.clients = 0
+        self.connected = 0
+        self.connect_times = []
+        self.failed = 0
+        self.dropped_clients = 0
+        self.commands_sent = 0
+        self.commands_acked = 0
+        self.commands_dropped = 0
+        self.latencies = {}         # code -> [seconds]
+        self.client_resends = 0
+        self.server_retransmits = 0
+        self.packets_received = 0
+        self.bytes_received = 0
+        self.packets_lost = 0
+        self.tally_updates = 0
+        self.elapsed = 0.0
+
+    def merge(self, other):
+        for name, value in vars(other).items():
+            if name == 'latencies':
+                for code, latencies in value.items():
+                    self.latencies.setdefault(code, []).extend(latencies)
+            elif name == 'elapsed':
+                self.elapsed = max(self.elapsed, value)
+            else:
+                setattr(self, name, getattr(self, name) + value)
+
+
+class VirtualClient(object):
+    def __init__(self, server_addr, is_panel, loss=0.0):
+        self.server_addr = server_addr
+        self.is_panel = is_panel
+        # fraction of the packets from the server to drop, like a lossy network
+        self.loss = loss
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.sock.bind(("127.0.0.1", 0))
+        self.state = CONNECTING
+        self.session_id = random.randint(0x0001, 0x7FFF)
+        self.initial_session_id = self.session_id
+        self.start_time = 0
+        self.handshake_send_time = 0
+        # set once the first packet of the setup dump arrives
+        self.setup_started = False
+        # highest server packet id received that still has to be acked
+        self.packet_id_to_ack = None
+        self.next_packet_id = 1
+        # commands waiting for their ack: packet id -> [first send time, last send time, code, packet]
+        self.in_flight = {}
+
+    def connect(self, now):
+        self.start_time = now
+        self.handshake_send_time = now
+        self.sock.sendto(make_packet(ATEMFlags.INIT, self.session_id, payload=INIT_PAYLOAD), self.server_addr)
+
+    def retry_handshake(self, now):
+        # UDP, so the init or the ack of the init response can get lost
+        if now - self.handshake_send_time < COMMAND_RESEND_INTERVAL:
+            return
+        if self.state == CONNECTING:
+            self.handshake_send_time = now
+            self.sock.sendto(make_packet(ATEMFlags.INIT, self.session_id, payload=INIT_PAYLOAD), self.server_addr)
+        elif self.state == SETUP and not self.setup_started:
+            self.handshake_send_time = now
+            self.sock.sendto(make_packet(ATEMFlags.ACK, self.initial_session_id), self.server_addr)
+
+    def receive(self, buf, now, stats):
+        while True:
+            try:
+                nbytes = self.sock.recv_into(buf)
+            except (BlockingIOError, InterruptedError):
+                break
+            except ConnectionError:
+                # Windows reports the server port being closed here
+                break
+            if self.loss and random.random() < self.loss:
+                stats.packets_lost += 1
+                continue
+            if nbytes >= PACKET_HEADER_SIZE:
+                self.handle_packet(memoryview(buf)[:nbytes], now, stats)
+        if self.packet_id_to_ack is not None:
+            # one ack covers every packet received so far
+            self.sock.sendto(make_packet(ATEMFlags.ACK, self.session_id, self.packet_id_to_ack), self.server_addr)
+            self.packet_id_to_ack = None
+
+    def handle_packet(self, data, now, stats):
+        stats.packets_received += 1
+        stats.bytes_received += len(data)
+        flags_and_size, session_id, acked_packet_id, packet_id = PACKET_HEADER.unpack_from(data, 0)
+        if session_id != self.session_id:
+            # for an earlier client that had the same port (the server only
+            # drops clients after a few seconds of silence)
+            return
+        flags = flags_and_size >> 11
+        if flags & ATEMFlags.RETRANSMITION:
+            stats.server_retransmits += 1
+
+        if flags & ATEMFlags.INIT:
+            if self.state == CONNECTING:
+                # init response, the client id is baked into the session id from now on
+                client_id = int.from_bytes(data[PACKET_HEADER_SIZE + 2:PACKET_HEADER_SIZE + 4], 'big')
+                self.sock.sendto(make_packet(ATEMFlags.ACK, self.session_id), self.server_addr)
+                self.session_id = 0x8000 + client_id
+                self.state = SETUP
+            elif self.state == ESTABLISHED:
+                # goodbye from the server, it has dropped this client
+                self.state = FAILED
+                stats.dropped_clients += 1
+            return
+
+        if flags & ATEMFlags.ACK:
+            # Acks are cumulative: one packet can carry the responses to
+            # several commands and ack the newest. in_flight is in send order.
+            while self.in_flight:
+                packet_id = next(iter(self.in_flight))
+                if (acked_packet_id - packet_id) & PACKET_ID_MASK >= (PACKET_ID_MASK + 1) // 2:
+                    break
+                first_send_time, last_send_time, code, packet = self.in_flight.pop(packet_id)
+                stats.commands_acked += 1
+                stats.latencies.setdefault(code, []).append(now - first_send_time)
+
+        if flags & ATEMFlags.COMMAND:
+            self.packet_id_to_ack = packet_id
+            if self.state == ESTABLISHED:
+                if not self.is_panel and flags_and_size & 0x07FF > PACKET_HEADER_SIZE:
+                    stats.tally_updates += 1
+            elif self.state == SETUP:
+                self.setup_started = True
+                # the setup dump ends with InCm
+                offset = PACKET_HEADER_SIZE
+                while offset + CMD_HEADER_SIZE <= len(data):
+                    cmd_length, code = CMD_HEADER.unpack_from(data, offset)
+                    if code == b'InCm':
+                        self.state = ESTABLISHED
+                        stats.connected += 1
+                        stats.connect_times.append(now - self.start_time)
+                    if cmd_length < CMD_HEADER_SIZE:
+                        break
+                    offset += cmd_length
+
+    def send_command(self, code, payload, now, stats):
+        packet_id = self.next_packet_id
+        self.next_packet_id = (self.next_packet_id + 1) & PACKET_ID_MASK
+        packet = make_packet(ATEMFlags.COMMAND, self.session_id, 0, packet_id, payload)
+        self.sock.sendto(packet, self.server_addr)
+        self.in_flight[packet_id] = [now, now, code, packet]
+        stats.commands_sent += 1
+
+    def resend_commands(self, now, timeout, stats):
+        for packet_id, entry in list(self.in_flight.items()):
+            first_send_time, last_send_time, code, packet = entry
+            if now - first_send_time > timeout:
+                del self.in_flight[packet_id]
+                stats.commands_dropped += 1
+            elif now - last_send_time > COMMAND_RESEND_INTERVAL:
+                flags_and_size = int.from_bytes(packet[:2], 'big') | (ATEMFlags.RETRANSMITION << 11)
+                self.sock.sendto(flags_and_size.to_bytes(2, 'big') + packet[2:], self.server_addr)
+                entry[1] = now
+                stats.client_resends += 1
+
+
+def run_swarm(host, port, num_panels, num_tally, duration, mix, rate, window, num_inputs, mes,
+              connect_rate, timeout, seed, loss=0.0):
+    """
+    Connect the clients, let the panels send commands for duration seconds,
+    then wait for the last acks. Returns a SwarmStats.
+    """
+    random.seed(seed)
+    server_addr = (host, port)
+    stats = SwarmStats()
+    codes, weights = parse_mix(mix)
+    clients = [VirtualClient(server_addr, i < num_panels, loss) for i in range(num_panels + num_tally)]
+    stats.clients = len(clients)
+    sel = selectors.DefaultSelector()
+    for client in clients:
+        sel.register(client.sock, selectors.EVENT_READ, client)
+    buf = bytearray(RECEIVE_BUFFER_SIZE)
+
+    # connect, at most connect_rate new clients a second
+    start = time.perf_counter()
+    to_connect = list(clients)
+    while True:
+        now = time.perf_counter()
+        while to_connect and len(clients) - len(to_connect) < (now - start) * connect_rate + 1:
+            to_connect.pop().connect(now)
+        for key, _ in sel.select(0.01):
+            key.data.receive(buf, time.perf_counter(), stats)
+        pending = [c for c in clients if c.state in (CONNECTING, SETUP)]
+        if not pending and not to_connect:
+            break
+        now = time.perf_counter()
+        for client in pending:
+            if not client.start_time:
+                continue
+            if now - client.start_time > timeout:
+                client.state = FAILED
+                stats.failed += 1
+            else:
+                client.retry_handshake(now)
+
+    # send commands: every panel sends at rate commands/s on average
+    # (exponential gaps), with at most window commands waiting for an ack
+    panels = [c for c in clients if c.is_panel and c.state == ESTABLISHED]
+    start = time.perf_counter()
+    # (next send time, panel number) so only the panels that are due get looked at
+    send_times = [(start + random.expovariate(rate), i) for i in range(len(panels))]
+    heapq.heapify(send_times)
+    last_resend_check = start
+    while True:
+        now = time.perf_counter()
+        sending = now - start < duration
+        if not sending and not any(c.in_flight for c in clients if c.state == ESTABLISHED):
+            break
+        if now - start > duration + timeout:
+            break
+        while sending and send_times and send_times[0][0] <= now:
+            send_time, i = heapq.heappop(send_times)
+            panel = panels[i]
+            if panel.state != ESTABLISHED:
+                continue
+            if len(panel.in_flight) < window:
+                code = random.choices(codes, weights)[0]
+                payload = make_command(code, random.randrange(mes), random.randint(1, num_inputs))
+                panel.send_command(code, payload, now, stats)
+            heapq.heappush(send_times, (now + random.expovariate(rate), i))
+        for key, _ in sel.select(0.005):
+            key.data.receive(buf, time.perf_counter(), stats)
+        if now - last_resend_check > 0.1:
+            for client in clients:
+                if client.state == ESTABLISHED:
+                    client.resend_commands(now, timeout, stats)
+            last_resend_check = now
+    stats.elapsed = time.perf_counter() - start
+
+    for client in clients:
+        if client.state == ESTABLISHED:
+            stats.commands_dropped += len(client.in_flight)
+        sel.unregister(client.sock)
+        client.sock.close()
+    return stats
+
+
+def run_worker(args):
+    return run_swarm(*args)
+
+
+def raise_file_limit(num_sockets):
+    # every virtual client has its own socket
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = num_sockets + 64
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        if hard != resource.RLIM_INFINITY:
+            wanted = min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+
+def print_report(stats):
+    print(f"clients: {stats.connected}/{stats.clients} connected, {stats.failed} failed to connect, "
+          f"{stats.dropped_clients} dropped by the server")
+    connect_times = sorted(stats.connect_times)
+    print(f"connect time: p50 {percentile(connect_times, 0.50) * 1000:.1f} ms, "
+          f"p99 {percentile(connect_times, 0.99) * 1000:.1f} ms")
+    elapsed = stats.elapsed or 1.0
+    print(f"commands: {stats.commands_sent} sent, {stats.commands_acked} acked "
+          f"({stats.commands_acked / elapsed:.0f}/s), {stats.commands_dropped} dropped")
+    all_latencies = sorted(latency for latencies in stats.latencies.values() for latency in latencies)
+    print(f"latency: p50 {percentile(all_latencies, 0.50) * 1000:.2f} ms, "
+          f"p90 {percentile(all_latencies, 0.90) * 1000:.2f} ms, "
+          f"p99 {percentile(all_latencies, 0.99) * 1000:.2f} ms")
+    for code in sorted(stats.latencies):
+        latencies = sorted(stats.latencies[code])
+        print(f"  {code}: {len(latencies):8d} acked, p50 {percentile(latencies, 0.50) * 1000:.2f} ms, "
+              f"p99 {percentile(latencies, 0.99) * 1000:.2f} ms")
+    print(f"retransmits: {stats.server_retransmits} by the server, {stats.client_resends} by the clients"
+          + (f", {stats.packets_lost} packets from the server dropped (--loss)" if stats.packets_lost else ""))
+    print(f"packets received: {stats.packets_received} ({stats.packets_received / elapsed:.0f}/s), "
+          f"{stats.bytes_received / 1000:.0f} KB ({stats.bytes_received / elapsed / 1000:.0f} KB/s), "
+          f"tally box updates: {stats.tally_updates} ({stats.tally_updates / elapsed:.0f}/s)")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Simulate a swarm of ATEM clients against a server")
+    ap.add_argument("--host", default="127.0.0.1", help="server address, default=127.0.0.1")
+    ap.add_argument("--port", type=int, default=9910, help="server port, default=9910")
+    ap.add_argument("--panels", type=int, default=10, help="control panels sending commands, default=10")
+    ap.add_argument("--tally", type=int, default=100, help="tally boxes (listen only), default=100")
+    ap.add_argument("--duration", type=float, default=10.0, help="seconds to send commands for, default=10")
+    ap.add_argument("--mix", default="CPgI=4,CPvI=4,DCut=1,DAut=1", help="command mix as code=weight, default=CPgI=4,CPvI=4,DCut=1,DAut=1")
+    ap.add_argument("--rate", type=float, default=5.0, help="commands per second per panel, default=5")
+    ap.add_argument("--window", type=int, default=4, help="commands a panel can have waiting for an ack, default=4")
+    ap.add_argument("--inputs", type=int, default=8, help="sources are picked from inputs 1..INPUTS, default=8")
+    ap.add_argument("--mes", type=int, default=1, help="number of MEs to send commands to, default=1")
+    ap.add_argument("--connect-rate", type=float, default=500.0, help="new connections per second, default=500")
+    ap.add_argument("--timeout", type=float, default=5.0, help="seconds before a connect or command counts as failed, default=5")
+    ap.add_argument("--workers", type=int, default=1, help="processes to spread the clients over, default=1")
+    ap.add_argument("--seed", type=int, default=None, help="random seed")
+    ap.add_argument("--loss", type=float, default=0.0, help="fraction of the server's packets the clients drop, to simulate a lossy network, default=0")
+    args = ap.parse_args()
+
+    parse_mix(args.mix)
+    workers = max(1, args.workers)
+    raise_file_limit((args.panels + args.tally) // workers + 1)
+    seed = args.seed if args.seed is not None else random.randrange(1 << 30)
+    jobs = []
+    for i in range(workers):
+        # spread the clients as evenly as possible
+        num_panels = args.panels // workers + (i < args.panels % workers)
+        num_tally = args.tally // workers + (i < args.tally % workers)
+        jobs.append((args.host, args.port, num_panels, num_tally, args.duration, args.mix, args.rate,
+                     args.window, args.inputs, args.mes, args.connect_rate / workers, args.timeout, seed + i, args.loss))
+    print(f"{args.panels} panels, {args.tally} tally boxes, {workers} worker(s) -> {args.host}:{args.port}")
+    if workers == 1:
+        results = [run_worker(jobs[0])]
+    else:
+        with multiprocessing.Pool(workers, initializer=raise_file_limit, initargs=(jobs[0][2] + jobs[0][3],)) as pool:
+            results = pool.map(run_worker, jobs)
+    stats = SwarmStats()
+    for result in results:
+        stats.merge(result)
+    print_report(stats)
+
+
+if __name__ == "__main__":
+    main()
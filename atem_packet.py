@@ -5,7 +5,10 @@ import time
 import atem_commands
 
 
-PACKET_HEADER_SIZE = 12
+# flags (5 bits) and packet length (11 bits), session id, acked packet id,
+# 4 unknown bytes, packet id
+PACKET_HEADER = struct.Struct('!3H 4x H')
+PACKET_HEADER_SIZE = PACKET_HEADER.size
 
 class ATEMFlags:
     COMMAND = 0x01
@@ -16,9 +19,12 @@ class ATEMFlags:
 
 class Packet(object):
     def __init__(self, ip_and_port=('', 0), raw_packet=b''):
-        # raw packet data
+        # raw packet data. This is not copied: an inbound packet (and its
+        # commands) reference the receive buffer directly, so call
+        # materialize() on anything that has to be kept after the receive
+        # buffer gets reused.
         self.ip_and_port = ip_and_port
-        self.bytes = bytearray(raw_packet)
+        self.bytes = raw_packet
 
         # parsed packet data
         self.flags = 0x00
@@ -31,58 +37,73 @@ class Packet(object):
         # extra stuff
         self.timestamp = time.monotonic()
         self.last_send_timestamp = 0
+        self.send_count = 0         # times it has been sent, to tell the current resend queue entry from stale ones
+        self.acked = False
         self.raw_cmd_data = None    # if this is not None then use this instead of commands. Used mainly for init packets.
+        self.trace = None           # latency stats for a response packet, see CommandCarrier.trace
         
     def parse_packet(self):
-        flags_and_size = struct.unpack_from('!H', self.bytes, 0)[0]
+        flags_and_size, self.session_id, self.ACKed_packet_id, self.packet_id = PACKET_HEADER.unpack_from(self.bytes, 0)
         self.flags = (flags_and_size >> 11) & 0x001F
-        self.packet_length = flags_and_size & 0x007F
-        self.session_id, self.ACKed_packet_id, self.packet_id = struct.unpack_from('!2H 4x H', self.bytes, 2)
+        self.packet_length = flags_and_size & 0x07FF
         if self.packet_length > PACKET_HEADER_SIZE:
             # deal with commands
+            # The commands get memoryview slices of the packet rather than copies
+            packet_view = self.bytes if isinstance(self.bytes, memoryview) else memoryview(self.bytes)
             bytes_remaining = self.packet_length - PACKET_HEADER_SIZE
             packet_offset = PACKET_HEADER_SIZE
             if self.flags & ATEMFlags.INIT:
                 # for INIT packets, just put the command data into raw_cmd_data
-                self.raw_cmd_data = self.bytes[PACKET_HEADER_SIZE:]
+                self.raw_cmd_data = packet_view[PACKET_HEADER_SIZE:]
             else:
                 while bytes_remaining > 0:
                     # Iterate through the packet commands and create a list of
                     # command objects
-                    cmd_length, cmd_raw_name = struct.unpack_from('!H 2x 4s', self.bytes, packet_offset)
-                    cmd_name = cmd_raw_name.decode('utf-8')
-                    cmd_bytes = self.bytes[packet_offset:(packet_offset + cmd_length)]
-                    cmd_obj = atem_commands.get_command_object(cmd_bytes, cmd_name)
-                    cmd_obj.parse_cmd()
-                    self.commands.append(cmd_obj)
+                    cmd_length, cmd_raw_name = atem_commands.CMD_HEADER.unpack_from(self.bytes, packet_offset)
+                    if cmd_length < 8:
+                        # malformed command, don't try to parse the rest of the packet
+                        break
+                    # Unknown commands are skipped without being decoded
+                    cmd_class = atem_commands.get_command_class(cmd_raw_name.decode('latin-1'))
+                    if cmd_class is not None:
+                        cmd_obj = cmd_class(packet_view[packet_offset:(packet_offset + cmd_length)])
+                        cmd_obj.parse_cmd()
+                        self.commands.append(cmd_obj)
                     packet_offset += cmd_length
                     bytes_remaining -= cmd_length
 
+    def materialize(self):
+        """
+        Copy the packet data (and the commands) out of the receive buffer so
+        the packet can be kept after the buffer has been reused.
+        """
+        self.bytes = bytes(self.bytes)
+        if self.raw_cmd_data is not None:
+            self.raw_cmd_data = bytes(self.raw_cmd_data)
+        for cmd in self.commands:
+            cmd.materialize()
+
     def to_bytes(self):
-        #temp = self.bytes
-        self.bytes = bytearray()
         if type(self.commands) != list:
             self.commands = [self.commands]
         if len(self.commands) > 0:
             self.flags |= ATEMFlags.COMMAND
-        flags = ((self.flags & 0x001F) << 11)
-        self.bytes += struct.pack('!H', flags)
-        self.bytes += struct.pack('!2H 4x H', self.session_id, self.ACKed_packet_id, self.packet_id)
-        self.packet_length = PACKET_HEADER_SIZE
+        # size the packet first so the header and the commands can be
+        # packed straight into one buffer
+        if self.raw_cmd_data != None:
+            self.packet_length = PACKET_HEADER_SIZE + len(self.raw_cmd_data)
+        else:
+            self.packet_length = PACKET_HEADER_SIZE + sum(cmd.get_length() for cmd in self.commands)
+        self.bytes = bytearray(self.packet_length)
+        flags_and_size = ((self.flags & 0x001F) << 11) | (self.packet_length & 0x07FF)
+        PACKET_HEADER.pack_into(self.bytes, 0, flags_and_size, self.session_id, self.ACKed_packet_id, self.packet_id)
         if self.raw_cmd_data != None:
-            self.bytes += self.raw_cmd_data
-            self.packet_length += len(self.raw_cmd_data)
+            self.bytes[PACKET_HEADER_SIZE:] = self.raw_cmd_data
         else:
+            offset = PACKET_HEADER_SIZE
             for cmd in self.commands:
-                cmd.to_bytes()
-                self.bytes += cmd.bytes
-                self.packet_length += cmd.length
-        # now add length of packet
-        flags_and_size = struct.unpack_from('!H', self.bytes, 0)[0]
-        flags_and_size |= (self.packet_length & 0x07FF)
-        struct.pack_into('!H', self.bytes, 0, flags_and_size)
-        #print(f"b1 = {temp}")
-        #print(f"b2 = {self.bytes}")
+                cmd.length = cmd.pack_into(self.bytes, offset)
+                offset += cmd.length
         assert(self.packet_length == len(self.bytes))
 
 
@@ -0,0 +1,304 @@
+# State persistence:
+# Saves the switcher state (atem_config.state) so a restarted server carries
+# on where it left off, without ever blocking the server loop on the disk.
+#
+# Every state change reports the object that changed to
+# atem_config.state_changed(), which hands it to the StateJournal. All the
+# server loop does is copy the object's persisted_fields into a tuple and
+# queue it. A writer thread appends what is queued to the journal file
+# (a run of pickled batches of (path, values) records) and fsyncs it every
+# JOURNAL_FSYNC_INTERVAL.
+#
+# The writer keeps its own copy of the saved state, built from the
+# records, so every COMPACT_RECORDS records it writes that out as the new
+# snapshot and starts an empty journal, without having to look at the
+# live state. Replaying is snapshot first, then the journal. A record holds
+# the object's whole value rather than a change to it, so replaying the
+# journal over a snapshot that already has it (a crash between the two
+# steps of a compaction) comes out the same, and a batch that was only half
+# written when the server died just ends the replay.
+#
+# python atem_server.py --state-file switcher.state
+
+import os
+import pickle
+import queue
+import threading
+import time
+
+import atem_config
+
+
+JOURNAL_FSYNC_INTERVAL = 1.0    # seconds, most a power cut can lose
+COMPACT_RECORDS = 10000         # journal records before it's compacted into a new snapshot
+# first thing in the snapshot, bump it if what gets saved changes
+STATE_SNAPSHOT_VERSION = 1
+
+
+def capture_state():
+    # path -> values for every object in the state
+    return atem_config.get_state_values()
+
+
+def apply_values(path, values):
+    obj = atem_config.get_state_object(path)
+    if obj is None:
+        # eg. an ME the config file in use now doesn't have
+        return
+    for name, value in zip(obj.persisted_fields, values):
+        setattr(obj, name, value)
+
+
+def apply_record(record):
+    path, values = record
+    if path is None:
+        # the whole state
+        for path, values in values.items():
+            apply_values(path, values)
+    else:
+        apply_values(path, values)
+
+
+def read_records(journal_file):
+    """
+    The records in the journal, up to the first batch that can't be read
+    (the one being written when the server stopped)
+    """
+    records = []
+    try:
+        f = open(journal_file, 'rb')
+    except FileNotFoundError:
+        return records
+    with f:
+        while True:
+            try:
+                records.extend(pickle.load(f))
+            except EOFError:
+                break
+            except Exception as e:
+                print(f"State journal {journal_file} ends with an incomplete write ({e}), replayed up to there")
+                break
+    return records
+
+
+def restore_state(state_file):
+    """
+    Put the saved state (snapshot, then journal) into atem_config.state.
+    Returns the number of journal records replayed, None if there was
+    nothing saved.
+    """
+    try:
+        with open(state_file, 'rb') as f:
+            version, objects = pickle.load(f)
+    except FileNotFoundError:
+        version, objects = None, None
+    if objects is not None:
+        if version != STATE_SNAPSHOT_VERSION:
+            print(f"Ignoring state snapshot {state_file}: version {version}, not {STATE_SNAPSHOT_VERSION}")
+            return None
+        apply_record((None, objects))
+    records = read_records(state_file + ".journal")
+    for record in records:
+        apply_record(record)
+    if objects is None and not records:
+        return None
+    atem_config.state_changed()
+    return len(records)
+
+
+class StateJournal(object):
+    """
+    Queues the state changes and writes them to the journal in a writer
+    thread. atem_config.state_journal while it's open.
+    """
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.journal_file = state_file + ".journal"
+        # (path, values), (None, whole state) or None to stop the writer
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        # the writer's copy of the saved state, path -> values
+        self.objects = {}
+        self.records_since_compaction = 0
+        # for monitoring (written by the writer thread)
+        self.records_queued = 0
+        self.records_written = 0
+        self.bytes_written = 0
+        self.compactions = 0
+        self.fsyncs = 0
+
+    def record(self, changed):
+        # server loop: queue the object's values (the whole state if changed is None)
+        if changed is None:
+            self.queue.put((None, capture_state()))
+        else:
+            self.queue.put((atem_config.get_state_path(changed),
+                            tuple(getattr(changed, name) for name in changed.persisted_fields)))
+        self.records_queued += 1
+
+    def start(self):
+        # starts with a snapshot of the state as it is now and an empty journal
+        self.objects = capture_state()
+        self.write_snapshot()
+        self.journal = open(self.journal_file, 'wb')
+        self.thread = threading.Thread(target=self.run, name="state journal", daemon=True)
+        self.thread.start()
+
+    def close(self):
+        """
+        Write out everything that's queued and leave a compacted snapshot
+        """
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        last_sync_time = time.monotonic()
+        unsynced = False
+        stopping = False
+        while not stopping:
+            try:
+                batch = [self.queue.get(timeout=JOURNAL_FSYNC_INTERVAL)]
+            except queue.Empty:
+                batch = []
+            # everything else that's waiting goes in the same write
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch and batch[-1] is None:
+                stopping = True
+                batch.pop()
+            if batch:
+                data = pickle.dumps(batch, pickle.HIGHEST_PROTOCOL)
+                self.journal.write(data)
+                self.journal.flush()
+                unsynced = True
+                for path, values in batch:
+                    if path is None:
+                        self.objects = values
+                    else:
+                        self.objects[path] = values
+                self.records_written += len(batch)
+                self.bytes_written += len(data)
+                self.records_since_compaction += len(batch)
+            if stopping or self.records_since_compaction >= COMPACT_RECORDS:
+                self.compact()
+                unsynced = False
+                last_sync_time = time.monotonic()
+            elif unsynced and time.monotonic() - last_sync_time >= JOURNAL_FSYNC_INTERVAL:
+                os.fsync(self.journal.fileno())
+                self.fsyncs += 1
+                unsynced = False
+                last_sync_time = time.monotonic()
+        self.journal.close()
+
+    def compact(self):
+        # the writer's copy of the state becomes the snapshot, then the journal starts again
+        self.write_snapshot()
+        self.journal.seek(0)
+        self.journal.truncate()
+        self.records_since_compaction = 0
+        self.compactions += 1
+
+    def write_snapshot(self):
+        temp_file = f"{self.state_file}.tmp"
+        with open(temp_file, 'wb') as f:
+            pickle.dump((STATE_SNAPSHOT_VERSION, self.objects), f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, self.state_file)
+
+
+def open_state(state_file):
+    """
+    Restore the state saved in state_file (if there is one) into the state
+    loaded from the config file, then save every change from now on.
+    Returns the StateJournal, which is close()d at shutdown.
+    """
+    replayed = restore_state(state_file)
+    if replayed is not None:
+        print(f"Restored the switcher state from {state_file} ({replayed} journal records)")
+    return start_journal(state_file)
+
+
+def start_journal(state_file):
+    # save the state as it is now and every change from now on, into state_file
+    journal = StateJournal(state_file)
+    journal.start()
+    atem_config.state_journal = journal
+    return journal
+
+
+def close_state():
+    # stop saving the active state (see open_state)
+    journal = atem_config.state_journal
+    if journal is not None:
+        atem_config.state_journal = None
+        journal.close()
+
+
+if __name__ == "__main__":
+    # Quick test: changes survive a restart, through a compaction and a
+    # journal that ends in the middle of a write
+    import tempfile
+    import atem_commands
+
+    temp_dir = tempfile.mkdtemp()
+    state_file = os.path.join(temp_dir, "switcher.state")
+    atem_config.config_init("default_config.xml")
+    open_state(state_file)
+    me = atem_config.state.mes[0]
+    for source in (1, 2, 3):
+        cmd = atem_commands.Cmd_CPgI()
+        cmd.me, cmd.video_source = 0, source
+        cmd.update_state()
+    cut = atem_commands.Cmd_DCut()
+    cut.me = 0
+    cut.update_state()
+    expected = capture_state()
+    assert expected[('mes', 0)][:2] == (me.program_input, me.preview_input)
+    journal = atem_config.state_journal
+    # the server loop only queues, the writer catches up
+    while journal.records_written < journal.records_queued:
+        time.sleep(0.01)
+    assert read_records(state_file + ".journal")[-1] == (('mes', 0), expected[('mes', 0)])
+
+    # restart (as if the server had died, so no compaction): back to the
+    # config file, then the journal on top
+    atem_config.state_journal = None
+    atem_config.config_init("default_config.xml")
+    assert capture_state() != expected
+    assert restore_state(state_file) == 4
+    assert capture_state() == expected
+
+    # half a batch on the end is left out
+    with open(state_file + ".journal", 'ab') as f:
+        f.write(pickle.dumps([(('mes', 0), expected[('mes', 0)])])[:-5])
+    atem_config.config_init("default_config.xml")
+    assert restore_state(state_file) == 4 and capture_state() == expected
+
+    # compaction: the snapshot alone has the state
+    atem_config.config_init("default_config.xml")
+    COMPACT_RECORDS = 10
+    open_state(state_file)
+    for source in range(1, 26):
+        cmd = atem_commands.Cmd_CPvI()
+        cmd.me, cmd.video_source = 0, source % 8 + 1
+        cmd.update_state()
+    journal = atem_config.state_journal
+    while journal.records_written < journal.records_queued:
+        time.sleep(0.01)
+    assert journal.compactions >= 1
+    close_state()
+    assert journal.records_written == 25 and os.path.getsize(state_file + ".journal") == 0
+    expected = capture_state()
+    atem_config.config_init("default_config.xml")
+    assert restore_state(state_file) == 0 and capture_state() == expected
+    print(f"state saved and restored ({journal.records_written} records, {journal.bytes_written} bytes, "
+          f"{journal.compactions} compactions)")
+    import shutil
+    shutil.rmtree(temp_dir)
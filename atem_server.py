@@ -3,25 +3,417 @@
 # processes the commands received
 
 
+import os
 import socket
 import argparse
 import sys
 import select
+import asyncio
+import time
+import multiprocessing
+import signal
 
-from client_manager import ClientManager
+import client_manager
+from client_manager import ClientManager, CLIENT_UPDATE_INTERVAL
 from atem_packet import Packet
 import atem_config
+import atem_commands
+import atem_latency
+import atem_shard
+import atem_switcher
+import atem_persist
+
+
+
+class ATEMServerProtocol(asyncio.DatagramProtocol):
+    """
+    asyncio version of the server loop. Inbound packets are processed as soon
+    as they arrive and the clients with something to send are updated
+    straight after. Each client has a timer for its next bit of maintenance
+    (resend, keepalive, dropout) so idle clients don't get polled, and the
+    scheduled command carriers (eg. transitions) are sent by a task that
+    sleeps until the next one is due.
+    """
+    def __init__(self, client_mgr: ClientManager, switcher=None, reloader=None):
+        self.client_mgr = client_mgr
+        # the atem_switcher.VirtualSwitcher this is the socket for, when the
+        # process is running more than one switcher
+        self.switcher = switcher
+        # ConfigReloader for the switcher's config file
+        self.reloader = reloader
+        self.transport = None
+        self.loop = None
+        # client -> asyncio.TimerHandle for the client's next update
+        self.client_timers = {}
+        self.clients_to_update = set()
+        self.update_pending = False
+        self.schedule_changed = asyncio.Event()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.loop = asyncio.get_running_loop()
+
+    def activate_switcher(self):
+        # the commands (and the transitions) work on the active switcher's state
+        if self.switcher is not None:
+            self.switcher.activate()
+
+    def datagram_received(self, data, addr):
+        self.activate_switcher()
+        packet = Packet(addr, data)
+        packet.parse_packet()
+        if atem_latency.enabled:
+            atem_latency.record("parse", time.monotonic() - packet.timestamp, packet.commands[0].code if packet.commands else None)
+        client = self.client_mgr.get_client(packet.ip_and_port, packet.session_id)
+        next_scheduled_time = self.client_mgr.get_next_scheduled_time()
+        client.process_inbound_packet(packet)
+        self.clients_to_update.add(client)
+        self.queue_updates(next_scheduled_time)
+
+    def state_relay_ready(self):
+        # commands from the sequencer when this is one of several workers
+        next_scheduled_time = self.client_mgr.get_next_scheduled_time()
+        self.client_mgr.state_relay.receive()
+        self.queue_updates(next_scheduled_time)
+
+    def queue_updates(self, next_scheduled_time):
+        if self.client_mgr.get_next_scheduled_time() != next_scheduled_time:
+            self.schedule_changed.set()
+        self.clients_to_update.update(self.client_mgr.updated_clients)
+        self.client_mgr.updated_clients.clear()
+        # Update the clients once the datagrams that have already arrived have
+        # been processed, so a burst only updates each client once.
+        if not self.update_pending:
+            self.update_pending = True
+            self.loop.call_soon(self.update_clients)
+
+    def check_config(self):
+        # reload the config file if SIGHUP asked for it or it has changed
+        self.activate_switcher()
+        next_scheduled_time = self.client_mgr.get_next_scheduled_time()
+        if self.reloader.poll(self.loop.time()):
+            self.queue_updates(next_scheduled_time)
+
+    async def watch_config(self):
+        # look for changes to the config file (--watch-config)
+        while True:
+            await asyncio.sleep(atem_config.CONFIG_WATCH_INTERVAL)
+            self.check_config()
+
+    def error_received(self, exc):
+        print(f"socket error: {exc}")
+
+    def update_clients(self):
+        self.update_pending = False
+        clients = self.clients_to_update
+        self.clients_to_update = set()
+        for client in clients:
+            self.update_client(client)
+
+    def update_client(self, client):
+        timer = self.client_timers.pop(client, None)
+        if timer is not None:
+            timer.cancel()
+        if self.client_mgr.update_client(client, self.transport):
+            # The client is still around, so set the timer for its next update.
+            # If that time has already passed (eg. it's waiting on an
+            # ack) then check back after the usual update interval.
+            next_time = client.get_next_update_time()
+            if next_time <= self.loop.time():
+                next_time = self.loop.time() + CLIENT_UPDATE_INTERVAL
+            self.client_timers[client] = self.loop.call_at(next_time, self.update_client, client)
+
+    async def run_scheduler(self):
+        # send the scheduled command carriers as they become due
+        while True:
+            self.activate_switcher()
+            self.schedule_changed.clear()
+            next_scheduled_time = self.client_mgr.get_next_scheduled_time()
+            if next_scheduled_time is None:
+                await self.schedule_changed.wait()
+                continue
+            try:
+                await asyncio.wait_for(self.schedule_changed.wait(), max(0, next_scheduled_time - self.loop.time()))
+            except asyncio.TimeoutError:
+                self.activate_switcher()
+                self.client_mgr.run_scheduler(self.loop.time())
+                clients = list(self.client_mgr.updated_clients)
+                self.client_mgr.updated_clients.clear()
+                for client in clients:
+                    self.update_client(client)
+
+
+def add_reload_signal_handler(loop, protocols):
+    # SIGHUP reloads the config files (not on Windows, it doesn't have SIGHUP)
+    def reload_requested():
+        for protocol in protocols:
+            protocol.reloader.request()
+            protocol.check_config()
+    if hasattr(signal, "SIGHUP"):
+        loop.add_signal_handler(signal.SIGHUP, reload_requested)
+
+
+async def run_asyncio_server(host, port, client_mgr: ClientManager, reuse_port=False, reloader=None):
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: ATEMServerProtocol(client_mgr, reloader=reloader), local_addr=(host, port), reuse_port=reuse_port)
+    if client_mgr.state_relay is not None:
+        loop.add_reader(client_mgr.state_relay.fileno(), protocol.state_relay_ready)
+    tasks = [protocol.run_scheduler()]
+    if reloader is not None:
+        add_reload_signal_handler(loop, [protocol])
+        if reloader.watch:
+            tasks.append(protocol.watch_config())
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        transport.close()
+
+
+async def run_asyncio_switchers(host, switchers, watch_config=False):
+    """
+    Run several virtual switchers (see atem_switcher) on the one event
+    loop, each on its own port with its own ClientManager.
+    """
+    loop = asyncio.get_running_loop()
+    transports = []
+    protocols = []
+    tasks = []
+    try:
+        for switcher in switchers:
+            reloader = atem_config.ConfigReloader(switcher.config_file, switcher.client_mgr.reload_config, watch_config)
+            transport, protocol = await loop.create_datagram_endpoint(
+                lambda switcher=switcher, reloader=reloader: ATEMServerProtocol(switcher.client_mgr, switcher, reloader),
+                local_addr=(host, switcher.port))
+            transports.append(transport)
+            protocols.append(protocol)
+            tasks.append(protocol.run_scheduler())
+            if watch_config:
+                tasks.append(protocol.watch_config())
+        add_reload_signal_handler(loop, protocols)
+        await asyncio.gather(*tasks)
+    finally:
+        for transport in transports:
+            transport.close()
+
+
+# Most datagrams to read in one go before the clients get updated
+MAX_PACKETS_PER_WAKEUP = 256
+RECEIVE_BUFFER_SIZE = 2048
+
+
+class OutboundBatch(object):
+    """
+    Stands in for the socket while the clients are updated so all the
+    packets for a tick are collected and then sent together by flush().
+    """
+    def __init__(self):
+        self.packets = []
+        # when the first packet of the batch came in, for the latency stats
+        self.batch_start_time = None
+        # packets the socket wouldn't take (eg. its buffer was full)
+        self.packets_dropped = 0
+
+    def sendto(self, data, addr):
+        if atem_latency.enabled and not self.packets:
+            self.batch_start_time = time.monotonic()
+        self.packets.append((data, addr))
+
+    def flush(self, sock: socket.socket):
+        # A packet the socket won't take is dropped like one lost on the
+        # network: the command packets get resent when they aren't acked.
+        try:
+            for data, addr in self.packets:
+                try:
+                    sock.sendto(data, addr)
+                except OSError as e:
+                    # (BlockingIOError included)
+                    self.packets_dropped += 1
+                    if self.packets_dropped == 1 or not isinstance(e, BlockingIOError):
+                        print(f"sendto {addr} failed: {e!r}, packet dropped")
+        finally:
+            self.packets.clear()
+            if self.batch_start_time is not None:
+                atem_latency.record("flush", time.monotonic() - self.batch_start_time)
+                self.batch_start_time = None
+
+
+def receive_packets(sock: socket.socket, buffers):
+    """
+    Read every datagram that is waiting on the (non-blocking) socket, up to
+    one per preallocated buffer. Returns a list of (nbytes, addr, buffer).
+    """
+    received = []
+    for buf in buffers:
+        try:
+            if hasattr(sock, "recvmsg_into"):
+                nbytes, ancdata, msg_flags, addr = sock.recvmsg_into([buf])
+            else:
+                # Windows doesn't have recvmsg
+                nbytes, addr = sock.recvfrom_into(buf)
+        except BlockingIOError:
+            break
+        received.append((nbytes, addr, buf))
+    return received
+
+
+def make_server_socket(host, port, reuse_port=False):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if reuse_port:
+        # several worker processes share the port
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    s.bind((host, port))
+    s.setblocking(False)
+    return s
 
 
+def run_select_server(host, port, client_mgr: ClientManager, reuse_port=False, reloader=None):
+    s = make_server_socket(host, port, reuse_port)
+    state_relay = client_mgr.state_relay
+    if reloader is not None and hasattr(signal, "SIGHUP"):
+        # SIGHUP reloads the config file (the loop does it, after the wait)
+        signal.signal(signal.SIGHUP, lambda signum, frame: reloader.request())
+    buffers = [bytearray(RECEIVE_BUFFER_SIZE) for _ in range(MAX_PACKETS_PER_WAKEUP)]
+    outbound = OutboundBatch()
+
+    while True:
+        # Process incoming packets but timeout after a while so the clients
+        # can perform cleanup and resend unresponded packets, or when the
+        # next scheduled command carrier is due.
+        readers, writers, errors = select.select([s] if state_relay is None else [s, state_relay], [], [], client_mgr.get_wait_time())
+        if state_relay in readers:
+            state_relay.receive()
+        if s in readers:
+            try:
+                # handle everything that's waiting, not just one datagram
+                for nbytes, addr, buf in receive_packets(s, buffers):
+                    packet = Packet(addr, memoryview(buf)[:nbytes])
+                    packet.parse_packet()
+                    if atem_latency.enabled:
+                        atem_latency.record("parse", time.monotonic() - packet.timestamp, packet.commands[0].code if packet.commands else None)
+                    client = client_mgr.get_client(packet.ip_and_port, packet.session_id)
+                    client.process_inbound_packet(packet)
+            except ConnectionResetError:
+                print("connection reset!")
+                s.close()
+                s = make_server_socket(host, port, reuse_port)
+                continue
+
+        if reloader is not None:
+            reloader.poll(time.monotonic())
+
+        # Update the clients that have something to send or whose timer is due
+        client_mgr.run_clients(outbound)
+        outbound.flush(s)
+
+
+def install_stats_signal_handler(client_mgrs):
+    # SIGUSR2 prints the clients' round trip times and retransmit counters
+    # (not on Windows, it doesn't have SIGUSR2)
+    def print_stats(signum, frame):
+        for client_mgr in client_mgrs:
+            client_mgr.print_stats(per_client=True)
+        sys.stdout.flush()
+    if hasattr(signal, "SIGUSR2"):
+        signal.signal(signal.SIGUSR2, print_stats)
+
+
+def run_worker(host, port, config_file, use_select, worker_id, relay_sock, latency, state_file, saved_state):
+    # one of the processes of a sharded server
+    atem_config.config_init(config_file)
+    if saved_state is not None:
+        atem_persist.apply_record((None, saved_state))
+        atem_config.state_changed()
+    # the workers all have the same state, worker 0 saves it
+    if state_file and worker_id == 0:
+        atem_persist.start_journal(state_file)
+    atem_commands.build_setup_commands_list(client_manager.get_setup_packet_cmd_bytes())
+    client_mgr = ClientManager()
+    client_mgr.state_relay = atem_shard.StateRelay(relay_sock, worker_id, client_mgr)
+    install_stats_signal_handler([client_mgr])
+    if latency:
+        atem_latency.enable()
+        atem_latency.install_signal_handler()
+    try:
+        if use_select:
+            run_select_server(host, port, client_mgr, reuse_port=True)
+        else:
+            asyncio.run(run_asyncio_server(host, port, client_mgr, reuse_port=True))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        atem_persist.close_state()
+        print(f"worker {worker_id}:")
+        client_mgr.print_stats()
+        if latency:
+            print(f"worker {worker_id}:")
+            atem_latency.dump()
+
+
+def run_sharded_server(host, port, config_file, num_workers, use_select=False, latency=False, state_file=None,
+                       watch_config=False):
+    """
+    Run num_workers server processes on the same port plus the sequencer
+    that keeps their switcher state in step (see atem_shard).
+    """
+    # the saved state is read here (into the state main() loaded from the
+    # config file), once, and handed to every worker, so worker 0 starting
+    # a new journal can't pull it out from under another worker that is
+    # still reading it
+    saved_state = None
+    if state_file:
+        replayed = atem_persist.restore_state(state_file)
+        if replayed is not None:
+            print(f"Restored the switcher state from {state_file} ({replayed} journal records)")
+            saved_state = atem_persist.capture_state()
+    sequencer_socks, worker_socks = atem_shard.make_sequencer_sockets(num_workers)
+    # the sequencer reloads the config and relays what changed to the
+    # workers, so they all apply it at the same point in the command order
+    processes = [multiprocessing.Process(target=atem_shard.run_sequencer, daemon=True,
+                                         args=(sequencer_socks, config_file, watch_config))]
+    for worker_id, relay_sock in enumerate(worker_socks):
+        processes.append(multiprocessing.Process(target=run_worker, daemon=True,
+            args=(host, port, config_file, use_select, worker_id, relay_sock, latency, state_file, saved_state)))
+    for process in processes:
+        process.start()
+    # the children have their own copies now
+    for sock in sequencer_socks + worker_socks:
+        sock.close()
+    # take the workers down with this process when it's killed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    # and pass SIGHUP (reload the config) on to the sequencer
+    def reload_config(signum, frame):
+        os.kill(processes[0].pid, signal.SIGHUP)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, reload_config)
+    try:
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            process.terminate()
+
 
 def main():
     # Parse the input aruments
     ap = argparse.ArgumentParser()
 
     ap.add_argument("--address", "-a", required=False, default="0.0.0.0", help="listening IP address, default=\"0.0.0.0\"")
-    ap.add_argument("--port", "-p", required=False, default=9910, help="listening UDP Port, default=9910")
+    ap.add_argument("--port", "-p", required=False, type=int, default=9910, help="listening UDP Port, default=9910")
     ap.add_argument("--config", required=False, default="default_config.xml", help="config XML file from ATEM software (default=default_config.xml)")
+    ap.add_argument("--config-cache", required=False, default=atem_config.CONFIG_CACHE_DIR, metavar="DIR", help=f"directory for the parsed config snapshots that make the next start faster (default={atem_config.CONFIG_CACHE_DIR})")
+    ap.add_argument("--no-config-cache", required=False, action="store_true", help="always parse the config file, don't use or save snapshots")
+    ap.add_argument("--state-file", required=False, metavar="PATH", help="save the switcher state (inputs, keys, names...) here and carry on from it on the next start")
+    ap.add_argument("--watch-config", required=False, action="store_true", help=f"reload the config file when it changes (checked every {atem_config.CONFIG_WATCH_INTERVAL:g}s) and send the clients what changed. kill -HUP <pid> reloads it any time")
     ap.add_argument("--debug", "-d", required=False, default="INFO", help="debug level (in quotes): NONE, INFO (default), WARNING, DEBUG")
+    ap.add_argument("--select", required=False, action="store_true", help="use the original select() polling loop instead of asyncio")
+    ap.add_argument("--switcher", required=False, action="append", metavar="PORT[:CONFIG]", help="run a switcher on this port, with its own config file (default=--config). Repeat to run several switchers in the one process")
+    ap.add_argument("--switchers", required=False, type=int, default=0, help="run this many switchers on consecutive ports from --port, all starting from --config")
+    ap.add_argument("--workers", required=False, type=int, default=1, help="number of server processes sharing the port (needs SO_REUSEPORT), default=1")
+    ap.add_argument("--transition-update-frames", required=False, type=int, default=atem_commands.TRANSITION_UPDATE_FRAMES, help=f"frames between the updates sent while a transition runs, 1 for every frame (default={atem_commands.TRANSITION_UPDATE_FRAMES})")
+    ap.add_argument("--no-coalesce", required=False, action="store_true", help="send every update, even the ones a later update has superseded before they went out")
+    ap.add_argument("--mtu", required=False, type=int, default=client_manager.PACKET_MTU, help=f"biggest datagram to send, updates are packed into packets up to this size (default={client_manager.PACKET_MTU})")
+    ap.add_argument("--latency", required=False, action="store_true", help="keep per stage latency histograms, printed at exit and on SIGUSR1")
     
 
     args = ap.parse_args()
@@ -30,41 +422,77 @@ def main():
     config_file = args.config
 
     print("ATEM Server Starting...")
-
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.bind((host, port))
+    atem_commands.TRANSITION_UPDATE_FRAMES = max(1, args.transition_update_frames)
+    client_manager.COALESCE_UPDATES = not args.no_coalesce
+    client_manager.PACKET_MTU = args.mtu
+    atem_config.CONFIG_CACHE_DIR = None if args.no_config_cache else args.config_cache
+
+    switcher_specs = list(args.switcher or [])
+    switcher_specs += [f"{port + i}" for i in range(args.switchers)]
+    if switcher_specs:
+        if args.select or args.workers > 1:
+            print("--switcher(s) only works with the asyncio server and one worker")
+            sys.exit(1)
+        switchers = atem_switcher.load_switchers(switcher_specs, config_file, args.state_file)
+        for switcher in switchers:
+            print(f"Switcher on port {switcher.port}: {switcher.config_file}")
+        if args.latency:
+            atem_latency.enable()
+            atem_latency.install_signal_handler()
+        install_stats_signal_handler([switcher.client_mgr for switcher in switchers])
+        print(f"ATEM Server Running {len(switchers)} switchers...Hit ctrl-c to exit")
+        try:
+            asyncio.run(run_asyncio_switchers(host, switchers, args.watch_config))
+        except KeyboardInterrupt:
+            sys.exit()
+        finally:
+            for switcher in switchers:
+                switcher.close()
+            atem_switcher.deactivate()
+            if args.latency:
+                atem_latency.dump()
+        return
 
     client_mgr = ClientManager()
     atem_config.config_init(config_file)
-
-    print("ATEM Server Running...Hit ctrl-c to exit")
-
-    while True:
+    # decode the setup dump now rather than on the first client connection
+    atem_commands.build_setup_commands_list(client_manager.get_setup_packet_cmd_bytes())
+
+    if args.workers > 1:
+        if not hasattr(socket, "SO_REUSEPORT"):
+            print("--workers needs SO_REUSEPORT, which this platform doesn't have")
+            sys.exit(1)
+        print(f"ATEM Server Running with {args.workers} workers...Hit ctrl-c to exit")
         try:
-            # Process incoming packets but timeout after a while so the clients
-            # can perform cleanup and resend unresponded packets.
-            readers, writers, errors = select.select([s], [], [], 0.050)
-            if len(readers) > 0:
-                try:
-                    bytes, addr = s.recvfrom(2048)
-                    packet = Packet(addr, bytes)
-                    packet.parse_packet()
-                    client = client_mgr.get_client(packet.ip_and_port, packet.session_id)
-                    client.process_inbound_packet(packet)
-                except ConnectionResetError:
-                    print("connection reset!")
-                    s.close()
-                    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                    s.bind((host, port))
-                    continue
-                except KeyboardInterrupt:
-                    raise
-            
-            # Perform regularly regardless of incoming packets
-            client_mgr.run_clients(s)
+            run_sharded_server(host, port, config_file, args.workers, args.select, args.latency, args.state_file,
+                               args.watch_config)
         except KeyboardInterrupt:
-            # quit
             sys.exit()
+        return
+
+    if args.state_file:
+        atem_persist.open_state(args.state_file)
+    if args.latency:
+        atem_latency.enable()
+        atem_latency.install_signal_handler()
+
+    install_stats_signal_handler([client_mgr])
+    reloader = atem_config.ConfigReloader(config_file, client_mgr.reload_config, args.watch_config)
+    print("ATEM Server Running...Hit ctrl-c to exit")
+
+    try:
+        if args.select:
+            run_select_server(host, port, client_mgr, reloader=reloader)
+        else:
+            asyncio.run(run_asyncio_server(host, port, client_mgr, reloader=reloader))
+    except KeyboardInterrupt:
+        # quit
+        sys.exit()
+    finally:
+        atem_persist.close_state()
+        client_mgr.print_stats()
+        if args.latency:
+            atem_latency.dump()
 
 
 
@@ -0,0 +1,324 @@
+# Sharding:
+# Runs the server as several worker processes that all bind the same UDP
+# port with SO_REUSEPORT. The kernel hashes each client's address to one of
+# the workers, so a client always talks to the same worker and that
+# worker's ClientManager works exactly as it does with a single process.
+#
+# The switcher state is kept in step by a sequencer process. A worker
+# doesn't apply the commands that change the switcher state straight away,
+# it sends them to the sequencer, which sends every command back to every
+# worker in one order. Each worker applies them in that order to its own
+# copy of the state and sends the updates to its clients, and the worker
+# the command came from acks it. The commands are small and rare compared
+# to the updates they cause, so replaying them in every worker is cheaper
+# than shipping the state around, and each worker's setup dump and tally
+# tables stay local.
+#
+# Config reloads go through the sequencer too: it reads the config file
+# (on SIGHUP or, watching it, when it changes) and sends what changed to
+# every worker as one more message in the order, so the workers all apply
+# it between the same two commands.
+
+import pickle
+import selectors
+import signal
+import socket
+import time
+from collections import deque
+
+import atem_commands
+import atem_config
+from atem_packet import Packet
+
+
+# biggest message between a worker and the sequencer (one datagram plus a bit)
+MAX_MESSAGE_SIZE = 65536
+
+
+def make_sequencer_sockets(num_workers):
+    """
+    A connected pair of sockets per worker: ([sequencer end], [worker end]).
+    SOCK_SEQPACKET keeps the message boundaries and the order.
+    """
+    pairs = [socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET) for _ in range(num_workers)]
+    return [pair[0] for pair in pairs], [pair[1] for pair in pairs]
+
+
+class StateRelay(object):
+    """
+    The worker end of the sequencer connection. Set as the client manager's
+    state_relay, and the server loop calls receive() when the socket is readable.
+    """
+    def __init__(self, sock: socket.socket, worker_id, client_mgr):
+        self.sock = sock
+        self.worker_id = worker_id
+        self.client_mgr = client_mgr
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def forward(self, client, in_packet: Packet):
+        """
+        Send the packet to the sequencer if it has any commands that change
+        the switcher state. Returns False if it doesn't (eg. only unknown
+        commands), and the client handles the packet itself.
+        """
+        if not any(cmd.code in atem_commands.command_handlers for cmd in in_packet.commands):
+            return False
+        message = (self.worker_id, client.ip_and_port, client.session_id, in_packet.timestamp,
+                   bytes(in_packet.bytes[:in_packet.packet_length]))
+        self.sock.send(pickle.dumps(message))
+        return True
+
+    def receive(self):
+        """
+        Apply the commands that have come back from the sequencer, in order.
+        The clients that have something new to send are added to the client
+        manager's updated_clients.
+        """
+        while True:
+            try:
+                data = self.sock.recv(MAX_MESSAGE_SIZE, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return
+            if not data:
+                raise ConnectionError("lost the connection to the sequencer")
+            message = pickle.loads(data)
+            if message[0] is None:
+                # a config reload (see read_config_changes)
+                config_file, changed_values = message[1:]
+                self.client_mgr.apply_config(config_file, changed_values)
+                continue
+            worker_id, ip_and_port, session_id, timestamp, datagram = message
+            packet = Packet(ip_and_port, datagram)
+            # time it from when the sending worker received it
+            packet.timestamp = timestamp
+            packet.parse_packet()
+            client = None
+            if worker_id == self.worker_id:
+                client = self.client_mgr.clients.get((ip_and_port, session_id))
+            if client is not None:
+                client.process_commands(packet)
+                self.client_mgr.updated_clients.add(client)
+            else:
+                # another worker's client (or one of ours that has gone)
+                self.client_mgr.process_remote_commands(packet)
+
+
+def read_config_changes(config_file):
+    """
+    Reload the config file in the sequencer: the message that has the
+    workers apply what changed (see atem_config.apply_config), None if
+    nothing did or the file can't be used. Only the changed values go, the
+    workers keep the rest of the conf_db they loaded (a whole one can be
+    bigger than a message).
+    """
+    loaded = atem_config.read_config_values(config_file)
+    if loaded is None:
+        return None
+    changed_values = atem_config.diff_config_values(config_file, loaded[1])
+    if not changed_values:
+        if changed_values is not None:
+            print(f"Reloaded {config_file}: no changes")
+        return None
+    # what the next reload is compared with
+    atem_config.config_values.update(changed_values)
+    return pickle.dumps((None, config_file, changed_values))
+
+
+def run_sequencer(socks, config_file=None, watch_config=False):
+    """
+    Send every message from a worker to all the workers, in the order they
+    arrive. It never blocks on a worker: whatever a worker can't take yet is
+    queued and the sequencer carries on reading, otherwise a worker blocked
+    sending to the sequencer and the sequencer blocked sending to that
+    worker would deadlock.
+    With a config_file, SIGHUP (and with watch_config, a change to the file)
+    reloads it and the changes go to the workers in the same order.
+    """
+    sel = selectors.DefaultSelector()
+    # worker socket -> messages waiting to be sent to it
+    queues = {}
+    for sock in socks:
+        sock.setblocking(False)
+        queues[sock] = deque()
+        sel.register(sock, selectors.EVENT_READ)
+    # the sockets registered for EVENT_WRITE because their queue is backed up
+    blocked = set()
+
+    def drop(sock):
+        sel.unregister(sock)
+        del queues[sock]
+        blocked.discard(sock)
+        sock.close()
+
+    def flush(sock):
+        queue = queues[sock]
+        try:
+            while queue:
+                sock.send(queue[0])
+                queue.popleft()
+        except BlockingIOError:
+            pass
+        except ConnectionError:
+            drop(sock)
+            return
+        if queue and sock not in blocked:
+            blocked.add(sock)
+            sel.modify(sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+        elif not queue and sock in blocked:
+            blocked.discard(sock)
+            sel.modify(sock, selectors.EVENT_READ)
+
+    def broadcast(message):
+        for queue in queues.values():
+            queue.append(message)
+        for out_sock in list(queues):
+            flush(out_sock)
+
+    reloader = None
+    # wakes the select() up for a signal (Python retries it otherwise)
+    wakeup_sock = None
+    if config_file is not None:
+        def reload_config(config_file):
+            message = read_config_changes(config_file)
+            if message is not None:
+                broadcast(message)
+        reloader = atem_config.ConfigReloader(config_file, reload_config, watch_config)
+        if hasattr(signal, "SIGHUP"):
+            wakeup_sock, wakeup_write_sock = socket.socketpair()
+            wakeup_sock.setblocking(False)
+            wakeup_write_sock.setblocking(False)
+            signal.set_wakeup_fd(wakeup_write_sock.fileno())
+            signal.signal(signal.SIGHUP, lambda signum, frame: reloader.request())
+            sel.register(wakeup_sock, selectors.EVENT_READ)
+
+    try:
+        while queues:
+            timeout = None
+            if reloader is not None and reloader.watch:
+                timeout = max(0, reloader.next_check_time - time.monotonic())
+            for key, events in sel.select(timeout):
+                sock = key.fileobj
+                if sock is wakeup_sock:
+                    try:
+                        while sock.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                if sock not in queues:
+                    # dropped earlier in this round
+                    continue
+                if events & selectors.EVENT_READ:
+                    received = False
+                    while True:
+                        try:
+                            message = sock.recv(MAX_MESSAGE_SIZE)
+                        except BlockingIOError:
+                            break
+                        except ConnectionError:
+                            message = b''
+                        if not message:
+                            # the worker has gone
+                            drop(sock)
+                            break
+                        received = True
+                        for queue in queues.values():
+                            queue.append(message)
+                    if received:
+                        for out_sock in list(queues):
+                            flush(out_sock)
+                if events & selectors.EVENT_WRITE and sock in queues:
+                    flush(sock)
+            if reloader is not None:
+                reloader.poll(time.monotonic())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    # Quick test: two workers in one process, each with its own switcher
+    # state (swapped in the way atem_switcher does it, a worker process has
+    # its own). A command from a client of worker 0 changes neither state
+    # until it comes back from the sequencer, then each worker applies it
+    # and its clients get it.
+    import os
+    import struct
+    import tempfile
+    import threading
+    import atem_switcher
+    from atem_packet import ATEMFlags
+
+    sequencer_socks, worker_socks = make_sequencer_sockets(2)
+    threading.Thread(target=run_sequencer, args=(sequencer_socks,), daemon=True).start()
+    workers = []
+    for worker_id, sock in enumerate(worker_socks):
+        worker = atem_switcher.VirtualSwitcher("default_config.xml", 9910)
+        worker.client_mgr.state_relay = StateRelay(sock, worker_id, worker.client_mgr)
+        workers.append(worker)
+
+    def make_packet(flags, session_id, packet_id=0, payload=b''):
+        raw = struct.pack('!3H 4x H', (flags << 11) | (12 + len(payload)), session_id, 0, packet_id) + payload
+        packet = Packet(('127.0.0.1', 10000), raw)
+        packet.parse_packet()
+        return packet
+
+    def program_input(worker):
+        worker.activate()
+        return atem_config.state.mes[0].program_input
+
+    clients = []
+    for worker in workers:
+        worker.activate()
+        client = worker.client_mgr.get_client(('127.0.0.1', 10000), 0x1234)
+        client.process_inbound_packet(make_packet(ATEMFlags.INIT, 0x1234, payload=b'\x01' + b'\x00' * 7))
+        client.process_inbound_packet(make_packet(ATEMFlags.ACK, 0x1234))
+        clients.append(client)
+    old_program = program_input(workers[0])
+    new_program = 3 if old_program != 3 else 4
+    cpgi = struct.pack('!H 2x 4s B x H', 12, b'CPgI', 0, new_program)
+    workers[0].activate()
+    clients[0].process_inbound_packet(make_packet(ATEMFlags.COMMAND, clients[0].session_id, 1, cpgi))
+    # nothing happens until it comes back from the sequencer
+    assert not clients[0].outbound_commands_list
+    assert program_input(workers[0]) == program_input(workers[1]) == old_program
+    time.sleep(0.2)
+    for worker in workers:
+        other = workers[1] if worker is workers[0] else workers[0]
+        other_program = program_input(other)
+        worker.activate()
+        worker.client_mgr.state_relay.receive()
+        assert program_input(worker) == new_program
+        # the other worker's state is its own
+        assert program_input(other) == other_program
+    # the sender gets the ack, the client of the other worker gets the update
+    assert clients[0].outbound_commands_list[0].ack_packet_id == 1
+    assert [cmd.code for cmd in clients[1].outbound_commands_list[0].commands] == ['Time', 'TlIn', 'TlSr', 'PrgI']
+    assert clients[1].outbound_commands_list[0].ack_packet_id == 0
+    # a config reload read by the sequencer (its own copy of the config, the
+    # modules' globals here) reaches both workers as one message
+    atem_switcher.deactivate()
+    atem_config.CONFIG_CACHE_DIR = None
+    atem_config.config_init("default_config.xml")
+    with open("default_config.xml") as f:
+        config_text = f.read()
+    fd, edited_file = tempfile.mkstemp(suffix=".xml")
+    with os.fdopen(fd, 'w') as f:
+        f.write(config_text.replace('<DownstreamKey index="0" fillSource="1" keySource="1" rate="20"',
+                                    '<DownstreamKey index="0" fillSource="1" keySource="1" rate="30"'))
+    message = read_config_changes(edited_file)
+    assert read_config_changes(edited_file) is None
+    os.remove(edited_file)
+    worker_socks[0].send(message)
+    time.sleep(0.2)
+    for worker, client in zip(workers, clients):
+        worker.activate()
+        assert atem_config.state.dsks[0].rate == 20
+        worker.client_mgr.state_relay.receive()
+        assert atem_config.state.dsks[0].rate == 30
+        # after the command that was sequenced before it
+        assert ([[cmd.code for cmd in cc.commands] for cc in client.outbound_commands_list] ==
+                [['Time', 'TlIn', 'TlSr', 'PrgI'], ['Time', 'DskP', 'DskS']])
+    atem_switcher.deactivate()
+    print("sharded command and config reload applied by both workers")
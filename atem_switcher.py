@@ -0,0 +1,133 @@
+# Virtual switchers:
+# Lets one process simulate several switchers, each with its own config
+# file, switcher state, ClientManager and UDP port.
+#
+# The switcher state lives in module globals (atem_config.state and the
+# caches built from it in atem_commands), which is what all the command
+# classes read. Rather than thread a switcher through every command, each
+# VirtualSwitcher keeps its own copy of those globals and activate() swaps
+# them in. The server is single threaded, so activating the switcher a
+# packet is for before handling it is all it takes, and when it is already
+# the active one that is a single comparison.
+
+import atem_config
+import atem_commands
+import atem_persist
+import client_manager
+from client_manager import ClientManager
+
+
+# The module globals that belong to one switcher, and what they start as
+SWITCHER_GLOBALS = (
+    (atem_config, 'conf_db', dict),
+    (atem_config, 'state', lambda: None),
+    (atem_config, 'state_version', int),
+    (atem_config, 'conf_db_version', int),
+    (atem_config, 'config_values', dict),
+    (atem_config, 'state_journal', lambda: None),
+    (atem_commands, 'tally_tables', dict),
+    (atem_commands, 'setup_commands_cache', lambda: None),
+    (atem_commands, 'setup_commands_cache_version', lambda: None),
+    (atem_commands, 'transition_engine', atem_commands.TransitionEngine),
+)
+
+# The switcher whose globals are currently in the modules. None means the
+# modules have their own (a plain single switcher server), which are kept
+# in own_globals while a switcher is active.
+active_switcher = None
+own_globals = None
+
+
+class VirtualSwitcher(object):
+    def __init__(self, config_file, port, state_file=None):
+        self.config_file = config_file
+        self.port = port
+        self.state_file = state_file
+        self.client_mgr = ClientManager()
+        # this switcher's copy of SWITCHER_GLOBALS while it isn't active
+        self.saved_globals = [make_default() for module, global_name, make_default in SWITCHER_GLOBALS]
+        self.activate()
+        atem_config.config_init(config_file)
+        if state_file:
+            atem_persist.open_state(state_file)
+        # decode the setup dump now rather than on the first client connection
+        atem_commands.build_setup_commands_list(client_manager.get_setup_packet_cmd_bytes())
+
+    def activate(self):
+        global active_switcher, own_globals
+        if active_switcher is self:
+            return
+        if active_switcher is not None:
+            active_switcher.save_globals()
+        else:
+            own_globals = get_globals()
+        for (module, global_name, make_default), value in zip(SWITCHER_GLOBALS, self.saved_globals):
+            setattr(module, global_name, value)
+        active_switcher = self
+
+    def save_globals(self):
+        self.saved_globals = get_globals()
+
+    def close(self):
+        # at shutdown: finish saving the state
+        self.activate()
+        atem_persist.close_state()
+
+
+def get_globals():
+    return [getattr(module, global_name) for module, global_name, make_default in SWITCHER_GLOBALS]
+
+
+def deactivate():
+    """
+    Put back the globals the modules had before a switcher was activated
+    """
+    global active_switcher
+    if active_switcher is None:
+        return
+    active_switcher.save_globals()
+    for (module, global_name, make_default), value in zip(SWITCHER_GLOBALS, own_globals):
+        setattr(module, global_name, value)
+    active_switcher = None
+
+
+def load_switchers(specs, default_config, state_file=None):
+    """
+    Create the switchers from "PORT" or "PORT:CONFIG" strings (eg. from the
+    --switcher option). Returns a list of VirtualSwitcher objects. With a
+    state_file each switcher saves its state in state_file.PORT.
+    """
+    switchers = []
+    for spec in specs:
+        port, _, config_file = spec.partition(':')
+        switchers.append(VirtualSwitcher(config_file or default_config, int(port),
+                                         f"{state_file}.{port}" if state_file else None))
+    return switchers
+
+
+if __name__ == "__main__":
+    # Quick test: two switchers with their own state, caches and clients
+    a = VirtualSwitcher("default_config.xml", 9910)
+    b = VirtualSwitcher("default_config.xml", 9911)
+    a.activate()
+    me = min(atem_config.state.mes)
+    atem_config.state.mes[me].program_input = 3
+    atem_config.state_changed()
+    a_dump = atem_commands.build_setup_commands_list()
+    a_tally = bytes(atem_commands.Cmd_TlIn(me).content)
+    b.activate()
+    atem_config.state.mes[me].program_input = 5
+    atem_config.state_changed()
+    b_dump = atem_commands.build_setup_commands_list()
+    assert b_dump is not a_dump and bytes(atem_commands.Cmd_TlIn(me).content) != a_tally
+    a.activate()
+    assert atem_config.state.mes[me].program_input == 3
+    assert atem_commands.build_setup_commands_list() is a_dump
+    assert bytes(atem_commands.Cmd_TlIn(me).content) == a_tally
+    b.activate()
+    assert atem_config.state.mes[me].program_input == 5
+    assert atem_commands.build_setup_commands_list() is b_dump
+    assert a.client_mgr is not b.client_mgr
+    deactivate()
+    assert atem_config.state is None and atem_commands.setup_commands_cache is None
+    print("2 switchers kept apart")
@@ -5,17 +5,69 @@
 
 import time
 import random
-from atem_packet import Packet, ATEMFlags
+from atem_packet import Packet, ATEMFlags, PACKET_HEADER_SIZE
 import atem_commands
+import atem_latency
 from atem_commands import CommandCarrier
 import socket
 import struct
-from typing import List
+from typing import List, Deque
+from collections import deque
 import copy
+import heapq
+import itertools
 
-CLIENT_ACTIVITY_TIMEOUT = 1.0   # seconds
-CLIENT_DROPOUT_TIMEOUT = 3.0    # seconds
-PACKET_RESEND_INTERVAL = 0.5    # seconds
+CLIENT_ACTIVITY_TIMEOUT = 1.0   # seconds of silence before the client gets a keepalive (ping)
+CLIENT_DROPOUT_TIMEOUT = 3.0    # seconds of silence before the client is dropped
+PACKET_RESEND_INTERVAL = 0.5    # seconds, until the client's round trip time has been measured
+CLIENT_UPDATE_INTERVAL = 0.050  # seconds, longest time between client updates
+PACKET_ID_MASK = 0x7FFF         # packet ids are 15 bits and wrap around
+# Coalescing: when a client has more than one update waiting to be sent, the
+# commands that a later update has a newer copy of are dropped. A slow
+# client (COALESCE_UNACKED_LIMIT packets waiting for an ack) has its updates
+# held back, for up to COALESCE_MAX_HOLD, so they coalesce too.
+COALESCE_UPDATES = True
+COALESCE_UNACKED_LIMIT = 2
+COALESCE_MAX_HOLD = 0.100       # seconds
+# Retransmission: each client's round trip time is measured from the acks
+# and the resend timeout (RTO) follows it, the way TCP does (RFC 6298):
+# RTO = smoothed RTT + 4 * RTT variation, clamped to RTO_MIN..RTO_MAX, and
+# doubled each time it expires (back to the estimate on the next sample).
+RTO_MIN = 0.100                 # seconds
+RTO_MAX = 1.0                   # seconds, so a few resends fit in CLIENT_DROPOUT_TIMEOUT
+RTO_GRANULARITY = 0.010         # seconds, least the RTT variation adds
+# Most command packets a client can have waiting for an ack. Packets beyond
+# that wait to be sent (and updates wait, coalescing) until acks come in.
+IN_FLIGHT_WINDOW = 32
+# Packetizing: the updates that are due together are packed into as few
+# packets as fit in PACKET_MTU (the IP datagram size), and one too big for
+# a packet is split across several.
+PACKET_MTU = 1500               # bytes
+IP_UDP_HEADER_SIZE = 28         # bytes of the datagram that aren't the ATEM packet
+MAX_PACKET_LENGTH = 0x7FF       # the packet length field is 11 bits
+# the per client counters, for monitoring (see ClientManager.print_stats).
+# packets_sent and bytes_sent are everything, keepalives included.
+CLIENT_COUNTERS = ('packets_sent', 'bytes_sent', 'packets_resent', 'resend_timeouts', 'window_stalls',
+                   'keepalives_sent', 'keepalive_bytes_sent')
+
+
+def get_max_packet_cmd_bytes():
+    # most command bytes that fit in one packet
+    return min(PACKET_MTU - IP_UDP_HEADER_SIZE, MAX_PACKET_LENGTH) - PACKET_HEADER_SIZE
+
+
+def get_setup_packet_cmd_bytes():
+    # command bytes in each packet of the setup dump: the real switcher's size, less if the MTU is smaller
+    return min(atem_commands.SETUP_PACKET_MAX_CMD_BYTES, get_max_packet_cmd_bytes())
+
+
+def packet_id_is_acked(packet_id, acked_packet_id):
+    """
+    True if packet_id is the acked packet id or older. Packet ids wrap around
+    at 0x7FFF so anything up to half the id space behind the acked id counts
+    as older.
+    """
+    return ((acked_packet_id - packet_id) & PACKET_ID_MASK) < (PACKET_ID_MASK + 1) // 2
 
 class ATEMClientState:
     UNINITIALIZED = 0
@@ -45,15 +97,97 @@ class ATEMClient(object):
         self.last_ACKed_packet_id = 0
         self.client_state = ATEMClientState.UNINITIALIZED
         self.outbound_commands_list: List[CommandCarrier] = []
-        self.outbound_packet_list: List[Packet] = []
+        # packets waiting to be sent for the first time
+        self.outbound_packet_list: Deque[Packet] = deque()
+        # command packets that have been sent but not acked yet, in packet id order
+        self.unacked_packet_list: Deque[Packet] = deque()
+        # (send timestamp, packet's send_count, packet) in the order the unacked
+        # packets were last sent, so the oldest is always at the front. Entries
+        # for packets that have since been acked or resent are skipped when
+        # they reach the front.
+        self.resend_queue: Deque = deque()
         self.client_manager: ClientManager = client_manager
+        # round trip time estimate (seconds), None until the first sample
+        self.smoothed_rtt = None
+        self.rtt_variation = None
+        self.resend_timeout = PACKET_RESEND_INTERVAL
+        # Liveness: a client that has gone quiet gets one keepalive, resent
+        # with backoff until it's acked or the client is dropped
+        self.keepalive_packet = None
+        self.keepalive_retry_time = 0
+        self.keepalive_retry_interval = 0
+        # when the client manager's timer for this client is set for (select loop)
+        self.next_update_time = None
+        # counters for monitoring (see ClientManager.print_stats)
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.packets_resent = 0
+        self.resend_timeouts = 0
+        self.window_stalls = 0
+        self.keepalives_sent = 0
+        self.keepalive_bytes_sent = 0
 
         # When an inbount packet has a command, store the packet id so
         # the ack can be sent on the next outgoing packet
         self.packet_id_needs_ack = None
+        # when the updates started being held back (slow client), or None
+        self.hold_start_time = None
+
+    def update_rtt(self, rtt):
+        """
+        Add a round trip time sample and work out the new resend timeout
+        """
+        if self.smoothed_rtt is None:
+            self.smoothed_rtt = rtt
+            self.rtt_variation = rtt / 2
+        else:
+            self.rtt_variation = 0.75 * self.rtt_variation + 0.25 * abs(self.smoothed_rtt - rtt)
+            self.smoothed_rtt = 0.875 * self.smoothed_rtt + 0.125 * rtt
+        self.resend_timeout = min(RTO_MAX, max(RTO_MIN, self.smoothed_rtt + max(RTO_GRANULARITY, 4 * self.rtt_variation)))
+
+    def get_keepalive_time(self):
+        """
+        When the client is next due a keepalive, None if it isn't. While
+        there are other packets waiting for an ack it isn't, the resends of
+        those ask for an ack just as well.
+        """
+        if self.client_state != ATEMClientState.ESTABLISHED:
+            return None
+        if self.keepalive_packet is not None:
+            return self.keepalive_retry_time
+        if self.unacked_packet_list:
+            return None
+        return self.last_activity_time + CLIENT_ACTIVITY_TIMEOUT
+
+    def send_keepalive(self, sock, now):
+        if self.keepalive_packet is None:
+            keepalive_packet = Packet(self.ip_and_port)
+            keepalive_packet.flags |= ATEMFlags.COMMAND | ATEMFlags.ACK
+            keepalive_packet.packet_id = self.get_next_packet_id()
+            keepalive_packet.session_id = self.session_id
+            keepalive_packet.ACKed_packet_id = self.last_ACKed_packet_id
+            keepalive_packet.to_bytes()
+            self.keepalive_packet = keepalive_packet
+            self.keepalive_retry_interval = self.resend_timeout
+        else:
+            keepalive_packet = self.keepalive_packet
+            if not keepalive_packet.flags & ATEMFlags.RETRANSMITION:
+                keepalive_packet.flags |= ATEMFlags.RETRANSMITION
+                keepalive_packet.bytes[0] |= ATEMFlags.RETRANSMITION << 3
+            self.keepalive_retry_interval = min(RTO_MAX, 2 * self.keepalive_retry_interval)
+        sock.sendto(keepalive_packet.bytes, keepalive_packet.ip_and_port)
+        keepalive_packet.last_send_timestamp = now
+        self.keepalive_retry_time = now + self.keepalive_retry_interval
+        self.packets_sent += 1
+        self.bytes_sent += len(keepalive_packet.bytes)
+        self.keepalives_sent += 1
+        self.keepalive_bytes_sent += len(keepalive_packet.bytes)
+
+    def window_is_full(self):
+        return len(self.unacked_packet_list) >= IN_FLIGHT_WINDOW
 
     def get_next_packet_id(self):
-        self.current_packet_id += 1
+        self.current_packet_id = (self.current_packet_id + 1) & PACKET_ID_MASK
         return(self.current_packet_id)
     
     def add_to_outbound_commands_list(self, outbound_obj):
@@ -62,6 +196,8 @@ class ATEMClient(object):
     def process_inbound_packet(self, in_packet: Packet):
         # timestamp the most recent activity from the client
         self.last_activity_time = time.monotonic()
+        # there's something to do (an ack or a response to send, or just a new liveness schedule)
+        self.client_manager.updated_clients.add(self)
 
         # if init packet then initialize this object and send a response
         if in_packet.flags & ATEMFlags.INIT and (
@@ -71,7 +207,8 @@ class ATEMClient(object):
                 or in_packet.raw_cmd_data == b'\x04\x00\x00\x00\x00\x00\x00\x00'):
             # This is an init packet. (re)Initialize client
             if self.client_state != ATEMClientState.UNINITIALIZED:
-                self.__init__(self.ip_and_port, self.client_id, self.session_id)
+                self.client_manager.retire_counters(self)
+                self.__init__(self.ip_and_port, self.client_id, self.session_id, self.client_manager)
                 self.last_activity_time = time.monotonic()
             # Create response packet
             init_response_packet = Packet(self.ip_and_port)
@@ -94,18 +231,18 @@ class ATEMClient(object):
             if self.client_state == ATEMClientState.WAIT_FOR_INIT_RESPONSE and in_packet.ACKed_packet_id == self.current_packet_id:
                 # Connected to client!
                 # Expected client session id = 0x8000 + client_id
-                self.session_id = 0x8000 + self.client_id
+                self.client_manager.change_session_id(self, 0x8000 + self.client_id)
                 self.client_state = ATEMClientState.ESTABLISHED
                 print(f"Connected client={self.ip_and_port}, session=0x{self.session_id:x}")
                 # Special case: response packet for the init (part of the handshake)
-                setup_commands_list = atem_commands.build_setup_commands_list()
+                setup_commands_list = atem_commands.build_setup_commands_list(get_setup_packet_cmd_bytes())
                 # still need to add the session ID, packet_id and run to_bytes() on each packet
                 for cmds in setup_commands_list:
                     setup_packet = Packet(self.ip_and_port)
                     setup_packet.session_id = self.session_id
                     setup_packet.flags |= ATEMFlags.COMMAND
                     setup_packet.packet_id = self.get_next_packet_id()
-                    setup_packet.commands = cmds
+                    setup_packet.raw_cmd_data = cmds.bytes
                     setup_packet.to_bytes()
                     self.outbound_packet_list.append(setup_packet)
                 
@@ -118,16 +255,20 @@ class ATEMClient(object):
                 self.outbound_packet_list.append(last_packet)
 
             else:
-                packets_to_keep = []
-                while self.outbound_packet_list:
-                    p = self.outbound_packet_list.pop(0)
-                    # discard if this packet is older than the packet being acked
-                    if p.packet_id <= in_packet.ACKed_packet_id and p.packet_id != 0:
-                        pass # discard packet
-                    else:
-                        packets_to_keep.append(p)
-                # Put the packets to keep back into the outbout_packet_list
-                self.outbound_packet_list = packets_to_keep
+                # the ack covers the acked packet and every packet before it,
+                # which is always a run at the front of the unacked list
+                while self.unacked_packet_list and packet_id_is_acked(self.unacked_packet_list[0].packet_id, in_packet.ACKed_packet_id):
+                    pkt = self.unacked_packet_list.popleft()
+                    pkt.acked = True
+                    if pkt.packet_id == in_packet.ACKed_packet_id and not pkt.flags & ATEMFlags.RETRANSMITION:
+                        # Only a packet that was sent once gives a sample, a
+                        # resent one could be acking either send (Karn's algorithm)
+                        self.update_rtt(in_packet.timestamp - pkt.last_send_timestamp)
+                keepalive_packet = self.keepalive_packet
+                if keepalive_packet is not None and packet_id_is_acked(keepalive_packet.packet_id, in_packet.ACKed_packet_id):
+                    if not keepalive_packet.flags & ATEMFlags.RETRANSMITION:
+                        self.update_rtt(in_packet.timestamp - keepalive_packet.last_send_timestamp)
+                    self.keepalive_packet = None
         
         
         if in_packet.flags & ATEMFlags.COMMAND:
@@ -136,124 +277,365 @@ class ATEMClient(object):
             # which may include response commands.
             # Also, it will likely need to update all the other clients with
             # the new information.
+            # When the server is sharded across processes the commands go via
+            # the sequencer first, which hands them back to process_commands()
+            # in the same order as the other workers apply them.
+            state_relay = self.client_manager.state_relay
+            if state_relay is not None and state_relay.forward(self, in_packet):
+                return
+            self.process_commands(in_packet)
+
+    def process_commands(self, in_packet: Packet):
+        # Get the response command(s). The result is one or more
+        # commands, contained in a list of CommandCarrier objects. The
+        # object contains metadata for the command(s). There
+        # may be more than one CommandCarrier object if more
+        # than one packet needs to be sent as a result of the
+        # command (eg. a transition).
+        # If it returns an empty list then it is an unknown command,
+        # so just send an ack packet to keep the client happy.
+        cmds_carrier_list = atem_commands.get_response(in_packet.commands)
+        trace = None
+        if atem_latency.enabled:
+            # follow the responses through to sendto()
+            code = in_packet.commands[0].code if in_packet.commands else None
+            trace = (code, in_packet.timestamp, time.monotonic())
+        if len(cmds_carrier_list) == 0:
+            # unknown command, just ack
+            self.queue_ack_packet(in_packet.packet_id, trace)
+        else:
+            # iterate through the commands sent back. The ones that are
+            # to be sent later (eg. the steps of a transition) are handed
+            # to the client manager's scheduler, which gives them to the
+            # clients when they are due.
+            now = time.monotonic()
+            sent_ack = False
+            for cc in cmds_carrier_list:
+                cc.trace = trace
+                if cc.send_time > now:
+                    self.client_manager.schedule(self, cc)
+                    continue
+                if cc.multicast == True:
+                    self.client_manager.send_to_other_clients(self, cc)
+                if sent_ack == False:
+                    cc.ack_packet_id = in_packet.packet_id
+                    self.last_ACKed_packet_id = in_packet.packet_id
+                    sent_ack = True
+                self.outbound_commands_list.append(cc)
+            if sent_ack == False:
+                # nothing to send right away, so ack on its own
+                self.queue_ack_packet(in_packet.packet_id, trace)
 
-            # Get the response command(s). The result is one or more
-            # commands, contained in a list of CommandCarrier objects. The
-            # object contains metadata for the command(s). There
-            # may be more than one CommandCarrier object if more
-            # than one packet needs to be sent as a result of the
-            # command (eg. a transition).
-            # If it returns an empty list then it is an unknown command,
-            # so just send an ack packet to keep the client happy.
-            cmds_carrier_list = atem_commands.get_response(in_packet.commands)
-            if len(cmds_carrier_list) == 0:
-                # unknown command, just ack
-                ack_packet = Packet(self.ip_and_port)
-                ack_packet.flags |= ATEMFlags.ACK
-                ack_packet.ACKed_packet_id = in_packet.packet_id
-                ack_packet.session_id = self.session_id
-                ack_packet.to_bytes()
-                self.last_ACKed_packet_id = in_packet.packet_id
-                self.outbound_packet_list.append(ack_packet)
+    def queue_ack_packet(self, packet_id, trace=None):
+        self.outbound_packet_list.append(self.make_ack_packet(packet_id, trace))
+        self.last_ACKed_packet_id = packet_id
+
+    def make_ack_packet(self, packet_id, trace=None):
+        ack_packet = Packet(self.ip_and_port)
+        ack_packet.trace = trace
+        ack_packet.flags |= ATEMFlags.ACK
+        ack_packet.ACKed_packet_id = packet_id
+        ack_packet.session_id = self.session_id
+        ack_packet.to_bytes()
+        return ack_packet
+
+    def coalesce_outbound_commands(self):
+        """
+        Drop the commands in outbound_commands_list that a later carrier in
+        the list has a newer copy of (same state key, see
+        ATEMCommand.state_key_fields), so the client only gets the latest
+        value. A carrier left with nothing to send still acks its packet,
+        on a bare ack packet.
+        """
+        client_manager = self.client_manager
+        # state keys sent by the carriers after the one being looked at
+        later_keys = set()
+        coalesced = []
+        bare_acks = []
+        for cc in reversed(self.outbound_commands_list):
+            cc.to_bytes()
+            spans = cc.command_spans
+            keep = [i for i, span in enumerate(spans) if span[0] is None or span[0] not in later_keys]
+            later_keys.update(span[0] for span in spans if span[0] is not None)
+            if len(keep) == len(spans):
+                coalesced.append(cc)
+                continue
+            client_manager.coalesced_commands += len(spans) - len(keep)
+            if keep:
+                # a copy with just the commands that are still current
+                new_cc = copy.copy(cc)
+                new_cc.commands = [cc.commands[i] for i in keep]
+                new_cc.cmd_bytes = b''.join(cc.cmd_bytes[spans[i][1]:spans[i][2]] for i in keep)
+                new_cc.command_spans = []
+                offset = 0
+                for i in keep:
+                    key, start, end = spans[i]
+                    new_cc.command_spans.append((key, offset, offset + end - start))
+                    offset += end - start
+                client_manager.coalesced_bytes += len(cc.cmd_bytes) - len(new_cc.cmd_bytes)
+                coalesced.append(new_cc)
+            elif cc.ack_packet_id > 0:
+                client_manager.coalesced_bytes += len(cc.cmd_bytes)
+                bare_acks.append(self.make_ack_packet(cc.ack_packet_id, cc.trace))
             else:
-                # iterate through the commands sent back
-                sent_ack = False
-                for cc in cmds_carrier_list:
-                    if cc.multicast == True:
-                        self.client_manager.send_to_other_clients(self, cc)
-                    if sent_ack == False:
-                        cc.ack_packet_id = in_packet.packet_id
-                        self.last_ACKed_packet_id = in_packet.packet_id
-                        sent_ack = True
-                    self.outbound_commands_list.append(cc)
+                client_manager.coalesced_bytes += PACKET_HEADER_SIZE + len(cc.cmd_bytes)
+                client_manager.coalesced_packets += 1
+        coalesced.reverse()
+        self.outbound_commands_list = coalesced
+        self.outbound_packet_list.extend(reversed(bare_acks))
+
+    def is_holding_updates(self, now):
+        """
+        True if the updates waiting in outbound_commands_list should be held
+        back (and coalesced) because the client is slow to ack
+        """
+        if not COALESCE_UPDATES or len(self.unacked_packet_list) < COALESCE_UNACKED_LIMIT:
+            return False
+        for cc in self.outbound_commands_list:
+            if cc.ack_packet_id > 0:
+                # the client is waiting for this one
+                return False
+        if self.hold_start_time is None:
+            self.hold_start_time = now
+        return now - self.hold_start_time < COALESCE_MAX_HOLD
 
+    def packetize(self, max_packets):
+        """
+        Turn the carriers in outbound_commands_list into packets on
+        outbound_packet_list, filling each packet up to the MTU (see
+        get_max_packet_cmd_bytes). Carriers that are due together share a
+        packet, and a carrier too big for one packet is split across several
+        at its command boundaries. The acks are cumulative, so a packet with
+        responses to several client packets acks the newest of them, and
+        the bare acks waiting to go out ride on the first packet instead.
+        Makes up to max_packets packets (more if the last carrier has to be
+        split), the carriers that don't fit stay in outbound_commands_list.
+        """
+        max_cmd_bytes = get_max_packet_cmd_bytes()
+        if len(self.outbound_commands_list) == 1 and not self.outbound_packet_list:
+            # the usual case, one update that fits in a packet
+            cc = self.outbound_commands_list[0]
+            cmd_bytes = cc.to_bytes()
+            if len(cmd_bytes) <= max_cmd_bytes:
+                if cc.trace is not None:
+                    atem_latency.record("queue", time.monotonic() - cc.trace[2], cc.trace[0])
+                self.queue_command_packet((cmd_bytes,), cc.ack_packet_id, cc.trace)
+                self.outbound_commands_list = []
+                return
+        ack_packet_id = 0
+        trace = None
+        if self.outbound_packet_list and all(pkt.flags == ATEMFlags.ACK for pkt in self.outbound_packet_list):
+            # (only when nothing else is waiting, so the acks aren't held
+            # up behind packets the window is holding back)
+            ack_packet_id = self.outbound_packet_list[-1].ACKed_packet_id
+            trace = self.outbound_packet_list[-1].trace
+            self.outbound_packet_list.clear()
+        # the command bytes of the packet being filled
+        pieces = []
+        size = 0
+        num_packets = 0
+        num_carriers = 0
+        for cc in self.outbound_commands_list:
+            cmd_bytes = cc.to_bytes()
+            if pieces and size + len(cmd_bytes) > max_cmd_bytes:
+                self.queue_command_packet(pieces, ack_packet_id, trace)
+                num_packets += 1
+                pieces = []
+                size = 0
+                ack_packet_id = 0
+                trace = None
+                if num_packets >= max_packets:
+                    break
+            num_carriers += 1
+            if cc.trace is not None:
+                atem_latency.record("queue", time.monotonic() - cc.trace[2], cc.trace[0])
+            if cc.ack_packet_id > 0:
+                if ack_packet_id == 0 or packet_id_is_acked(ack_packet_id, cc.ack_packet_id):
+                    ack_packet_id = cc.ack_packet_id
+                # the packet is timed as the response
+                trace = cc.trace
+            elif trace is None:
+                trace = cc.trace
+            if len(cmd_bytes) > max_cmd_bytes:
+                # too big for one packet, the last part starts the next packet
+                start = 0
+                for state_key, span_start, span_end in cc.command_spans:
+                    if span_end - start > max_cmd_bytes and span_start > start:
+                        self.queue_command_packet([cmd_bytes[start:span_start]], ack_packet_id, trace)
+                        num_packets += 1
+                        ack_packet_id = 0
+                        trace = None
+                        start = span_start
+                cmd_bytes = cmd_bytes[start:]
+            pieces.append(cmd_bytes)
+            size += len(cmd_bytes)
+        if pieces:
+            self.queue_command_packet(pieces, ack_packet_id, trace)
+        del self.outbound_commands_list[:num_carriers]
 
+    def queue_command_packet(self, pieces, ack_packet_id, trace):
+        # pieces: the command bytes for the packet, from one or more carriers
+        if trace is not None:
+            encode_start = time.monotonic()
+        out_packet = Packet(self.ip_and_port)
+        out_packet.flags |= ATEMFlags.COMMAND
+        if ack_packet_id > 0:
+            # this is an ack packet
+            out_packet.flags |= ATEMFlags.ACK
+            out_packet.ACKed_packet_id = ack_packet_id
+        out_packet.packet_id = self.get_next_packet_id()
+        out_packet.session_id = self.session_id
+        out_packet.raw_cmd_data = pieces[0] if len(pieces) == 1 else b''.join(pieces)
+        out_packet.to_bytes()
+        if trace is not None:
+            atem_latency.record("encode", time.monotonic() - encode_start, trace[0])
+            out_packet.trace = trace
+        self.outbound_packet_list.append(out_packet)
 
+    def split_off_acks(self):
+        # Send the acks in outbound_commands_list on their own so the client
+        # isn't kept waiting for them while its updates are held back
+        for cc in self.outbound_commands_list:
+            if cc.ack_packet_id > 0:
+                self.outbound_packet_list.append(self.make_ack_packet(cc.ack_packet_id, cc.trace))
+                cc.ack_packet_id = 0
+                cc.trace = None
 
 
 
 
+
+
+
+    def get_next_update_time(self):
+        """
+        The next time update() will have something to do for this client:
+        packets to send, a resend, a keepalive or dropping the client.
+        """
+        # (with the in-flight window full, what is waiting has to wait for
+        # an ack, which gets the client updated anyway)
+        if not self.window_is_full() and (self.outbound_packet_list or (self.outbound_commands_list and self.hold_start_time is None)):
+            return time.monotonic()
+        next_time = self.last_activity_time + CLIENT_DROPOUT_TIMEOUT
+        if self.outbound_commands_list and self.hold_start_time is not None:
+            # held back, see is_holding_updates()
+            next_time = min(next_time, self.hold_start_time + COALESCE_MAX_HOLD)
+        keepalive_time = self.get_keepalive_time()
+        if keepalive_time is not None:
+            next_time = min(next_time, keepalive_time)
+        if self.resend_queue:
+            next_time = min(next_time, self.resend_queue[0][0] + self.resend_timeout)
+        return next_time
+
     def update(self, sock: socket.socket):
         now = time.monotonic()
 
         # Perform regular client update activities. This mainly involves creating packets
         # and sending, or retransmitting packets if they haven't been ACK'd.
-        # 1. iterate through the outbound objects
-        #   generate one or more packets (split into multiple packets based on MTU=1500)
+        # 1. iterate through the outbound objects (they are all due, future ones
+        #   wait in the client manager's scheduler)
+        #   pack them into as few packets as fit in the MTU (see packetize)
         #   add to the outbound packet list
-        # TODO: if one command object has too many commands in it, then split
-        # across multiple packets
-        carriers_to_keep = []
-        for cmd_carrier in self.outbound_commands_list:
-            if cmd_carrier.send_time > now:
-                # not time to send this packet yet
-                carriers_to_keep.append(cmd_carrier)
+        #   Updates that have been superseded by a later one are dropped first,
+        #   and a slow client's updates are held back for a while to coalesce.
+        #   While the in-flight window is full they wait for acks.
+        if COALESCE_UPDATES and len(self.outbound_commands_list) > 1:
+            self.coalesce_outbound_commands()
+        window_room = IN_FLIGHT_WINDOW - len(self.unacked_packet_list)
+        if not self.outbound_commands_list:
+            pass
+        elif window_room <= 0:
+            self.window_stalls += 1
+            self.split_off_acks()
+        elif not self.is_holding_updates(now):
+            # as many packets as there is room for, the rest wait for acks
+            self.packetize(window_room)
+            if self.outbound_commands_list:
+                self.window_stalls += 1
+                self.split_off_acks()
             else:
-                out_packet = Packet(self.ip_and_port)
-                out_packet.flags |= ATEMFlags.COMMAND
-                if cmd_carrier.ack_packet_id > 0:
-                    # this is an ack packet
-                    out_packet.flags |= ATEMFlags.ACK
-                    out_packet.ACKed_packet_id = cmd_carrier.ack_packet_id
-                out_packet.packet_id = self.get_next_packet_id()
-                out_packet.session_id = self.session_id
-                out_packet.commands = cmd_carrier.commands
-                out_packet.to_bytes()
-                self.outbound_packet_list.append(out_packet)
-        self.outbound_commands_list = carriers_to_keep
+                self.hold_start_time = None
         
 
         # 2. check the inactivity time (based on the last time the client communicated to the server)
-        #   If > client inactivity timeout (say 1 sec) then generate an "are you there?" packet
+        #   If it's time for a keepalive (see get_keepalive_time) then send an "are you there?" packet,
+        #   or resend the one that hasn't been acked yet
         #   If > client dropout timeout (say 3 sec) then generate a "goodbye" init packet
         if self.client_state == ATEMClientState.ESTABLISHED:
-            if now - self.last_activity_time > CLIENT_ACTIVITY_TIMEOUT:
-                ping_packet = Packet(self.ip_and_port)
-                ping_packet.flags |= ATEMFlags.COMMAND | ATEMFlags.ACK
-                ping_packet.packet_id = self.get_next_packet_id()
-                ping_packet.session_id = self.session_id
-                ping_packet.ACKed_packet_id = self.last_ACKed_packet_id
-                ping_packet.to_bytes()
-                self.outbound_packet_list.append(ping_packet)
-            
             if now - self.last_activity_time > CLIENT_DROPOUT_TIMEOUT:
                 goodbye_packet = Packet(self.ip_and_port)
                 goodbye_packet.flags |= ATEMFlags.INIT
                 goodbye_packet.session_id = self.session_id
                 goodbye_packet.to_bytes()
                 self.outbound_packet_list.append(goodbye_packet)
+            else:
+                keepalive_time = self.get_keepalive_time()
+                if keepalive_time is not None and keepalive_time <= now:
+                    self.send_keepalive(sock, now)
 
-        # 3. iterate through the outbound packets
+        # 3. send the new outbound packets
         #   if it's an init packet, send and delete
         #   if it's a response packet only with no command data then send and delete
-        #   if it's a packet with command data and send timestamp is 0 then send and keep
-        #   if it's a packet with command data and send timestamp is >0 then 
-        #       wait until the response timeout has elapsed (say 1 sec) and send again
-        packets_to_keep = []
+        #   if it's a packet with command data then send and keep until it's acked,
+        #   as long as the in-flight window isn't full, otherwise it waits
+        window_blocked = None
         while self.outbound_packet_list:
-            pkt = self.outbound_packet_list.pop(0)
-            if pkt.flags & ATEMFlags.INIT:
-                sock.sendto(pkt.bytes, pkt.ip_and_port)
-                # init response, discard packet after sending
-            elif (pkt.flags & ATEMFlags.ACK) and ((pkt.flags & ATEMFlags.COMMAND) == 0):
-                sock.sendto(pkt.bytes, pkt.ip_and_port)
-                # ping response, discard packet after sending
-            elif (pkt.flags & ATEMFlags.COMMAND) and pkt.last_send_timestamp == 0:
-                sock.sendto(pkt.bytes, pkt.ip_and_port)
+            pkt = self.outbound_packet_list.popleft()
+            needs_ack = (pkt.flags & ATEMFlags.COMMAND) and not (pkt.flags & ATEMFlags.INIT)
+            if needs_ack and self.window_is_full():
+                if window_blocked is None:
+                    window_blocked = deque()
+                    self.window_stalls += 1
+                window_blocked.append(pkt)
+                continue
+            trace = pkt.trace
+            if trace is not None:
+                send_start = time.monotonic()
+            sock.sendto(pkt.bytes, pkt.ip_and_port)
+            if trace is not None:
+                sent_time = time.monotonic()
+                atem_latency.record("sendto", sent_time - send_start, trace[0])
+                # the sender gets the ack, the other clients get a copy without one
+                atem_latency.record("response" if pkt.flags & ATEMFlags.ACK else "broadcast", sent_time - trace[1], trace[0])
+                # only the first send counts, not the resends
+                pkt.trace = None
+            self.packets_sent += 1
+            self.bytes_sent += len(pkt.bytes)
+            if needs_ack:
                 pkt.last_send_timestamp = now
-                # command packet, keep until an ack has been received
-                packets_to_keep.append(pkt)
-            elif (pkt.flags & ATEMFlags.COMMAND) and pkt.last_send_timestamp > 0:
-                if now - pkt.last_send_timestamp > PACKET_RESEND_INTERVAL:
-                    pkt.flags |= ATEMFlags.RETRANSMITION
-                    sock.sendto(pkt.bytes, pkt.ip_and_port)
-                    pkt.last_send_timestamp = now
-                # command packet (resending), keep until an ack has been received
-                packets_to_keep.append(pkt)
-        # Put the packets to keep back into the outbout_packet_list
-        self.outbound_packet_list = packets_to_keep
-
-        # 4. If client dropout timeout (say >3 sec) then delete client
+                pkt.send_count += 1
+                self.unacked_packet_list.append(pkt)
+                self.resend_queue.append((now, pkt.send_count, pkt))
+        if window_blocked is not None:
+            self.outbound_packet_list = window_blocked
+
+        # 4. resend the command packets that haven't been acked within the resend timeout.
+        #   Only the front of the resend queue has to be checked since it's in send order.
+        #   The timeout backs off each time it expires.
+        resend_timeout = self.resend_timeout
+        resent = False
+        while self.resend_queue and now - self.resend_queue[0][0] > resend_timeout:
+            send_timestamp, send_count, pkt = self.resend_queue.popleft()
+            if pkt.acked or send_count != pkt.send_count:
+                # acked or already resent since this entry was queued
+                continue
+            if not pkt.flags & ATEMFlags.RETRANSMITION:
+                pkt.flags |= ATEMFlags.RETRANSMITION
+                # the flags are the top 5 bits of the first byte
+                pkt.bytes[0] |= ATEMFlags.RETRANSMITION << 3
+            sock.sendto(pkt.bytes, pkt.ip_and_port)
+            pkt.last_send_timestamp = now
+            pkt.send_count += 1
+            self.resend_queue.append((now, pkt.send_count, pkt))
+            self.packets_sent += 1
+            self.bytes_sent += len(pkt.bytes)
+            self.packets_resent += 1
+            resent = True
+        if resent:
+            self.resend_timeouts += 1
+            self.resend_timeout = min(RTO_MAX, 2 * resend_timeout)
+
+        # 5. If client dropout timeout (say >3 sec) then delete client
         if now - self.last_activity_time > CLIENT_DROPOUT_TIMEOUT:
             self.client_state = ATEMClientState.FINISHED
 
@@ -262,47 +644,404 @@ class ATEMClient(object):
 
 class ClientManager(object):
     def __init__(self):
-        self.clients = []
+        # clients indexed by (ip_and_port, session_id), which is what
+        # identifies the client in every inbound packet
+        self.clients = {}
         # every client needs a unique id, which gets baked into the session ID
         self.client_counter = 0
+        # Command carriers to be sent in the future (eg. transition steps), kept
+        # as a heap of (send_time, sequence, carrier, sending_client) so only
+        # the next one due has to be checked. The sequence number keeps
+        # carriers with the same send_time in the order they were scheduled.
+        self.scheduled_carriers = []
+        self.schedule_sequence = itertools.count()
+        # Clients that have been given something to send by the client
+        # manager (broadcasts, scheduled carriers) since this was last
+        # cleared. Lets the asyncio server update just those clients.
+        self.updated_clients = set()
+        # atem_shard.StateRelay when this is one of several worker processes
+        self.state_relay = None
+        # (time, sequence, client) for run_clients(): each client's next
+        # update (resend, keepalive, dropout...), so a client that has
+        # nothing to do isn't looked at. Entries for a time that is no
+        # longer the client's next_update_time are skipped.
+        self.client_timers = []
+        self.client_timer_sequence = itertools.count()
+        # what coalescing has saved (see ATEMClient.coalesce_outbound_commands)
+        self.coalesced_commands = 0
+        self.coalesced_packets = 0
+        self.coalesced_bytes = 0
+        # CLIENT_COUNTERS of the clients that have gone (or reconnected)
+        self.retired_counters = dict.fromkeys(CLIENT_COUNTERS, 0)
 
     # Get the client based on the packet info or create a new client
     def get_client(self, ip_and_port, session_id) -> ATEMClient:
-        for client in self.clients:
-            if client.ip_and_port == ip_and_port and client.session_id == session_id:
-                return client
+        client = self.clients.get((ip_and_port, session_id))
+        if client is not None:
+            return client
         client_id = self.get_next_client_id()
         new_client = ATEMClient(ip_and_port, client_id, session_id, self)
         print(f"Create client={new_client.ip_and_port}, session=0x{new_client.session_id:x}")
-        self.clients.append(new_client)
+        self.clients[(ip_and_port, session_id)] = new_client
         print(f"client count={len(self.clients)}")
         return new_client
 
-    def run_clients(self, sock: socket.socket):
-        clients_to_keep = []
-        drop = False
-        while self.clients:
-            client = self.clients.pop(0)
-            client.update(sock)
-            if client.client_state == ATEMClientState.FINISHED:
-                print(f"Dropping client={client.ip_and_port}, session=0x{client.session_id:x}")
-                drop = True
-            else:
-                clients_to_keep.append(client)
-        self.clients = clients_to_keep
-        if drop == True:
+    def change_session_id(self, client: ATEMClient, session_id):
+        # The session id changes during the handshake, so move the client to its new key
+        self.clients.pop((client.ip_and_port, client.session_id), None)
+        client.session_id = session_id
+        self.clients[(client.ip_and_port, client.session_id)] = client
+
+    def schedule(self, sending_client, outbound_obj):
+        # encode now so the time in the commands is based on when they were created
+        outbound_obj.to_bytes()
+        heapq.heappush(self.scheduled_carriers, (outbound_obj.send_time, next(self.schedule_sequence), outbound_obj, sending_client))
+
+    def run_scheduler(self, now):
+        # hand out the scheduled carriers that are due
+        while self.scheduled_carriers and self.scheduled_carriers[0][0] <= now:
+            send_time, _, outbound_obj, sending_client = heapq.heappop(self.scheduled_carriers)
+            if outbound_obj.trace is not None:
+                # time the scheduled carrier from when it was due
+                outbound_obj.trace = (outbound_obj.trace[0], send_time, send_time)
+            if outbound_obj.multicast == True:
+                for client in self.clients.values():
+                    client.outbound_commands_list.append(copy.copy(outbound_obj))
+                    self.updated_clients.add(client)
+            elif self.clients.get((sending_client.ip_and_port, sending_client.session_id)) is sending_client:
+                sending_client.outbound_commands_list.append(outbound_obj)
+                self.updated_clients.add(sending_client)
+        # the running transitions work out their updates when they are due
+        transition_engine = atem_commands.transition_engine
+        if transition_engine.transitions:
+            for outbound_obj in transition_engine.tick(now):
+                self.send_to_other_clients(None, outbound_obj)
+
+    def get_next_scheduled_time(self):
+        # send time of the next scheduled carrier or transition update, or
+        # None if nothing is scheduled
+        next_time = atem_commands.transition_engine.get_next_time()
+        if self.scheduled_carriers and (next_time is None or self.scheduled_carriers[0][0] < next_time):
+            next_time = self.scheduled_carriers[0][0]
+        return next_time
+
+    def get_wait_time(self):
+        """
+        How long the server can wait for incoming packets before the clients
+        need to be updated, either to send a scheduled carrier or for a
+        client's timer.
+        """
+        wait_time = CLIENT_UPDATE_INTERVAL
+        for next_time in (self.get_next_scheduled_time(), self.get_next_client_time()):
+            if next_time is not None:
+                wait_time = min(wait_time, max(0, next_time - time.monotonic()))
+        return wait_time
+
+    def update_client(self, client: ATEMClient, sock: socket.socket):
+        """
+        Run the client's update and drop it if it has finished.
+        Returns False if the client was dropped.
+        """
+        client.update(sock)
+        if client.client_state == ATEMClientState.FINISHED:
+            print(f"Dropping client={client.ip_and_port}, session=0x{client.session_id:x}")
+            if self.clients.get((client.ip_and_port, client.session_id)) is client:
+                del self.clients[(client.ip_and_port, client.session_id)]
+                self.retire_counters(client)
             print(f"client count={len(self.clients)}")
+            return False
+        return True
+
+    def run_clients(self, sock: socket.socket):
+        """
+        Update the clients that have something to do: the ones given
+        something to send or that have sent something (updated_clients) and
+        the ones whose timer is due
+        """
+        now = time.monotonic()
+        self.run_scheduler(now)
+        clients = self.updated_clients
+        self.updated_clients = set()
+        while self.client_timers and self.client_timers[0][0] <= now:
+            timer_time, _, client = heapq.heappop(self.client_timers)
+            if client.next_update_time == timer_time:
+                client.next_update_time = None
+                clients.add(client)
+        for client in clients:
+            if self.clients.get((client.ip_and_port, client.session_id)) is not client:
+                # dropped, or replaced by a new session from the same address
+                continue
+            if self.update_client(client, sock):
+                self.set_client_timer(client, now)
+
+    def set_client_timer(self, client: ATEMClient, now):
+        next_time = client.get_next_update_time()
+        if next_time <= now:
+            # (eg. waiting on an ack) check back after the usual update interval
+            next_time = now + CLIENT_UPDATE_INTERVAL
+        # An earlier timer is left to go off, the client just gets a new one then
+        if client.next_update_time is None or next_time < client.next_update_time:
+            client.next_update_time = next_time
+            heapq.heappush(self.client_timers, (next_time, next(self.client_timer_sequence), client))
+
+    def get_next_client_time(self):
+        # when run_clients() next has a client to update for its timer, None if none
+        while self.client_timers and self.client_timers[0][2].next_update_time != self.client_timers[0][0]:
+            heapq.heappop(self.client_timers)
+        return self.client_timers[0][0] if self.client_timers else None
 
     def send_to_other_clients(self, sending_client, outbound_obj):
-        for client in self.clients:
-            if client.ip_and_port == sending_client.ip_and_port and client.session_id == sending_client.session_id:
+        outbound_obj.to_bytes()
+        for client in self.clients.values():
+            if client is sending_client:
                 # this is the sending client, so don't send to itself
                 pass
             else:
                 # Give each client a shallow copy of the commands carrier so the ack_packet_id
-                # can be different for each client.
+                # can be different for each client. The commands are encoded before copying
+                # so all the copies share the same encoded bytes.
                 client.outbound_commands_list.append(copy.copy(outbound_obj))
+                self.updated_clients.add(client)
+
+    def process_remote_commands(self, in_packet: Packet):
+        """
+        Apply commands that a client of another worker process sent (see
+        atem_shard) and send the updates to this worker's clients.
+        """
+        cmds_carrier_list = atem_commands.get_response(in_packet.commands)
+        now = time.monotonic()
+        trace = None
+        if atem_latency.enabled:
+            trace = (in_packet.commands[0].code if in_packet.commands else None, in_packet.timestamp, now)
+        for cc in cmds_carrier_list:
+            cc.trace = trace
+            if cc.multicast == False:
+                # only for the client that sent it
+                continue
+            if cc.send_time > now:
+                self.schedule(None, cc)
+            else:
+                self.send_to_other_clients(None, cc)
+
+    def reload_config(self, config_file):
+        """
+        Reload the config file and send what changed to every client (see
+        atem_commands.reload_config)
+        """
+        for cc in atem_commands.reload_config(config_file):
+            self.send_to_other_clients(None, cc)
+
+    def apply_config(self, config_file, changed_values):
+        """
+        Use a config reloaded somewhere else and send what changed to every
+        client (see atem_commands.apply_config)
+        """
+        for cc in atem_commands.apply_config(config_file, changed_values):
+            self.send_to_other_clients(None, cc)
+
+    def get_coalesce_summary(self):
+        return (f"coalesced: {self.coalesced_commands} superseded commands, "
+                f"{self.coalesced_packets} packets, {self.coalesced_bytes} bytes not sent")
+
+    def retire_counters(self, client: ATEMClient):
+        for name in CLIENT_COUNTERS:
+            self.retired_counters[name] += getattr(client, name)
+
+    def get_counters(self):
+        """
+        CLIENT_COUNTERS totalled over every client there has been
+        """
+        counters = dict(self.retired_counters)
+        for client in self.clients.values():
+            for name in CLIENT_COUNTERS:
+                counters[name] += getattr(client, name)
+        return counters
+
+    def print_stats(self, per_client=False, file=None):
+        """
+        Print the transport counters, and the round trip times etc. of each
+        client if per_client is set (the server does on SIGUSR2)
+        """
+        counters = self.get_counters()
+        print(f"clients: {len(self.clients)}, packets sent: {counters['packets_sent']} ({counters['bytes_sent']} bytes), "
+              f"resent: {counters['packets_resent']} ({counters['resend_timeouts']} timeouts), "
+              f"window stalls: {counters['window_stalls']}", file=file)
+        print(f"keepalives: {counters['keepalives_sent']} packets ({counters['keepalive_bytes_sent']} bytes), "
+              f"everything else: {counters['packets_sent'] - counters['keepalives_sent']} packets "
+              f"({counters['bytes_sent'] - counters['keepalive_bytes_sent']} bytes)", file=file)
+        print(self.get_coalesce_summary(), file=file)
+        if not per_client:
+            return
+        print(f"  {'client':<22} {'session':>7} {'in flight':>9} {'rtt ms':>7} {'rto ms':>7} "
+              f"{'sent':>8} {'resent':>7} {'timeouts':>8} {'stalls':>7} {'keepalive':>9}", file=file)
+        for client in self.clients.values():
+            address = f"{client.ip_and_port[0]}:{client.ip_and_port[1]}" if client.ip_and_port else "?"
+            rtt = "-" if client.smoothed_rtt is None else f"{client.smoothed_rtt * 1000:.1f}"
+            print(f"  {address:<22} {client.session_id:>#7x} {len(client.unacked_packet_list):>9} {rtt:>7} "
+                  f"{client.resend_timeout * 1000:>7.0f} {client.packets_sent:>8} {client.packets_resent:>7} "
+                  f"{client.resend_timeouts:>8} {client.window_stalls:>7} {client.keepalives_sent:>9}", file=file)
 
     def get_next_client_id(self):
         self.client_counter += 1
         return self.client_counter
+
+
+if __name__ == "__main__":
+    # Quick test: a burst of preview changes coalesces to the last one, and
+    # the sender still gets every ack
+    import atem_config
+    atem_config.config_init("default_config.xml")
+
+    class RecordingSocket(object):
+        def __init__(self):
+            self.sent = []
+
+        def sendto(self, data, addr):
+            packet = Packet(addr, bytes(data))
+            packet.parse_packet()
+            # the codes of the commands (parse_packet only decodes the ones from clients)
+            packet.codes = []
+            offset = 12
+            while offset < packet.packet_length:
+                cmd_length, code = atem_commands.CMD_HEADER.unpack_from(packet.bytes, offset)
+                packet.codes.append(code.decode())
+                offset += cmd_length
+            self.sent.append(packet)
+
+    def make_packet(ip_and_port, flags, session_id, packet_id=0, acked_packet_id=0, payload=b''):
+        raw = struct.pack('!3H 4x H', (flags << 11) | (12 + len(payload)), session_id, acked_packet_id, packet_id) + payload
+        packet = Packet(ip_and_port, raw)
+        packet.parse_packet()
+        return packet
+
+    client_mgr = ClientManager()
+    sock = RecordingSocket()
+    panel, tally = [client_mgr.get_client(('127.0.0.1', port), 0x1234) for port in (10000, 10001)]
+    for client in (panel, tally):
+        client.process_inbound_packet(make_packet(client.ip_and_port, ATEMFlags.INIT, 0x1234, payload=b'\x01' + b'\x00' * 7))
+        client.update(sock)
+        client.process_inbound_packet(make_packet(client.ip_and_port, ATEMFlags.ACK, 0x1234, acked_packet_id=client.current_packet_id))
+        client.update(sock)
+        client.process_inbound_packet(make_packet(client.ip_and_port, ATEMFlags.ACK, client.session_id, acked_packet_id=client.current_packet_id))
+    sock.sent.clear()
+    for packet_id, source in enumerate((2, 3, 4), 1):
+        cpvi = struct.pack('!H 2x 4s B x H', 12, b'CPvI', 0, source)
+        panel.process_inbound_packet(make_packet(panel.ip_and_port, ATEMFlags.COMMAND, panel.session_id, packet_id, payload=cpvi))
+    panel.update(sock)
+    tally.update(sock)
+    to_panel = [packet for packet in sock.sent if packet.ip_and_port == panel.ip_and_port]
+    to_tally = [packet for packet in sock.sent if packet.ip_and_port == tally.ip_and_port]
+    # (the acks of the coalesced responses ride on the last one, they're cumulative)
+    assert [packet.ACKed_packet_id for packet in to_panel] == [3]
+    assert len(to_tally) == 1
+    assert to_tally[0].codes == ['Time', 'TlIn', 'TlSr', 'PrvI']
+    assert to_tally[0].bytes[-6:-4] == b'\x00\x04'
+    assert client_mgr.coalesced_commands == 16 and client_mgr.coalesced_packets == 2
+
+    # a client that is behind on its acks gets its updates held back, then coalesced
+    sock.sent.clear()
+    for packet_id, source in enumerate((5, 6, 7), 4):
+        cpvi = struct.pack('!H 2x 4s B x H', 12, b'CPvI', 0, source)
+        panel.process_inbound_packet(make_packet(panel.ip_and_port, ATEMFlags.COMMAND, panel.session_id, packet_id, payload=cpvi))
+        panel.update(sock)
+        tally.update(sock)
+    assert len([packet for packet in sock.sent if packet.ip_and_port == tally.ip_and_port]) == 1
+    assert len(tally.outbound_commands_list) == 1
+    tally.process_inbound_packet(make_packet(tally.ip_and_port, ATEMFlags.ACK, tally.session_id, acked_packet_id=tally.current_packet_id))
+    tally.update(sock)
+    assert not tally.outbound_commands_list and tally.hold_start_time is None
+    assert sock.sent[-1].ip_and_port == tally.ip_and_port and sock.sent[-1].bytes[-6:-4] == b'\x00\x07'
+
+    # the acks give the round trip time, and the resend timeout follows it
+    assert tally.smoothed_rtt is not None and RTO_MIN <= tally.resend_timeout < PACKET_RESEND_INTERVAL
+    for _ in range(50):
+        tally.update_rtt(0.300)
+    assert abs(tally.smoothed_rtt - 0.300) < 0.01 and 0.300 < tally.resend_timeout < 0.350
+
+    # no more than IN_FLIGHT_WINDOW packets waiting for an ack, the rest wait their turn
+    tally.process_inbound_packet(make_packet(tally.ip_and_port, ATEMFlags.ACK, tally.session_id, acked_packet_id=tally.current_packet_id))
+    sock.sent.clear()
+    # (big enough to need a packet each)
+    raw = atem_commands.CMD_HEADER.pack(1000, b'XXXX') + bytes(992)
+    for _ in range(IN_FLIGHT_WINDOW + 8):
+        cc = CommandCarrier()
+        cc.commands.append(atem_commands.Cmd_Raw(raw))
+        tally.outbound_commands_list.append(cc)
+    tally.update(sock)
+    assert len(tally.unacked_packet_list) == IN_FLIGHT_WINDOW == len(sock.sent)
+    assert len(tally.outbound_commands_list) == 8 and tally.window_stalls == 1
+    tally.process_inbound_packet(make_packet(tally.ip_and_port, ATEMFlags.ACK, tally.session_id, acked_packet_id=tally.current_packet_id))
+    tally.update(sock)
+    assert len(sock.sent) == IN_FLIGHT_WINDOW + 8 and not tally.outbound_commands_list
+
+    # an unacked packet gets resent (flagged as a retransmission) and the timeout backs off
+    resend_timeout = tally.resend_timeout
+    tally.resend_queue = deque((send_time - resend_timeout - 0.001, send_count, pkt)
+                               for send_time, send_count, pkt in tally.resend_queue)
+    sock.sent.clear()
+    tally.update(sock)
+    assert len(sock.sent) == 8 and all(packet.flags & ATEMFlags.RETRANSMITION for packet in sock.sent)
+    assert tally.packets_resent == 8 and tally.resend_timeouts == 1 and tally.resend_timeout == min(RTO_MAX, 2 * resend_timeout)
+
+    # carriers that are due together share a packet, one too big for a packet is split
+    tally.process_inbound_packet(make_packet(tally.ip_and_port, ATEMFlags.ACK, tally.session_id, acked_packet_id=tally.current_packet_id))
+    sock.sent.clear()
+    small = atem_commands.CMD_HEADER.pack(12, b'XXXX') + bytes(4)
+    big = atem_commands.CMD_HEADER.pack(500, b'YYYY') + bytes(492)
+    for raw_cmds in [[small]] * 10 + [[big] * 7, [small]]:
+        cc = CommandCarrier()
+        cc.commands = [atem_commands.Cmd_Raw(raw) for raw in raw_cmds]
+        tally.outbound_commands_list.append(cc)
+    first_packet_id = tally.current_packet_id + 1
+    tally.update(sock)
+    assert [packet.codes for packet in sock.sent] == [['XXXX'] * 10, ['YYYY'] * 2, ['YYYY'] * 2, ['YYYY'] * 2, ['YYYY', 'XXXX']]
+    assert [packet.packet_id for packet in sock.sent] == list(range(first_packet_id, first_packet_id + 5))
+    assert all(len(packet.bytes) + IP_UDP_HEADER_SIZE <= PACKET_MTU for packet in sock.sent)
+    # the setup dump sent on connecting fits in a smaller MTU too
+    PACKET_MTU = 1000
+    sock.sent.clear()
+    client = client_mgr.get_client(('127.0.0.1', 10002), 0x1234)
+    client.process_inbound_packet(make_packet(client.ip_and_port, ATEMFlags.INIT, 0x1234, payload=b'\x01' + b'\x00' * 7))
+    client.update(sock)
+    client.process_inbound_packet(make_packet(client.ip_and_port, ATEMFlags.ACK, 0x1234, acked_packet_id=client.current_packet_id))
+    client.update(sock)
+    assert len(sock.sent) > 8 and all(len(packet.bytes) + IP_UDP_HEADER_SIZE <= PACKET_MTU for packet in sock.sent)
+    client_mgr.clients.pop((client.ip_and_port, client.session_id))
+    PACKET_MTU = 1500
+    sock.sent.clear()
+
+    # no keepalive while packets are waiting for an ack, their resends do the job
+    tally.last_activity_time -= CLIENT_ACTIVITY_TIMEOUT + 0.001
+    assert tally.get_keepalive_time() is None
+    # once it's quiet the client gets one keepalive, resent with backoff until it's acked
+    tally.process_inbound_packet(make_packet(tally.ip_and_port, ATEMFlags.ACK, tally.session_id, acked_packet_id=tally.current_packet_id))
+    tally.update(sock)
+    tally.last_activity_time -= CLIENT_ACTIVITY_TIMEOUT + 0.001
+    assert tally.get_keepalive_time() <= time.monotonic()
+    sock.sent.clear()
+    tally.update(sock)
+    tally.update(sock)
+    assert len(sock.sent) == 1 and not sock.sent[0].codes and tally.keepalives_sent == 1 and not tally.unacked_packet_list
+    retry_interval = tally.keepalive_retry_interval
+    tally.keepalive_retry_time = time.monotonic()
+    tally.update(sock)
+    assert len(sock.sent) == 2 and sock.sent[1].packet_id == sock.sent[0].packet_id and sock.sent[1].flags & ATEMFlags.RETRANSMITION
+    assert tally.keepalive_retry_interval == min(RTO_MAX, 2 * retry_interval)
+    tally.process_inbound_packet(make_packet(tally.ip_and_port, ATEMFlags.ACK, tally.session_id, acked_packet_id=sock.sent[0].packet_id))
+    assert tally.keepalive_packet is None
+    assert tally.get_keepalive_time() == tally.last_activity_time + CLIENT_ACTIVITY_TIMEOUT
+    # and a client that stays quiet is dropped
+    tally.last_activity_time -= CLIENT_DROPOUT_TIMEOUT + 0.001
+    sock.sent.clear()
+    tally.update(sock)
+    tally.update(sock)
+    assert sock.sent[0].flags == ATEMFlags.INIT and tally.client_state == ATEMClientState.FINISHED
+
+    # run_clients() only updates the clients that are due
+    client_mgr.updated_clients.clear()
+    panel.last_activity_time = time.monotonic()
+    client_mgr.set_client_timer(panel, time.monotonic())
+    sock.sent.clear()
+    client_mgr.run_clients(sock)
+    assert not sock.sent and client_mgr.get_next_client_time() == panel.next_update_time > time.monotonic()
+    client_mgr.print_stats(per_client=True)
@@ -3,13 +3,11 @@
 # This isn't a particularly intelligent way to set up the switcher but
 # it's good enough for now.
 
-import struct
 
 def getByteStream(packetString):
-    converted = b''
-    for theByte in packetString.strip().replace("\n", " ").split():
-        converted += struct.pack("!B", int(theByte, 16))
-    return converted
+    # bytes.fromhex() skips the whitespace and newlines between the hex pairs
+    # and converts the whole capture in one pass.
+    return bytes.fromhex(packetString)
 
 
 commands1 = """